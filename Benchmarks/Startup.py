@@ -0,0 +1,117 @@
+# Measures how long uChip takes to start and fails if it got slower than the allowed limits.
+# Every measurement runs in a fresh interpreter, so nothing is cached between runs. Run from the
+# uChip directory:
+#   python -m Benchmarks.Startup
+#   python -m Benchmarks.Startup --repeat 10 --max-gui 1.5
+# The GUI measurement is skipped if PySide6 is not installed. It uses Qt's offscreen platform, so
+# no display is needed.
+import argparse
+import importlib.util
+import os
+import statistics
+import subprocess
+import sys
+from typing import List, Optional
+
+# Modules that must not be imported before they are needed.
+DEFERRED_MODULES = ["dill", "serial"]
+
+# Imports the headless session and reports any deferred modules that were imported anyway.
+HEADLESS_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+from Data.Session import Session
+session = Session(devicesPath=None)
+print(time.perf_counter() - start)
+print(",".join(m for m in %r + ["PySide6"] if m in sys.modules))
+""" % DEFERRED_MODULES
+
+# Builds the main window and waits until it has painted once.
+GUI_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+from PySide6 import QtWidgets
+from PySide6.QtCore import QEventLoop
+app = QtWidgets.QApplication(sys.argv)
+from UI.MainWindow import MainWindow
+window = MainWindow()
+app.processEvents(QEventLoop.AllEvents)
+print(time.perf_counter() - start)
+print(",".join(m for m in %r if m in sys.modules))
+window.programWorker.doStop = True
+window.usbWorker.doStop = True
+window.programWorker.thread.join()
+window.usbWorker.thread.join()
+""" % DEFERRED_MODULES
+
+
+class Measurement:
+    def __init__(self, name: str, limit: float):
+        self.name = name
+        self.limit = limit
+        self.times: List[float] = []
+        self.eagerModules: List[str] = []
+        self.error: Optional[str] = None
+
+    def Median(self):
+        return statistics.median(self.times) if len(self.times) > 0 else None
+
+    def Passed(self):
+        return self.error is None and len(self.eagerModules) == 0 and self.Median() <= self.limit
+
+
+def RunScript(script: str, environment=None):
+    result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True,
+                            env=environment)
+    if result.returncode != 0:
+        raise Exception(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else
+                        "exited with code %d" % result.returncode)
+    lines = result.stdout.splitlines()
+    return float(lines[-2]), [m for m in lines[-1].split(",") if m != ""]
+
+
+def Measure(name: str, script: str, limit: float, repeat: int, environment=None):
+    measurement = Measurement(name, limit)
+    for _ in range(repeat):
+        try:
+            seconds, eagerModules = RunScript(script, environment)
+        except Exception as e:
+            measurement.error = str(e)
+            return measurement
+        measurement.times.append(seconds)
+        measurement.eagerModules = sorted(set(measurement.eagerModules + eagerModules))
+    return measurement
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m Benchmarks.Startup",
+                                     description="Measure uChip startup time.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-headless", type=float, default=0.5,
+                        help="The allowed median seconds to set up a headless session.")
+    parser.add_argument("--max-gui", type=float, default=2.0,
+                        help="The allowed median seconds until the main window has painted.")
+    args = parser.parse_args(argv)
+
+    measurements = [Measure("Headless session", HEADLESS_SCRIPT, args.max_headless, args.repeat)]
+    if importlib.util.find_spec("PySide6") is not None:
+        environment = dict(os.environ, QT_QPA_PLATFORM="offscreen")
+        measurements.append(Measure("Main window painted", GUI_SCRIPT, args.max_gui, args.repeat,
+                                    environment))
+    else:
+        print("PySide6 is not installed; skipping the GUI measurement.")
+
+    for m in measurements:
+        if m.error is not None:
+            print("%-22s FAILED: %s" % (m.name, m.error))
+            continue
+        print("%-22s median %.3f s (min %.3f s, limit %.3f s)%s" %
+              (m.name, m.Median(), min(m.times), m.limit, "" if m.Passed() else "  REGRESSION"))
+        if len(m.eagerModules) > 0:
+            print("%-22s imported at startup: %s" % ("", ", ".join(m.eagerModules)))
+
+    return 0 if all(m.Passed() for m in measurements) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
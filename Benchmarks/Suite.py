@@ -0,0 +1,259 @@
+# Benchmarks of the program engine, the rig and project files. Runs without Qt or hardware.
+# Run from the uChip directory:
+#   python -m Benchmarks.Suite --output results.json
+#   python -m Benchmarks.Suite --baseline Benchmarks/baseline.json --tolerance 0.25
+# Each result is the fastest time of one operation (e.g. one tick or one call) over several
+# repeats, which is the least sensitive to other load on the machine. With --baseline, the run
+# fails if any result is more than [tolerance] slower than the stored result of the same name.
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from Data.Chip import Chip, Valve, Program, Script
+from Data.Clock import VirtualClock
+from Data.FileIO import SaveObject, LoadObject
+from Data.ProjectFile import SaveProject, LoadProject
+from Data.ProgramCompilation import ProgramRegistry, Recompile, CallFunction, Message
+from Data.Rig import Rig, Device
+from Data.Scheduler import Scheduler
+
+
+# A connected device that discards everything written to it.
+class BenchmarkDevice(Device):
+    def __init__(self, startNumber: int):
+        super().__init__()
+        self.startNumber = startNumber
+        self.enabled = True
+        self.available = True
+        self.bytesWritten = 0
+
+    def IsConnected(self):
+        return True
+
+    def Write(self, data):
+        self.bytesWritten += len(data)
+
+
+class Benchmark:
+    def __init__(self, name: str, operation: Callable[[], None], operationsPerCall: int = 1):
+        self.name = name
+        self.operation = operation
+        self.operationsPerCall = operationsPerCall
+
+
+# Times [benchmark] and returns the fastest seconds per operation over [repeat] repeats. Calls are
+# grouped so that each repeat takes at least [minSeconds].
+def Measure(benchmark: Benchmark, repeat: int, minSeconds: float):
+    benchmark.operation()
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            benchmark.operation()
+        elapsed = time.perf_counter() - start
+        if elapsed >= minSeconds or calls >= 1 << 20:
+            break
+        calls *= 2 if elapsed <= 0 else max(2, int(minSeconds / elapsed) + 1)
+    samples = [elapsed]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(calls):
+            benchmark.operation()
+        samples.append(time.perf_counter() - start)
+    return min(samples) / calls / benchmark.operationsPerCall
+
+
+def BuildProgram(chip: Chip, rig: Rig, source: str, name="Benchmark"):
+    program = Program(Script(None, True, source, name))
+    program.name = name
+    chip.AddProgram(program)
+    registry = ProgramRegistry(chip, rig)
+    registry.clock = VirtualClock()
+    compiledProgram = registry.Compile(program)
+    errors = [m.text for m in compiledProgram.messages if m.messageType != Message.MESSAGE]
+    if len(errors) > 0:
+        raise Exception("Benchmark script did not compile:\n" + errors[0])
+    return registry, compiledProgram
+
+
+def BuildChip(valveCount: int):
+    chip = Chip()
+    for i in range(valveCount):
+        valve = Valve()
+        valve.name = "Valve %d" % i
+        valve.solenoidNumber = i
+        valve.rect = [i * 10, 0, 10, 10]
+        chip.AddValve(valve)
+    return chip
+
+
+# A script with [count] parameters, helpers and functions.
+def LargeScript(count: int):
+    lines = ["from ucscript import *", ""]
+    for i in range(count):
+        lines += ["p%d = Parameter(int, defaultValue=%d)" % (i, i),
+                  "",
+                  "def Helper%d(x):" % i,
+                  "    return x * %d + p%d.Get()" % (i, i),
+                  "",
+                  "@display",
+                  "def Function%d():" % i,
+                  "    for i in range(3):",
+                  "        Log(str(Helper%d(i)))" % i,
+                  "        yield WaitForSeconds(1)",
+                  ""]
+    return "\n".join(lines)
+
+
+def RecompileBenchmarks():
+    benchmarks = []
+    with open("ReagentToggle.py") as f:
+        small = f.read()
+    for name, source in [("small", small), ("large", LargeScript(500))]:
+        registry, compiledProgram = BuildProgram(BuildChip(20), Rig(), source)
+        benchmarks.append(Benchmark("Recompile/%s" % name,
+                                    lambda c=compiledProgram, r=registry: Recompile(c, r)))
+    return benchmarks
+
+
+def TickBenchmarks():
+    benchmarks = []
+    for count in [1, 10, 100, 1000]:
+        source = "from ucscript import *\n\n" + "\n".join(
+            "def F%d():\n    while True:\n        yield\n" % i for i in range(count))
+        rig = Rig()
+        registry, compiledProgram = BuildProgram(BuildChip(0), rig, source)
+        for i in range(count):
+            CallFunction(compiledProgram, "F%d" % i)
+        scheduler = Scheduler(rig, lambda r=registry: r.compiledPrograms, registry.clock)
+        benchmarks.append(Benchmark("TickFunction/%d functions" % count, scheduler.Tick, count))
+    return benchmarks
+
+
+def FlushBenchmarks():
+    benchmarks = []
+    for count in [1, 4, 16]:
+        rig = Rig()
+        rig.allDevices = [BenchmarkDevice(i * 24) for i in range(count)]
+        for i in range(count * 24):
+            rig.SetSolenoidState(i, i % 3 == 0)
+        benchmarks.append(Benchmark("FlushStates/%d devices" % count, rig.FlushStates))
+    return benchmarks
+
+
+def FileBenchmarks(directory: Path):
+    benchmarks = []
+    for count in [10, 1000, 10000]:
+        chip = BuildChip(count)
+        path = directory / ("chip%d.ucp" % count)
+        SaveObject(chip, path)
+        benchmarks.append(Benchmark("SaveObject/%d valves" % count,
+                                    lambda c=chip, p=path: SaveObject(c, p)))
+        benchmarks.append(Benchmark("LoadObject/%d valves" % count, lambda p=path: LoadObject(p)))
+        projectPath = directory / ("project%d.ucp" % count)
+        SaveProject(chip, projectPath)
+        benchmarks.append(Benchmark("SaveProject/%d valves" % count,
+                                    lambda c=chip, p=projectPath: SaveProject(c, p)))
+        benchmarks.append(Benchmark("LoadProject/%d valves" % count,
+                                    lambda p=projectPath: LoadProject(p)))
+    return benchmarks
+
+
+def LookupBenchmarks():
+    source = """from ucscript import *
+
+number = Parameter(int)
+valve = Parameter(Valve)
+valves = ListParameter(Valve)
+"""
+    chip = BuildChip(1000)
+    registry, compiledProgram = BuildProgram(chip, Rig(), source)
+    compiledProgram.program.parameterValues["valve"] = chip.valves[500]
+    compiledProgram.program.parameterValues["valves"] = chip.valves[:24]
+    findValve = compiledProgram.globalsDict["FindValve"]
+    parameters = compiledProgram.parameters
+
+    def FindValves():
+        for i in range(0, 1000, 10):
+            findValve("Valve %d" % i)
+
+    return [Benchmark("FindValve", FindValves, 100),
+            Benchmark("Parameter.Get/int", parameters["number"].Get),
+            Benchmark("Parameter.Get/Valve", parameters["valve"].Get),
+            Benchmark("Parameter.Get/list of 24 valves", parameters["valves"].Get)]
+
+
+def Compare(results: Dict[str, float], baseline: Dict[str, float], tolerance: float):
+    regressions = []
+    for name, seconds in results.items():
+        if name not in baseline:
+            continue
+        ratio = seconds / baseline[name] if baseline[name] > 0 else 1
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+        print("%-36s %10s -> %10s  %+6.1f%%%s" % (name, FormatSeconds(baseline[name]),
+                                                  FormatSeconds(seconds), (ratio - 1) * 100,
+                                                  "  REGRESSION" if ratio > 1 + tolerance else ""))
+    return regressions
+
+
+def FormatSeconds(seconds: float):
+    for unit, scale in [("s", 1), ("ms", 1e-3), ("us", 1e-6)]:
+        if seconds >= scale:
+            return "%.3f %s" % (seconds / scale, unit)
+    return "%.1f ns" % (seconds / 1e-9)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m Benchmarks.Suite",
+                                     description="Benchmark the uChip engine, rig and files.")
+    parser.add_argument("--output", type=Path, default=None,
+                        help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", type=Path, default=None,
+                        help="Compare against the results in this JSON file.")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="The allowed slowdown relative to the baseline (0.25 = 25%%).")
+    parser.add_argument("--filter", default="",
+                        help="Only run benchmarks whose name contains this text.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-seconds", type=float, default=0.05,
+                        help="The minimum duration of each repeat.")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        benchmarks: List[Benchmark] = RecompileBenchmarks() + TickBenchmarks() + \
+            FlushBenchmarks() + FileBenchmarks(Path(directory)) + LookupBenchmarks()
+        results = {}
+        for benchmark in benchmarks:
+            if args.filter not in benchmark.name:
+                continue
+            results[benchmark.name] = Measure(benchmark, args.repeat, args.min_seconds)
+            print("%-36s %10s" % (benchmark.name, FormatSeconds(results[benchmark.name])),
+                  flush=True)
+
+    output = {"python": sys.version.split()[0], "platform": platform.platform(),
+              "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "unit": "seconds per operation",
+              "results": results}
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        print()
+        regressions = Compare(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print("\n%d benchmark(s) regressed by more than %d%%." %
+                  (len(regressions), args.tolerance * 100))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
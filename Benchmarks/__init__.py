@@ -0,0 +1 @@
+# Performance benchmarks. Run from the uChip directory, e.g. python -m Benchmarks.Startup
@@ -21,8 +21,24 @@ def ClosePump():
 @onPause(ClosePump)
 @display
 def RunPump():
-    i = 0
+    # The pattern plays until the pump is turned off or its valves change. Changes to
+    # cyclesPerSecond apply from the next step, without restarting the pattern.
+    stopped = False
     while True:
-        [valve.Get().SetOpen(bool(state)) for (valve, state) in zip(pumpValves, pattern[i])]
-        yield WaitForSeconds(1 / cyclesPerSecond.Get())
-        i = (i + 1) % len(pattern)
+        valves = [valve.Get() for valve in pumpValves]
+
+        def StepSeconds():
+            rate = cyclesPerSecond.Get()
+            if rate <= 0 or [valve.Get() for valve in pumpValves] != valves:
+                return None
+            return 1 / rate
+
+        if cyclesPerSecond.Get() <= 0:
+            if not stopped:
+                Log("The pump waits until cyclesPerSecond is more than 0.")
+                ClosePump()
+                stopped = True
+            yield WaitForSeconds(0.1)
+            continue
+        stopped = False
+        yield PlayPattern(valves, pattern, StepSeconds)
@@ -5,8 +5,8 @@ valveTest = Parameter(float)
 
 @display
 def OpenAll():
-    [v.Open() for v in valves.Get()]
+    FindValves(valves.Get()).OpenAll()
 
 @display
 def CloseAll():
-    [v.Close() for v in valves.Get()]
+    FindValves(valves.Get()).CloseAll()
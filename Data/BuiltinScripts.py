@@ -0,0 +1,66 @@
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from Data.Chip import Chip, Script
+
+# The folder of the scripts that ship with uChip.
+BUILTINS_DIRECTORY = Path("Builtins")
+
+# The built-in scripts, read from BUILTINS_DIRECTORY the first time they are needed and shared by
+# every chip in the process. They are keyed by (name, digest of the source) (see Script.Key), so a
+# project can refer to a built-in without storing its source, and can tell whether the built-in
+# it was saved with is the one this version of uChip ships.
+_scripts: Optional[List[Script]] = None
+_byKey: Dict[Tuple[str, str], Script] = {}
+_byName: Dict[str, Script] = {}
+_lock = threading.Lock()
+
+
+def BuiltinScripts() -> List[Script]:
+    global _scripts
+    if _scripts is None:
+        with _lock:
+            if _scripts is None:
+                scripts = []
+                if BUILTINS_DIRECTORY.is_dir():
+                    for path in sorted(BUILTINS_DIRECTORY.glob("*.py")):
+                        scripts.append(Script(None, True, path.read_text(encoding="utf-8"),
+                                              path.stem))
+                _byKey.update({s.Key(): s for s in scripts})
+                _byName.update({s.biName: s for s in scripts})
+                _scripts = scripts
+    return _scripts
+
+
+# The built-in script with the given name and digest, or if [digest] is None, the current one with
+# that name.
+def FindBuiltin(name: str, digest: Optional[str] = None) -> Optional[Script]:
+    BuiltinScripts()
+    if digest is None:
+        return _byName.get(name)
+    return _byKey.get((name, digest))
+
+
+# Whether [script] is a built-in that this version of uChip ships, rather than an older (or newer)
+# version of one that was saved with a project.
+def IsShippedBuiltin(script: Script) -> bool:
+    return script.isBuiltIn and FindBuiltin(*script.Key()) is not None
+
+
+# Replaces the chip's copies of built-in scripts (e.g. from a project saved with dill) with the
+# shared ones, and adds the shipped built-ins that the chip does not list yet. Copies that this
+# version of uChip does not ship are kept, so existing programs keep the code they were saved
+# with, while new programs can use the shipped version of the same name.
+def ResolveBuiltins(chip: Chip):
+    replacements = {}
+    for script in chip.scripts:
+        if script.isBuiltIn:
+            shared = FindBuiltin(*script.Key())
+            if shared is not None:
+                replacements[id(script)] = shared
+    chip.scripts = [replacements.get(id(s), s) for s in chip.scripts]
+    for program in chip.programs:
+        program.script = replacements.get(id(program.script), program.script)
+    keys = {s.Key() for s in chip.scripts if s.isBuiltIn}
+    chip.scripts = [s for s in BuiltinScripts() if s.Key() not in keys] + chip.scripts
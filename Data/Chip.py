@@ -1,5 +1,6 @@
+import hashlib
 import typing
-from typing import Optional, List, Dict, Any, Union, Callable, Type
+from typing import Optional, List, Dict, Any, Union, Callable, Type, Tuple
 from pathlib import Path
 import os
 
@@ -10,13 +11,56 @@ class Chip:
         self.images: List[Image] = []
         self.text: List[Text] = []
         self.programs: List[Program] = []
-        self.scripts: List[Script] = []
-
-        builtinFiles = Path("Builtins").iterdir()
-        for x in builtinFiles:
-            f = open(x)
-            self.scripts.append(Script(None, True, f.read(), x.stem))
-            f.close()
+        # The built-in scripts are shared by all chips and only read from disk once. Imported here
+        # because Data.BuiltinScripts imports this module.
+        from Data.BuiltinScripts import BuiltinScripts
+        self.scripts: List[Script] = list(BuiltinScripts())
+
+    def __getstate__(self):
+        # Drops the lookups, which are caches that are rebuilt after loading.
+        state = self.__dict__.copy()
+        for cached in ("_valveLookup", "_valveLookupKey", "_programLookup", "_programLookupKey"):
+            state.pop(cached, None)
+        return state
+
+    def AddValve(self, valve: 'Valve'):
+        self.valves.append(valve)
+        Valve.generation += 1
+
+    def RemoveValve(self, valve: 'Valve'):
+        self.valves.remove(valve)
+        Valve.generation += 1
+
+    def AddProgram(self, program: 'Program'):
+        self.programs.append(program)
+        Program.generation += 1
+
+    def RemoveProgram(self, program: 'Program'):
+        self.programs.remove(program)
+        Program.generation += 1
+
+    # Finds the first program with the given name. Cached in the same way as FindValve().
+    def FindProgram(self, name: str) -> Optional['Program']:
+        key = (Program.generation, id(self.programs), len(self.programs))
+        if self.__dict__.get("_programLookupKey") != key:
+            lookup = {}
+            for program in self.programs:
+                lookup.setdefault(program.name, program)
+            self._programLookup = lookup
+            self._programLookupKey = key
+        return self._programLookup.get(name)
+
+    # Finds the first valve with the given name. The name lookup is cached and rebuilt whenever a
+    # valve is added, removed, renamed or renumbered.
+    def FindValve(self, name: str) -> Optional['Valve']:
+        key = (Valve.generation, id(self.valves), len(self.valves))
+        if self.__dict__.get("_valveLookupKey") != key:
+            lookup = {}
+            for valve in self.valves:
+                lookup.setdefault(valve.name, valve)
+            self._valveLookup = lookup
+            self._valveLookupKey = key
+        return self._valveLookup.get(name)
 
     def ConvertPathsToRelative(self, basePath: Path):
         for image in self.images:
@@ -26,20 +70,31 @@ class Chip:
                 continue
             script.path = Path(os.path.relpath(script.path, basePath))
 
+    # Relative paths are stored relative to the project file itself (e.g. "../script.py"), so they
+    # are normalized lexically; the project file is not a directory on POSIX systems.
     def ConvertPathsToAbsolute(self, basePath: Path):
         for image in self.images:
-            image.path = (basePath / image.path).absolute()
+            image.path = Path(os.path.abspath(basePath / image.path))
         for script in self.scripts:
             if script.isBuiltIn:
                 continue
-            script.path = (basePath / script.path).absolute()
+            script.path = Path(os.path.abspath(basePath / script.path))
 
 class Valve:
+    # Incremented whenever any valve is renamed, renumbered, added or removed so that cached
+    # lookups know to rebuild.
+    generation = 0
+
     def __init__(self):
         self.name = ""
         self.rect = [0, 0, 0, 0]
         self.solenoidNumber = 0
 
+    def __setattr__(self, key, value):
+        if key in ("name", "solenoidNumber") and self.__dict__.get(key) != value:
+            Valve.generation += 1
+        super().__setattr__(key, value)
+
 
 class Text:
     def __init__(self):
@@ -61,6 +116,13 @@ class Script:
         self.isBuiltIn = isBuiltIn
         self.biScript = biScript
         self.biName = biName
+        self.biKey: Optional[Tuple[str, str]] = None
+
+    # Built-in scripts are identified by their name and a digest of their source.
+    def Key(self) -> Tuple[str, str]:
+        if self.__dict__.get("biKey") is None:
+            self.biKey = (self.biName, hashlib.sha1(self.biScript.encode("utf-8")).hexdigest()[:16])
+        return self.biKey
 
     def Read(self):
         if self.isBuiltIn:
@@ -76,7 +138,32 @@ class Script:
         return self.path.stem
 
 
+# A program's parameter values. Any change increments Program.parameterGeneration, so that
+# waiting scripts (ucscript.WaitUntil) know when to check their conditions again.
+class ParameterValues(dict):
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        Program.parameterGeneration += 1
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        Program.parameterGeneration += 1
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        Program.parameterGeneration += 1
+
+    def copy(self):
+        return ParameterValues(self)
+
+
 class Program:
+    # Incremented whenever any program is renamed, added or removed.
+    generation = 0
+
+    # Incremented whenever any parameter value changes.
+    parameterGeneration = 0
+
     def __init__(self, script):
         self.script = script
         self.position = [0, 0]
@@ -86,7 +173,22 @@ class Program:
         self.name = ""
         self.hideMessages = False
 
+    def __setattr__(self, key, value):
+        if key == "name" and self.__dict__.get(key) != value:
+            Program.generation += 1
+        if key == "parameterValues":
+            value = ParameterValues(value)
+            Program.parameterGeneration += 1
+        super().__setattr__(key, value)
+
+    # Parameter values are saved as a plain dictionary.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["parameterValues"] = dict(self.parameterValues)
+        return state
+
     def __setstate__(self, state):
         if "hideMessages" not in state:
             state["hideMessages"] = False
+        state["parameterValues"] = ParameterValues(state.get("parameterValues", {}))
         self.__dict__ = state
@@ -0,0 +1,26 @@
+import time
+
+
+# The wall clock. Used when running programs on a real rig.
+class RealClock:
+    def Time(self) -> float:
+        return time.time()
+
+    def Sleep(self, seconds: float):
+        time.sleep(seconds)
+
+
+# A clock that only moves when it is told to. Sleeping advances the clock instantly, which lets
+# protocols that wait for hours run in seconds.
+class VirtualClock:
+    def __init__(self, startTime: float = 0.0):
+        self.now = startTime
+
+    def Time(self) -> float:
+        return self.now
+
+    def Sleep(self, seconds: float):
+        self.now += seconds
+
+    def AdvanceTo(self, t: float):
+        self.now = max(self.now, t)
@@ -0,0 +1,391 @@
+import inspect
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+from typing import Callable, List, Dict, Any, Optional, Tuple, Union
+
+import ucscript
+from Data.Chip import Chip, Valve, Program
+from Data.ProgramCompilation import ProgramRegistry, CompiledProgram, CallFunction, StopFunction, \
+    SetFunctionPaused, IsFunctionPaused, ParseParameterValue, SetProfiling
+from Data.Scheduler import Scheduler
+from Data.Session import FindProgramIn
+
+
+# A local API that lets other software on the same computer (e.g. a LIMS or a lab scheduler) run
+# program functions, set parameters and watch valve states.
+#
+# Clients connect to a Unix domain socket (or a localhost TCP port where Unix sockets are not
+# available) and send one JSON request per line:
+#   {"id": 1, "method": "CallFunction", "params": {"program": "Pump", "function": "RunPump"}}
+# and receive one JSON response per line, in the same order:
+#   {"id": 1, "result": null}     or     {"id": 1, "error": "Could not find ..."}
+# A line may also hold a JSON array of requests, which is answered with an array of responses.
+#
+# Clients do not need to wait for a response before sending the next request. All requests that
+# have arrived are run together on the program thread at the start of its next tick, so a client
+# can issue hundreds of operations per second.
+#
+# Methods (params in brackets are optional). When several projects are open, [program] can be
+# given as "Project/Program".
+#   Programs()                                  -> [{name, project, functions, parameters, running}]
+#   CallFunction(program, function, [args])     -> the return value of a non-async function
+#   StopFunction(program, function)
+#   SetFunctionPaused(program, function, paused)
+#   RunningFunctions([program])                 -> [{program, project, function, paused}]
+#   GetParameter(program, parameter)            -> the value; valves and programs by name
+#   SetParameter(program, parameter, value)     -> valves and programs by name
+#   Signal(name)                                -> wakes scripts waiting in WaitForSignal(name)
+#   GetValveStates([valves])                    -> {valve name: open}
+#   Subscribe([valves], [interval])             -> then streams {"event": "valves", "states": ...}
+#                                                  whenever a valve changes
+#   Unsubscribe()
+#   TickStats([reset])                          -> tick timing per function (see TickStats)
+#   Profile(program, [enabled], [reset])        -> time per script line and API call, slowest
+#                                                  first (see ScriptProfiler)
+class ControlServer:
+    DEFAULT_SOCKET = "uchip.sock"
+    DEFAULT_PORT = 8765
+
+    # How long a request may wait for the program thread before failing.
+    TIMEOUT = 5.0
+
+    def __init__(self, scheduler: Scheduler, registrySource: Callable[[], List[ProgramRegistry]],
+                 address: Optional[Union[str, Tuple[str, int]]] = None):
+        self.scheduler = scheduler
+        self.registrySource = registrySource
+        if address is None:
+            address = ControlServer.DEFAULT_SOCKET if hasattr(socket, "AF_UNIX") else \
+                ("127.0.0.1", ControlServer.DEFAULT_PORT)
+        self.address = address
+
+        handler = self.BuildHandler()
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.remove(address)
+            self.server = ThreadingUnixServer(address, handler)
+            os.chmod(address, 0o600)
+        else:
+            self.server = ThreadingTCPServer(address, handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def Close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+    def Describe(self):
+        if isinstance(self.address, str):
+            return "unix:" + os.path.abspath(self.address)
+        return "tcp://%s:%d" % self.address
+
+    def BuildHandler(self):
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                Connection(server, self.rfile, self.wfile).Run()
+
+        return Handler
+
+    # Runs a list of decoded requests on the program thread and returns their responses.
+    def Execute(self, requests: List[Dict], connection: 'Connection') -> List[Dict]:
+        future = self.scheduler.Invoke(lambda: [self.ExecuteOne(r, connection) for r in requests])
+        try:
+            return future.result(ControlServer.TIMEOUT)
+        except Exception as e:
+            future.cancel()
+            return [Response(r, error="The program thread did not respond: %s" % str(e) if str(e)
+                             else "The program thread did not respond.") for r in requests]
+
+    def ExecuteOne(self, request: Dict, connection: 'Connection') -> Dict:
+        if not isinstance(request, dict) or not isinstance(request.get("method"), str):
+            return Response(request, error="Requests need a 'method'.")
+        method = getattr(self, "Api" + request["method"], None)
+        if method is None:
+            return Response(request, error="Unknown method '%s'." % request["method"])
+        params = request.get("params", {})
+        if not isinstance(params, dict):
+            return Response(request, error="'params' must be an object.")
+        try:
+            inspect.signature(method).bind(connection, **params)
+        except TypeError as e:
+            return Response(request, error="Bad parameters for '%s': %s" % (request["method"], e))
+        try:
+            return Response(request, result=method(connection, **params))
+        except Exception as e:
+            return Response(request, error=str(e))
+
+    def Registries(self):
+        return self.registrySource()
+
+    # [program] is a program name, or "Project/Program" when several projects are open.
+    def FindCompiled(self, program: str) -> CompiledProgram:
+        found = FindProgramIn(self.Registries(), program)
+        if found is None:
+            raise Exception("Could not find a program named '%s'." % program)
+        registry, p = found
+        return registry.Get(p)
+
+    def FindChip(self, compiled: CompiledProgram) -> Chip:
+        return next(r.chip for r in self.Registries() if compiled in r.compiledPrograms)
+
+    # The methods below run on the program thread.
+
+    def ApiPrograms(self, connection):
+        return [{"name": x.program.name,
+                 "project": registry.name,
+                 "functions": list(x.showableFunctions),
+                 "parameters": {s: EncodeValue(x.program.parameterValues.get(s)) for s in
+                                x.parameters},
+                 "running": list(x.asyncFunctions)}
+                for registry in self.Registries() for x in registry.compiledPrograms]
+
+    def ApiCallFunction(self, connection, program: str, function: str, args: List = None):
+        compiled = self.FindCompiled(program)
+        if function not in compiled.programFunctions:
+            raise Exception("Could not find function '%s' in program '%s'." % (function, program))
+        try:
+            inspect.signature(compiled.programFunctions[function].function).bind(*(args or []))
+        except TypeError as e:
+            raise Exception("Bad arguments for '%s': %s" % (function, e))
+        try:
+            return EncodeValue(CallFunction(compiled, function, *(args or []), raiseErrors=True))
+        except Exception as e:
+            raise Exception("Function '%s' raised an error: %s: %s" % (function, type(e).__name__,
+                                                                      e))
+
+    def ApiStopFunction(self, connection, program: str, function: str):
+        StopFunction(self.FindCompiled(program), function)
+
+    def ApiSetFunctionPaused(self, connection, program: str, function: str, paused: bool):
+        SetFunctionPaused(self.FindCompiled(program), function, bool(paused))
+
+    def ApiRunningFunctions(self, connection, program: str = None):
+        compiledPrograms = [self.FindCompiled(program)] if program is not None else \
+            [x for r in self.Registries() for x in r.compiledPrograms]
+        return [{"program": x.program.name, "project": x.registry.name, "function": s,
+                 "paused": IsFunctionPaused(x, s)}
+                for x in compiledPrograms for s in x.asyncFunctions]
+
+    def ApiGetParameter(self, connection, program: str, parameter: str):
+        compiled = self.FindCompiled(program)
+        if parameter not in compiled.parameters:
+            raise Exception("Program '%s' has no parameter '%s'." % (program, parameter))
+        return EncodeValue(compiled.program.parameterValues.get(parameter))
+
+    def ApiSetParameter(self, connection, program: str, parameter: str, value):
+        compiled = self.FindCompiled(program)
+        if parameter not in compiled.parameters:
+            raise Exception("Program '%s' has no parameter '%s'." % (program, parameter))
+        p = compiled.parameters[parameter]
+        value = DecodeValue(value, p.parameterType, self.FindChip(compiled))
+        if p.minimum is not None and value < p.minimum or \
+                p.maximum is not None and value > p.maximum:
+            raise Exception("%s is outside the range of parameter '%s'." % (value, parameter))
+        p.Set(value)
+
+    def ApiSignal(self, connection, name: str):
+        return sum(registry.Signal(name) for registry in self.Registries())
+
+    def ApiGetValveStates(self, connection, valves: List[str] = None):
+        return self.ValveStates(valves)
+
+    def ApiSubscribe(self, connection, valves: List[str] = None, interval: float = 0.05):
+        self.ValveStates(valves)  # Fails early on unknown valve names.
+        connection.Subscribe(valves, max(0.01, float(interval)))
+        return None
+
+    def ApiUnsubscribe(self, connection):
+        connection.Subscribe(None, None)
+
+    def ApiTickStats(self, connection, reset: bool = False):
+        snapshot = self.scheduler.stats.Snapshot()
+        if reset:
+            self.scheduler.stats.Reset()
+        return snapshot
+
+    # Turns the line profiler of a program on or off and returns its results so far.
+    def ApiProfile(self, connection, program: str, enabled: bool = None, reset: bool = False):
+        compiled = self.FindCompiled(program)
+        if enabled is not None:
+            SetProfiling(compiled, bool(enabled))
+        profiler = compiled.profileResults
+        if profiler is None:
+            return None
+        snapshot = profiler.Snapshot()
+        if reset:
+            profiler.Reset()
+        return snapshot
+
+    # The valves claimed by running functions and the most recent rejected writes and claims.
+    def ApiValveClaims(self, connection):
+        leases = self.scheduler.rig.leases
+        return {"claims": leases.Summary(),
+                "conflicts": [{"time": t, "writer": writer, "owner": owner, "solenoid": number}
+                              for t, writer, owner, number in list(leases.conflicts)]}
+
+    def ValveStates(self, names: Optional[List[str]]) -> Dict[str, bool]:
+        # Valves by name, with their rig solenoid numbers. The first open project wins if several
+        # have a valve of the same name.
+        allValves = {}
+        for r in self.Registries():
+            for v, number in zip(r.chip.valves, r.RigNumbers(r.chip.valves)):
+                allValves.setdefault(v.name, number)
+        if names is not None:
+            missing = [n for n in names if n not in allValves]
+            if len(missing) > 0:
+                raise Exception("Could not find a valve named '%s'." % missing[0])
+            allValves = {n: allValves[n] for n in names}
+        return {name: self.scheduler.rig.GetSolenoidState(number) for name, number in
+                allValves.items()}
+
+
+# A single client connection. Requests are read on one thread and executed on another, so that
+# requests that arrive while a batch is running are collected into the next batch.
+class Connection:
+    def __init__(self, server: ControlServer, rfile, wfile):
+        self.server = server
+        self.rfile = rfile
+        self.wfile = wfile
+        self.writeLock = threading.Lock()
+        self.lines = queue.SimpleQueue()
+        self.subscription: Optional[Tuple[Optional[List[str]], float]] = None
+        self.subscriptionChanged = threading.Event()
+        self.closed = False
+
+    def Run(self):
+        executor = threading.Thread(target=self.ExecuteLoop, daemon=True)
+        executor.start()
+        publisher = threading.Thread(target=self.PublishLoop, daemon=True)
+        publisher.start()
+        try:
+            for line in self.rfile:
+                if line.strip():
+                    self.lines.put(line)
+        except (ConnectionError, OSError):
+            pass
+        self.closed = True
+        self.lines.put(None)
+        self.subscriptionChanged.set()
+        executor.join()
+        publisher.join()
+
+    def ExecuteLoop(self):
+        while True:
+            lines = [self.lines.get()]
+            while not self.lines.empty():
+                lines.append(self.lines.get())
+            # Decode every line, remembering which requests were sent as an array.
+            entries: List[Tuple[bool, List, Optional[str]]] = []
+            for line in lines:
+                if line is None:
+                    break
+                try:
+                    decoded = json.loads(line)
+                except ValueError as e:
+                    entries.append((False, [], "Invalid JSON: %s" % e))
+                    continue
+                isArray = isinstance(decoded, list)
+                entries.append((isArray, decoded if isArray else [decoded], None))
+            requests = [r for _, batch, _ in entries for r in batch]
+            responses = iter(self.server.Execute(requests, self) if len(requests) > 0 else [])
+            for isArray, batch, error in entries:
+                if error is not None:
+                    self.Send({"id": None, "error": error})
+                    continue
+                results = [next(responses) for _ in batch]
+                self.Send(results if isArray else results[0])
+            if lines[-1] is None or self.closed:
+                return
+
+    # Sends valve states whenever they change while subscribed.
+    def PublishLoop(self):
+        lastStates = None
+        while not self.closed:
+            if self.subscription is None:
+                lastStates = None
+                self.subscriptionChanged.wait()
+                self.subscriptionChanged.clear()
+                continue
+            names, interval = self.subscription
+            future = self.server.scheduler.Invoke(lambda: self.server.ValveStates(names))
+            try:
+                states = future.result(ControlServer.TIMEOUT)
+            except Exception:
+                states = None
+            if states is not None and states != lastStates:
+                self.Send({"event": "valves", "states": states})
+                lastStates = states
+            if self.subscriptionChanged.wait(interval):
+                self.subscriptionChanged.clear()
+                lastStates = None
+
+    def Subscribe(self, names: Optional[List[str]], interval: Optional[float]):
+        self.subscription = None if interval is None else (names, interval)
+        self.subscriptionChanged.set()
+
+    def Send(self, message):
+        data = (json.dumps(message) + "\n").encode("utf-8")
+        with self.writeLock:
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except (ConnectionError, OSError, ValueError):
+                self.closed = True
+
+
+if hasattr(socketserver, "ThreadingUnixStreamServer"):
+    class ThreadingUnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+else:
+    ThreadingUnixServer = None
+
+
+class ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def Response(request, result=None, error: Optional[str] = None):
+    response = {"id": request.get("id") if isinstance(request, dict) else None}
+    if error is not None:
+        response["error"] = error
+    else:
+        response["result"] = result
+    return response
+
+
+# Converts a parameter value to JSON. Valves and programs are given by name.
+def EncodeValue(value) -> Any:
+    if isinstance(value, (Valve, Program)):
+        return value.name
+    if isinstance(value, (ucscript.Valve, ucscript.Program)):
+        return value.Name()
+    if isinstance(value, (list, tuple)):
+        return [EncodeValue(v) for v in value]
+    if isinstance(value, ucscript.ProgramFunction):
+        # Calling an asynchronous function returns the function itself.
+        return None
+    if value is None or isinstance(value, (bool, int, float, str, dict)):
+        return value
+    return str(value)
+
+
+# Converts a JSON value to a parameter value of type [t]. Strings are parsed like on the command
+# line, so valves and programs can be given by name.
+def DecodeValue(value, t, chip: Chip):
+    if isinstance(t, ucscript.ListParameterType) and isinstance(value, list):
+        return [DecodeValue(v, t.listType, chip) for v in value]
+    if isinstance(value, str) and t != str:
+        return ParseParameterValue(value, t, chip)
+    if t == float and isinstance(value, int) and not isinstance(value, bool):
+        return float(value)
+    if t in (bool, int, float, str) and type(value) != t:
+        raise Exception("Expected a value of type %s, not %r." % (t.__name__, value))
+    return value
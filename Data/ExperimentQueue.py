@@ -0,0 +1,325 @@
+import concurrent.futures
+import itertools
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Any, Tuple
+
+import ucscript
+import Data.Chip as Chip
+from Data.MessageLog import Message, MessageLog
+from Data.ProgramCompilation import ProgramRegistry, CompiledProgram, CallFunction, \
+    StopFunction, ParseParameterValue
+from Data.ProjectFile import WriteAtomically
+
+# Queue files are written on this thread, so that saving never stalls the program thread.
+_writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="Queue writer")
+
+
+# One run of an experiment queue: a program function and the parameter values to run it with.
+# Parameter values are kept as text, as typed on the command line (see ParseParameterValue).
+class QueuedRun:
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STOPPED = "stopped"
+    # The run was still running when uChip was closed.
+    INTERRUPTED = "interrupted"
+
+    FINISHED_STATES = (DONE, FAILED, STOPPED, INTERRUPTED)
+
+    def __init__(self, runId: int, programName: str, functionSymbol: str,
+                 parameters: Dict[str, str]):
+        self.runId = runId
+        self.programName = programName
+        self.functionSymbol = functionSymbol
+        self.parameters = parameters
+        self.state = QueuedRun.PENDING
+        self.startTime: Optional[float] = None
+        self.endTime: Optional[float] = None
+
+        # The program's messages during the run, as (timestamp, level, text).
+        self.log: List[List] = []
+
+        # The sequence number of the program's message log when the run started.
+        self.logStart = 0
+
+    def Describe(self):
+        return ", ".join("%s=%s" % (k, v) for k, v in self.parameters.items())
+
+    def ToDict(self):
+        return {"id": self.runId, "program": self.programName, "function": self.functionSymbol,
+                "parameters": self.parameters, "state": self.state, "start": self.startTime,
+                "end": self.endTime, "log": self.log}
+
+    @staticmethod
+    def FromDict(d: Dict):
+        run = QueuedRun(d["id"], d["program"], d["function"], d["parameters"])
+        run.state = d["state"]
+        run.startTime = d["start"]
+        run.endTime = d["end"]
+        run.log = d["log"]
+        return run
+
+
+# Runs program functions over a grid of parameter values, one run after another. The scheduler
+# calls Tick every tick; as soon as a run's function has finished, the next run's parameters are
+# set and its function is started and ticked in the same tick. A run fails if its function raises
+# an error. Once no run is left running, the parameters are set back to their values from before
+# the queue started.
+#
+# The queue is saved as JSON (next to the project file) whenever a run is added, starts or
+# finishes, so it survives restarts. Files are written in the background; problems reading or
+# writing them are added to the queue's message log. A queue that is loaded from disk is paused,
+# and a run that was running when uChip closed is marked as interrupted rather than started again.
+class ExperimentQueue:
+    def __init__(self, registry: ProgramRegistry, path: Optional[Path] = None):
+        self.registry = registry
+        self.path = path
+        self.runs: List[QueuedRun] = []
+        self.nextId = 1
+        self.current: Optional[QueuedRun] = None
+        self.currentProgram: Optional[CompiledProgram] = None
+        # The running function of the current run, whose error tells whether the run failed.
+        self.currentFunction: Optional[CompiledProgram.AsyncFunctionInfo] = None
+
+        # The parameter values that runs have replaced, as (value before the queue started, value
+        # set by the latest run), by program and parameter symbol. They are put back once the
+        # queue has no current run, unless they were changed in the meantime.
+        self.replacedParameters: Dict[Tuple[Chip.Program, str], Tuple[Any, Any]] = {}
+
+        # Runs are only started while the queue is running.
+        self.running = False
+
+        # Runs are added from the GUI thread and started from the program thread.
+        self.lock = threading.RLock()
+
+        # Messages about the queue itself, such as errors reading or writing its file.
+        self.messages = MessageLog("Queue", registry.messageCapacity, registry.messageSink)
+        self.messages.clock = registry.clock.Time
+
+        # The latest queue contents that have not been written yet, as (path, data), and the
+        # write that will write them.
+        self.unsaved = None
+        self.pendingWrite: Optional[concurrent.futures.Future] = None
+        self.Load()
+
+    # Adds one run for every combination of the values in [grid], which maps parameter symbols to
+    # lists of values. Returns the new runs.
+    def Submit(self, programName: str, functionSymbol: str,
+               grid: Dict[str, Sequence[Any]]) -> List[QueuedRun]:
+        symbols = list(grid)
+        combinations = list(itertools.product(*[[ValueText(v) for v in grid[s]] for s in symbols]))
+        with self.lock:
+            runs = []
+            for values in combinations:
+                runs.append(QueuedRun(self.nextId, programName, functionSymbol,
+                                      dict(zip(symbols, values))))
+                self.nextId += 1
+            self.runs += runs
+            self.Save()
+        return runs
+
+    def SetRunning(self, running: bool):
+        with self.lock:
+            self.running = running
+
+    def Remove(self, run: QueuedRun):
+        with self.lock:
+            if run is not self.current and run in self.runs:
+                self.runs.remove(run)
+                self.Save()
+
+    # Queues a finished run again, at the end of the queue.
+    def Retry(self, run: QueuedRun):
+        with self.lock:
+            if run.state in QueuedRun.FINISHED_STATES:
+                self.Submit(run.programName, run.functionSymbol,
+                            {k: [v] for k, v in run.parameters.items()})
+
+    def ClearFinished(self):
+        with self.lock:
+            self.runs = [r for r in self.runs if r.state not in QueuedRun.FINISHED_STATES]
+            self.Save()
+
+    # Stops the current run. Must be called on the program thread (e.g. with Scheduler.Invoke).
+    def StopCurrent(self):
+        with self.lock:
+            if self.current is None:
+                return
+            run, compiled = self.current, self.currentProgram
+            if run.functionSymbol in compiled.asyncFunctions:
+                StopFunction(compiled, run.functionSymbol)
+            self.Finish(QueuedRun.STOPPED)
+
+    def Pending(self) -> List[QueuedRun]:
+        with self.lock:
+            return [r for r in self.runs if r.state == QueuedRun.PENDING]
+
+    # Called by the scheduler on the program thread after the running functions have been ticked.
+    def Tick(self, currentTime: float):
+        if self.current is None and not self.running and len(self.replacedParameters) == 0:
+            return
+        with self.lock:
+            if self.current is not None:
+                if self.current.functionSymbol in self.currentProgram.asyncFunctions:
+                    return
+                failed = self.currentFunction is not None and self.currentFunction.error is not None
+                self.Finish(QueuedRun.FAILED if failed else QueuedRun.DONE)
+            if self.running:
+                self.StartNext()
+            if self.current is None:
+                self.RestoreParameters()
+
+    def StartNext(self):
+        for run in self.runs:
+            if run.state != QueuedRun.PENDING:
+                continue
+            self.current = run
+            run.state = QueuedRun.RUNNING
+            run.startTime = self.registry.clock.Time()
+            try:
+                compiled = self.Prepare(run)
+            except Exception as e:
+                run.log = [[run.startTime, "ERROR", str(e)]]
+                self.currentProgram = None
+                self.Finish(QueuedRun.FAILED)
+                continue
+            self.currentProgram = compiled
+            run.logStart = compiled.messages.nextSequence
+            self.Save()
+            try:
+                CallFunction(compiled, run.functionSymbol, raiseErrors=True)
+            except Exception:
+                self.Finish(QueuedRun.FAILED)
+                continue
+            self.currentFunction = compiled.asyncFunctions.get(run.functionSymbol)
+            if run.functionSymbol in compiled.asyncFunctions:
+                # Tick the new function in this tick instead of the next one.
+                compiled.wokenFunctions.append(run.functionSymbol)
+            return
+        self.running = False
+
+    # Finds the run's program and sets its parameters. The values they replace are kept, so that
+    # RestoreParameters can put them back.
+    def Prepare(self, run: QueuedRun) -> CompiledProgram:
+        chip = self.registry.chip
+        program = chip.FindProgram(run.programName)
+        if program is None:
+            raise Exception("Could not find a program named '%s'." % run.programName)
+        compiled = self.registry.Get(program)
+        if run.functionSymbol not in compiled.programFunctions:
+            raise Exception("Could not find function '%s' in program '%s'." %
+                            (run.functionSymbol, run.programName))
+        if run.functionSymbol in compiled.asyncFunctions:
+            raise Exception("Function '%s' is already running." % run.functionSymbol)
+        values = {}
+        for symbol, text in run.parameters.items():
+            if symbol not in compiled.parameters:
+                raise Exception("Program '%s' has no parameter '%s'." % (run.programName, symbol))
+            values[symbol] = ParseParameterValue(text, compiled.parameters[symbol].parameterType,
+                                                 chip)
+        for symbol, value in values.items():
+            key = (program, symbol)
+            before = self.replacedParameters[key][0] if key in self.replacedParameters else \
+                program.parameterValues.get(symbol)
+            self.replacedParameters[key] = (before, value)
+        program.parameterValues.update(values)
+        return compiled
+
+    # Puts back the parameter values that runs replaced, except those that were changed since.
+    def RestoreParameters(self):
+        for (program, symbol), (before, value) in self.replacedParameters.items():
+            if program.parameterValues.get(symbol) is value:
+                program.parameterValues[symbol] = before
+        self.replacedParameters = {}
+
+    def Finish(self, state: str):
+        run = self.current
+        run.state = state
+        run.endTime = self.registry.clock.Time()
+        if self.currentProgram is not None:
+            run.log = [[m.timestamp, m.LevelName(), m.text] for m in
+                       self.currentProgram.messages.Since(run.logStart)]
+        self.current = None
+        self.currentProgram = None
+        self.currentFunction = None
+        self.Save()
+
+    def SetPath(self, path: Optional[Path]):
+        with self.lock:
+            self.path = path
+            self.Save()
+
+    # Saves the queue in the background. Only the latest contents are written if the queue
+    # changes again before the file has been written.
+    def Save(self):
+        if self.path is None:
+            return
+        data = {"version": 1, "nextId": self.nextId, "runs": [r.ToDict() for r in self.runs]}
+        with self.lock:
+            writing = self.unsaved is not None
+            self.unsaved = (self.path, data)
+            if not writing:
+                self.pendingWrite = _writer.submit(self.Write)
+
+    # Writes the queue with WriteAtomically, so that a crash never leaves a half-written queue
+    # behind. Runs on the writer thread.
+    def Write(self):
+        with self.lock:
+            path, data = self.unsaved
+            self.unsaved = None
+        try:
+            WriteAtomically(path, json.dumps(data, indent=1))
+        except OSError as e:
+            self.messages.Add("Could not save the experiment queue '%s': %s" % (path, e),
+                              Message.ERROR_RT)
+
+    # Blocks until the queue has been written.
+    def Flush(self):
+        with self.lock:
+            pendingWrite = self.pendingWrite
+        if pendingWrite is not None:
+            pendingWrite.result()
+
+    def Load(self):
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            self.nextId = data["nextId"]
+            self.runs = [QueuedRun.FromDict(d) for d in data["runs"]]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            # Keep the unreadable file for inspection and start with an empty queue.
+            badPath = self.path.with_name(self.path.name + ".bad")
+            self.messages.Add("Could not read the experiment queue '%s' (kept as '%s'): %s" %
+                              (self.path, badPath.name, e), Message.ERROR_RT)
+            self.nextId = 1
+            self.runs = []
+            try:
+                os.replace(self.path, badPath)
+            except OSError:
+                pass
+            return
+        for run in self.runs:
+            if run.state == QueuedRun.RUNNING:
+                run.state = QueuedRun.INTERRUPTED
+
+
+# The queue file of a project, e.g. Screen.queue.json for Screen.ucp.
+def QueuePath(projectPath: Optional[Path]) -> Optional[Path]:
+    return None if projectPath is None else projectPath.with_suffix(".queue.json")
+
+
+# The text of a parameter value, which ParseParameterValue reads back.
+def ValueText(value) -> str:
+    if isinstance(value, (Chip.Valve, Chip.Program)):
+        return value.name
+    if isinstance(value, (ucscript.Valve, ucscript.Program)):
+        return value.Name()
+    if isinstance(value, (list, tuple)):
+        return ", ".join(ValueText(v) for v in value)
+    return str(value)
@@ -1,14 +1,25 @@
 #------------------- macOS Platform ------------------------
-import dill
 from pathlib import PosixPath
 
+# dill is imported on first use rather than at startup, since importing it is slow.
+_unpicklerClass = None
+
+
+def CrossPlatformUnpickler(file):
+    global _unpicklerClass
+    if _unpicklerClass is None:
+        import dill
+
+        class Unpickler(dill.Unpickler):
+            def find_class(self, module, name):
+                # Redirect WindowsPath to PosixPath on macOS/Linux
+                if module == 'pathlib' and name == 'WindowsPath':
+                    return PosixPath
+                return super().find_class(module, name)
+
+        _unpicklerClass = Unpickler
+    return _unpicklerClass(file)
 
-class CrossPlatformUnpickler(dill.Unpickler):
-    def find_class(self, module, name):
-        # Redirect WindowsPath to PosixPath on macOS/Linux
-        if module == 'pathlib' and name == 'WindowsPath':
-            return PosixPath
-        return super().find_class(module, name)
 
 def LoadObject(file_path):
     """Load a dill/pickle object from file, fixing WindowsPath on non-Windows systems."""
@@ -18,6 +29,7 @@ def LoadObject(file_path):
 
 def SaveObject(obj, file_path):
     """Save a dill/pickle object to file."""
+    import dill
     with open(file_path, 'wb') as file:
         dill.dump(obj, file)
 
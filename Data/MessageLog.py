@@ -0,0 +1,137 @@
+import collections
+import gzip
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Optional, List, Callable, Deque
+
+
+class Message:
+    MESSAGE = 0
+    ERROR_RT = 1
+    ERROR_CT = 2
+
+    def __init__(self, text, messageType: int, timestamp: Optional[float] = None):
+        self.text = text
+        self.messageType = messageType
+        self.timestamp = time.time() if timestamp is None else timestamp
+
+        # Assigned by the MessageLog when the message is added.
+        self.sequence = -1
+
+    def LevelName(self):
+        return {Message.MESSAGE: "INFO",
+                Message.ERROR_RT: "ERROR",
+                Message.ERROR_CT: "COMPILE ERROR"}.get(self.messageType, "INFO")
+
+
+# A bounded log of program messages. Once the capacity is reached the oldest messages are dropped.
+# Every message gets an increasing sequence number, so readers (e.g. the UI) can fetch only the
+# messages that are new since their last read instead of copying the whole log.
+class MessageLog:
+    DEFAULT_CAPACITY = 1000
+
+    def __init__(self, name: str = "", capacity: int = DEFAULT_CAPACITY,
+                 sink: Optional['MessageFileSink'] = None):
+        self.name = name
+        self.entries: Deque[Message] = collections.deque(maxlen=capacity)
+        self.nextSequence = 0
+
+        # Incremented whenever messages are removed other than by overflowing the capacity, so
+        # that readers know to start over.
+        self.resetCount = 0
+
+        # Optional on-disk sink that receives every message.
+        self.sink = sink
+
+        # Returns the time used to timestamp new messages.
+        self.clock: Callable[[], float] = time.time
+        self.lock = threading.Lock()
+
+    def Add(self, text: str, messageType: int = Message.MESSAGE):
+        self.Append(Message(text, messageType, self.clock()))
+
+    def Append(self, message: Message):
+        with self.lock:
+            message.sequence = self.nextSequence
+            self.nextSequence += 1
+            self.entries.append(message)
+        if self.sink is not None:
+            self.sink.Write(self.name, message)
+
+    # Returns the messages with a sequence number of at least [sequence].
+    def Since(self, sequence: int) -> List[Message]:
+        with self.lock:
+            if len(self.entries) == 0 or sequence >= self.nextSequence:
+                return []
+            start = max(0, sequence - self.entries[0].sequence)
+            return [self.entries[i] for i in range(start, len(self.entries))]
+
+    # Removes all messages for which [predicate] returns True.
+    def RemoveWhere(self, predicate: Callable[[Message], bool]):
+        with self.lock:
+            kept = [m for m in self.entries if not predicate(m)]
+            if len(kept) == len(self.entries):
+                return
+            self.entries.clear()
+            self.entries.extend(kept)
+            self.resetCount += 1
+
+    def SetCapacity(self, capacity: int):
+        with self.lock:
+            self.entries = collections.deque(self.entries, maxlen=capacity)
+
+    def OldestSequence(self):
+        with self.lock:
+            return self.entries[0].sequence if len(self.entries) > 0 else self.nextSequence
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.entries))
+
+
+# Streams messages from all programs to rotating log files. Writing happens on a background thread
+# so that logging never blocks the program thread on disk I/O. Rotated files are gzip-compressed.
+class MessageFileSink:
+    def __init__(self, directory: Path, fileName="uChip.log", maxBytes=5 * 1024 * 1024,
+                 backupCount=10):
+        directory.mkdir(parents=True, exist_ok=True)
+        self.path = directory / fileName
+        handler = logging.handlers.RotatingFileHandler(self.path, maxBytes=maxBytes,
+                                                       backupCount=backupCount, encoding="utf-8")
+        handler.namer = lambda name: name + ".gz"
+        handler.rotator = CompressRotatedLog
+        handler.setFormatter(logging.Formatter("%(asctime)s\t%(levelname)s\t%(program)s\t%(message)s"))
+        self.queue = queue.SimpleQueue()
+        self.listener = logging.handlers.QueueListener(self.queue, handler)
+        self.listener.start()
+
+    def Write(self, programName: str, message: Message):
+        level = logging.INFO if message.messageType == Message.MESSAGE else logging.ERROR
+        record = logging.LogRecord("uChip", level, "", 0, message.text, None, None)
+        record.created = message.timestamp
+        record.msecs = (message.timestamp % 1) * 1000
+        record.program = programName
+        if message.messageType == Message.ERROR_CT:
+            record.levelname = "COMPILE"
+        self.queue.put_nowait(record)
+
+    # Stops the background writer after writing all queued messages.
+    def Close(self):
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
+
+
+def CompressRotatedLog(source: str, destination: str):
+    with open(source, "rb") as sourceFile, gzip.open(destination, "wb") as destinationFile:
+        shutil.copyfileobj(sourceFile, destinationFile)
+    os.remove(source)
@@ -0,0 +1,289 @@
+import http.server
+import os
+import threading
+from pathlib import Path
+from typing import Callable, List, Dict, Tuple
+
+from Data.MessageLog import Message
+from Data.ProgramCompilation import ProgramRegistry
+from Data.Scheduler import Scheduler
+from Data.TickStats import DurationHistogram
+
+# Exports the health of a running uChip for monitoring systems such as Prometheus, in the
+# OpenMetrics text format (or the older Prometheus text format, which e.g. node_exporter's
+# textfile collector reads):
+#
+#   uchip_tick_period_seconds                histogram  time between the starts of ticks
+#   uchip_tick_jitter_seconds                histogram  change of the tick period between ticks
+#   uchip_flush_duration_seconds             histogram  FlushStates; its _count gives flushes/s
+#   uchip_function_tick_seconds              histogram  ticks of each program function
+#   uchip_function_lateness_seconds          histogram  how late WaitForSeconds resumed
+#   uchip_device_writes_total                counter    serial writes per solenoid board
+#   uchip_device_written_bytes_total         counter
+#   uchip_device_write_errors_total          counter
+#   uchip_device_connects_total              counter    (re)connections of each board
+#   uchip_device_connected                   gauge
+#   uchip_remote_pushes_total                counter    state pushes to each agent
+#   uchip_remote_sent_bytes_total            counter
+#   uchip_remote_errors_total                counter    lost connections to each agent
+#   uchip_remote_connects_total              counter
+#   uchip_remote_connected                   gauge
+#   uchip_remote_apply_latency_seconds       gauge      last push until the agent applied it
+#   uchip_running_functions                  gauge      per program
+#   uchip_compile_duration_seconds           histogram  per project
+#   uchip_program_compile_seconds            gauge      last compilation of each program
+#   uchip_log_messages                       gauge      messages in each program's log by level
+#   uchip_log_messages_added_total           counter
+#
+# Counters restart from zero when uChip restarts or the tick statistics are reset, which rate()
+# handles. Nothing is measured for the export: it only reads counters that are kept anyway.
+
+DEFAULT_PORT = 8767
+
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# Builds the text of one scrape. Samples must be added family by family.
+class MetricsText:
+    def __init__(self, openMetrics: bool):
+        self.openMetrics = openMetrics
+        self.lines: List[str] = []
+
+    def Family(self, name: str, metricType: str, helpText: str):
+        # The Prometheus format names counters by their sample name.
+        typeName = name + "_total" if metricType == "counter" and not self.openMetrics else name
+        self.lines.append("# TYPE %s %s" % (typeName, metricType))
+        self.lines.append("# HELP %s %s" % (typeName, helpText))
+
+    def Sample(self, name: str, labels: Dict[str, str], value: float):
+        self.lines.append(name + FormatLabels(labels) + " " + FormatValue(value))
+
+    def Histogram(self, name: str, labels: Dict[str, str], histogram: DurationHistogram):
+        # Copied first, so that the buckets add up to the count even while the histogram is being
+        # written by the program thread.
+        counts = list(histogram.counts)
+        total = histogram.total
+        cumulative = 0
+        for bound, count in zip(DurationHistogram.BOUNDS, counts):
+            cumulative += count
+            self.Sample(name + "_bucket", dict(labels, le=repr(float(bound))), cumulative)
+        cumulative += counts[-1]
+        self.Sample(name + "_bucket", dict(labels, le="+Inf"), cumulative)
+        self.Sample(name + "_count", labels, cumulative)
+        self.Sample(name + "_sum", labels, total)
+
+    def Text(self) -> str:
+        return "\n".join(self.lines + (["# EOF"] if self.openMetrics else [])) + "\n"
+
+
+def FormatLabels(labels: Dict[str, str]) -> str:
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"')
+                                        .replace("\n", "\\n"))
+                          for key, value in labels.items()) + "}"
+
+
+def FormatValue(value: float) -> str:
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+# The metrics of a scheduler, its rig and the given projects as OpenMetrics (or Prometheus) text.
+# Safe to call from any thread.
+def RenderMetrics(scheduler: Scheduler, registries: List[ProgramRegistry],
+                  openMetrics: bool = True) -> str:
+    text = MetricsText(openMetrics)
+    stats = scheduler.stats
+    with stats.lock:
+        period, jitter, flush = stats.period, stats.jitter, stats.flush
+        functions = sorted(stats.functions.items())
+
+    text.Family("uchip_tick_period_seconds", "histogram",
+                "Time between the starts of consecutive program ticks.")
+    text.Histogram("uchip_tick_period_seconds", {}, period)
+    text.Family("uchip_tick_jitter_seconds", "histogram",
+                "How much the tick period changed from one tick to the next.")
+    text.Histogram("uchip_tick_jitter_seconds", {}, jitter)
+    text.Family("uchip_flush_duration_seconds", "histogram",
+                "Time taken to write the solenoid states to the rig, once per tick.")
+    text.Histogram("uchip_flush_duration_seconds", {}, flush)
+    text.Family("uchip_function_tick_seconds", "histogram",
+                "Time taken by each tick of a running program function.")
+    for (projectName, programName, functionSymbol), functionStats in functions:
+        text.Histogram("uchip_function_tick_seconds",
+                       {"project": projectName, "program": programName,
+                        "function": functionSymbol},
+                       functionStats.duration)
+    text.Family("uchip_function_lateness_seconds", "histogram",
+                "How long after its WaitForSeconds deadline a function was resumed.")
+    for (projectName, programName, functionSymbol), functionStats in functions:
+        text.Histogram("uchip_function_lateness_seconds",
+                       {"project": projectName, "program": programName,
+                        "function": functionSymbol},
+                       functionStats.lateness)
+
+    RenderRig(text, scheduler)
+    RenderPrograms(text, registries)
+    return text.Text()
+
+
+def RenderRig(text: MetricsText, scheduler: Scheduler):
+    rig = scheduler.rig
+    devices = [d for d in list(rig.allDevices) if d.enabled or d.writes > 0]
+    deviceLabels = [(d, {"port": d.portInfo.device if d.portInfo is not None else "",
+                         "first": str(d.startNumber)}) for d in devices]
+    for name, attribute, helpText in [
+            ("uchip_device_writes", "writes", "Writes to a solenoid board."),
+            ("uchip_device_written_bytes", "bytesWritten", "Bytes written to a solenoid board."),
+            ("uchip_device_write_errors", "writeErrors", "Writes to a solenoid board that failed."),
+            ("uchip_device_connects", "connects",
+             "How often a solenoid board was connected, including reconnections.")]:
+        text.Family(name, "counter", helpText)
+        for device, labels in deviceLabels:
+            text.Sample(name + "_total", labels, getattr(device, attribute))
+    text.Family("uchip_device_connected", "gauge", "1 if a solenoid board is connected.")
+    for device, labels in deviceLabels:
+        text.Sample("uchip_device_connected", labels, device.IsConnected())
+
+    remotes = [(r, {"agent": "%s:%d" % (r.host, r.port), "first": str(r.startNumber)})
+               for r in list(rig.remoteRigs)]
+    for name, attribute, helpText in [
+            ("uchip_remote_pushes", "pushes", "State changes sent to an agent."),
+            ("uchip_remote_sent_bytes", "bytesSent", "Bytes sent to an agent."),
+            ("uchip_remote_errors", "errors", "Connections to an agent that were lost."),
+            ("uchip_remote_connects", "connects",
+             "How often an agent was connected, including reconnections.")]:
+        text.Family(name, "counter", helpText)
+        for remote, labels in remotes:
+            text.Sample(name + "_total", labels, getattr(remote, attribute))
+    text.Family("uchip_remote_connected", "gauge", "1 if an agent is connected.")
+    for remote, labels in remotes:
+        text.Sample("uchip_remote_connected", labels, remote.IsConnected())
+    text.Family("uchip_remote_apply_latency_seconds", "gauge",
+                "Time from sending the last acknowledged push until the agent applied it.")
+    for remote, labels in remotes:
+        if remote.lastApplyLatency is not None:
+            text.Sample("uchip_remote_apply_latency_seconds", labels, remote.lastApplyLatency)
+
+
+def RenderPrograms(text: MetricsText, registries: List[ProgramRegistry]):
+    programs = [(registry, compiled, {"project": registry.name or "",
+                                      "program": compiled.program.name})
+                for registry in list(registries) for compiled in list(registry.compiledPrograms)]
+    text.Family("uchip_running_functions", "gauge", "Functions of a program that are running.")
+    for registry, compiled, labels in programs:
+        text.Sample("uchip_running_functions", labels, len(compiled.asyncFunctions))
+    text.Family("uchip_compile_duration_seconds", "histogram",
+                "Time taken to compile the programs of a project.")
+    for registry in list(registries):
+        text.Histogram("uchip_compile_duration_seconds", {"project": registry.name or ""},
+                       registry.compileTimes)
+    text.Family("uchip_program_compile_seconds", "gauge",
+                "Time taken by the last compilation of a program.")
+    for registry, compiled, labels in programs:
+        text.Sample("uchip_program_compile_seconds", labels, compiled.compileSeconds)
+
+    text.Family("uchip_log_messages", "gauge", "Messages in the log of a program, by level.")
+    for registry, compiled, labels in programs:
+        levels = {Message.MESSAGE: 0, Message.ERROR_RT: 0, Message.ERROR_CT: 0}
+        for message in compiled.messages:
+            levels[message.messageType] = levels.get(message.messageType, 0) + 1
+        for messageType, count in levels.items():
+            text.Sample("uchip_log_messages",
+                        dict(labels, level=Message("", messageType).LevelName()), count)
+    text.Family("uchip_log_messages_added", "counter",
+                "Messages added to the log of a program, including those dropped since.")
+    for registry, compiled, labels in programs:
+        text.Sample("uchip_log_messages_added_total", labels, compiled.messages.nextSequence)
+
+
+# Serves the metrics over HTTP at /metrics, e.g. for a Prometheus scrape job.
+class MetricsServer:
+    def __init__(self, scheduler: Scheduler, registrySource: Callable[[], List[ProgramRegistry]],
+                 address: Tuple[str, int] = ("127.0.0.1", DEFAULT_PORT)):
+        self.scheduler = scheduler
+        self.registrySource = registrySource
+        self.address = address
+        self.server = http.server.ThreadingHTTPServer(address, self.BuildHandler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def Close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def Describe(self):
+        return "http://%s:%d/metrics" % self.server.server_address[:2]
+
+    def BuildHandler(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                # Scrapers that understand OpenMetrics ask for it; everything else gets the
+                # Prometheus text format.
+                openMetrics = "application/openmetrics-text" in self.headers.get("Accept", "")
+                body = RenderMetrics(server.scheduler, server.registrySource(),
+                                     openMetrics).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", OPENMETRICS_CONTENT_TYPE if openMetrics else
+                                 PROMETHEUS_CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+# Writes the metrics to a file every [interval] seconds, e.g. for node_exporter's textfile
+# collector. The file is replaced in one step, so readers never see a partly written file.
+class MetricsFileWriter:
+    def __init__(self, scheduler: Scheduler, registrySource: Callable[[], List[ProgramRegistry]],
+                 path: Path, interval: float = 15.0, openMetrics: bool = False):
+        self.scheduler = scheduler
+        self.registrySource = registrySource
+        self.path = Path(path)
+        self.interval = interval
+        self.openMetrics = openMetrics
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.Loop, daemon=True)
+        self.thread.start()
+
+    def Loop(self):
+        while True:
+            try:
+                self.Write()
+            except OSError as e:
+                print("Could not write metrics to %s: %s" % (self.path, e))
+            if self.stopped.wait(self.interval):
+                return
+
+    def Write(self):
+        temporaryPath = self.path.with_name(self.path.name + ".tmp")
+        temporaryPath.write_text(RenderMetrics(self.scheduler, self.registrySource(),
+                                               self.openMetrics), encoding="utf-8")
+        os.replace(temporaryPath, self.path)
+
+    # Stops writing, after writing the final values.
+    def Close(self):
+        self.stopped.set()
+        self.thread.join()
+        try:
+            self.Write()
+        except OSError:
+            pass
+
+    def Describe(self):
+        return str(self.path.absolute())
@@ -1,13 +1,22 @@
+import ast
 import enum
+import fnmatch
+import operator
 import pathlib
+import re
 import time
 import types
 import traceback
 
 import ucscript
-from typing import Optional, List, Dict, Any, Union
+from typing import Optional, List, Dict, Any, Union, Set, Tuple, Callable
 import Data.Chip as Chip
 from Data.Rig import Rig
+from Data.MessageLog import Message, MessageLog, MessageFileSink
+from Data.Clock import RealClock
+from Data.Sequencer import CompilePattern, Playback, GetSequencer
+from Data.ScriptProfiler import ScriptProfiler
+from Data.TickStats import DurationHistogram
 import inspect
 
 
@@ -20,10 +29,11 @@ class CompiledProgram:
         self.program = program
 
         # The path to the script file used for compilation and the time of last modification. This
-        # is used to automatically recompile when out-of-date.
+        # is used to automatically recompile when out-of-date. For built-in scripts, the key of the
+        # script that was compiled is kept instead (see Script.Key).
         self.compiledPath: Optional[pathlib.Path] = None
         self.lastModTime: Optional[float] = None
-        self.lastBuiltin: Optional[Chip.Script] = None
+        self.lastBuiltin: Optional[Tuple[str, str]] = None
 
         # The description from the compiled program.
         self.description = ""
@@ -35,19 +45,67 @@ class CompiledProgram:
         # Zero argument functions are important because they can be run through GUI buttons.
         self.showableFunctions: List[str] = []
 
-        # Message queue and any fatal error message.
-        self.messages: List[Message] = []
+        # Bounded message log and any fatal error message.
+        self.messages = MessageLog(program.name)
 
         # Zero-argument functions can be run by button press. Functions that yield values will
         # be run asynchronously and are stored in this dictionary.
         self.asyncFunctions: Dict[str, CompiledProgram.AsyncFunctionInfo] = {}
 
+        # The script globals are kept across recompiles so that running functions resolve
+        # helpers and parameters to their latest definitions, like importlib.reload does.
+        self.globalsDict: Optional[Dict] = None
+
+        # A fingerprint of each function's code, used to detect which functions changed when
+        # the script is reloaded.
+        self.functionFingerprints: Dict[str, Any] = {}
+
+        # Running functions whose code has changed since they were started. They keep running
+        # the old code until the user restarts them.
+        self.staleFunctions: Set[str] = set()
+
+        # Running functions whose wait has just been satisfied. The scheduler ticks them again
+        # before the end of the current tick.
+        self.wokenFunctions: List[str] = []
+
+        # Blocked functions that the scheduler has to check every tick: those waiting with
+        # WaitUntil or with a timeout.
+        self.waitingFunctions: Dict[str, CompiledProgram.AsyncFunctionInfo] = {}
+
+        # The registry that compiled this program.
+        self.registry: Optional[ProgramRegistry] = None
+
+        # Times the program's script line by line while it is set (see SetProfiling). The results
+        # are kept in profileResults after profiling is turned off.
+        self.profiler: Optional[ScriptProfiler] = None
+        self.profileResults: Optional[ScriptProfiler] = None
+
+        # How many times the program has been compiled and how long the last compilation took.
+        self.compiles = 0
+        self.compileSeconds = 0.0
+
+    # Resets everything that is extracted from the script, leaving running functions and their
+    # messages alone.
+    def ResetCompiledSymbols(self):
+        self.compiledPath = None
+        self.lastModTime = None
+        self.lastBuiltin = None
+        self.description = ""
+        self.parameters = {}
+        self.programFunctions = {}
+        self.showableFunctions = []
+        self.functionFingerprints = {}
+
     # Details of asynchronous functions
     class AsyncFunctionInfo:
-        def __init__(self, iterator: types.GeneratorType):
+        def __init__(self, iterator: types.GeneratorType, programFunction: ucscript.ProgramFunction):
             # The function can be paused/resumed.
             self.paused = False
 
+            # The program function that was called. This is kept so that the function can still be
+            # stopped/paused with its original callbacks after the script is reloaded.
+            self.programFunction = programFunction
+
             # Stores the iterator returned from the function.
             self.iterator = iterator
 
@@ -57,21 +115,40 @@ class CompiledProgram:
             # The time of the last iteration.
             self.lastIterationTime = None
 
+            # The fingerprint of the code that the function was started with.
+            self.fingerprint = None
+
+            # True while the function is waiting for other functions to finish. Blocked functions
+            # are not ticked until they are woken.
+            self.blocked = False
+
+            # The running functions that this function is waiting for, and whether it waits for
+            # all of them or any one.
+            self.waitTargets: List[CompiledProgram.AsyncFunctionInfo] = []
+            self.waitForAll = True
+
+            # When a blocked function gives up waiting (None for no timeout), and the StateVersion
+            # at which its WaitUntil condition was last checked.
+            self.waitDeadline: Optional[float] = None
+            self.waitVersion = None
+
+            # The functions waiting for this function, as (compiled program, symbol, info).
+            self.waiters: List[Tuple[CompiledProgram, str, CompiledProgram.AsyncFunctionInfo]] = []
 
-class Message:
-    MESSAGE = 0
-    ERROR_RT = 1
-    ERROR_CT = 2
+            # The pattern the function is playing with PlayPattern.
+            self.playback: Optional[Playback] = None
 
-    def __init__(self, text, messageType: int):
-        self.text = text
-        self.messageType = messageType
+            # The name of the function in valve claims, e.g. "Pump.RunPump".
+            self.label = ""
+
+            # The error that stopped the function, if any (see FailFunction).
+            self.error: Optional[Exception] = None
 
 
 # Returns 'True' if the compiled program is out-of-date.
 def IsOutOfDate(compiledProgram: CompiledProgram):
     if compiledProgram.program.script.isBuiltIn:
-        return compiledProgram.program.script != compiledProgram.lastBuiltin
+        return compiledProgram.program.script.Key() != compiledProgram.lastBuiltin
     return compiledProgram.lastBuiltin is not None or compiledProgram.compiledPath != compiledProgram.program.script.path or \
         compiledProgram.lastModTime != compiledProgram.program.script.path.stat().st_mtime
 
@@ -100,36 +177,257 @@ def BuildEnvironment():
     return globalsDict
 
 
-# Recompiles a CompiledProgram object (which must have a Chip.Program already attached).
-def Recompile(compiledProgram: CompiledProgram, chip: Chip, rig: Rig,
-              programList: List[CompiledProgram]) -> CompiledProgram:
+# Keeps the compiled programs of a chip project, indexed by their Chip.Program. The registry also
+# hands out ucscript.Program proxies that stay valid when their program is recompiled.
+class ProgramRegistry:
+    def __init__(self, chip: Chip.Chip, rig: Rig):
+        self.chip = chip
+        self.rig = rig
+        self.compiledPrograms: List[CompiledProgram] = []
+        self.programLookup: Dict[Chip.Program, CompiledProgram] = {}
+        self.proxies: Dict[Chip.Program, BoundProgram] = {}
+
+        # The capacity of each program's message log and an optional sink that receives the
+        # messages of all programs.
+        self.messageCapacity = MessageLog.DEFAULT_CAPACITY
+        self.messageSink: Optional[MessageFileSink] = None
+
+        # The clock used to timestamp messages. Replaced by a VirtualClock when simulating.
+        self.clock = RealClock()
+
+        # Functions blocked in WaitForSignal, by signal name, as (compiled program, symbol, info).
+        self.signalWaiters: Dict[str, List[Tuple[CompiledProgram, str,
+                                                 CompiledProgram.AsyncFunctionInfo]]] = {}
+
+        # When several projects share one rig, each is given a name and the rig solenoid that its
+        # solenoid 0 maps to, so that two copies of a chip can run side by side. Set the offset
+        # before compiling.
+        self.name: Optional[str] = None
+        self.solenoidOffset = 0
+
+        # How long compiling the programs took.
+        self.compileTimes = DurationHistogram()
+
+    # Replaces the sink that receives the messages of all programs, including compiled ones.
+    def SetMessageSink(self, sink: Optional[MessageFileSink]):
+        self.messageSink = sink
+        for compiledProgram in self.compiledPrograms:
+            compiledProgram.messages.sink = sink
+
+    # Stops every running function, e.g. before the project is closed: their patterns stop, their
+    # onStop callbacks run and their claims are released. A failing onStop is logged and the
+    # function is removed anyway. Must be called on the program thread.
+    def StopAll(self):
+        for compiledProgram in self.compiledPrograms:
+            for functionSymbol in list(compiledProgram.asyncFunctions):
+                try:
+                    StopFunction(compiledProgram, functionSymbol)
+                except Exception as e:
+                    LogError(compiledProgram, e, False)
+                    if functionSymbol in compiledProgram.asyncFunctions:
+                        RemoveAsyncFunction(compiledProgram, functionSymbol)
+
+    # Changes how many messages each program keeps, including compiled ones.
+    def SetMessageCapacity(self, capacity: int):
+        self.messageCapacity = capacity
+        for compiledProgram in self.compiledPrograms:
+            compiledProgram.messages.SetCapacity(capacity)
+
+    # The rig solenoid numbers of chip valves.
+    def RigNumbers(self, valves: List[Chip.Valve]) -> List[int]:
+        offset = self.solenoidOffset
+        return [v.solenoidNumber + offset for v in valves]
+
+    def Compile(self, program: Chip.Program) -> CompiledProgram:
+        if program not in self.programLookup:
+            self.programLookup[program] = CompiledProgram(program)
+            self.programLookup[program].messages.SetCapacity(self.messageCapacity)
+            self.programLookup[program].messages.sink = self.messageSink
+            self.programLookup[program].messages.clock = self.clock.Time
+            self.compiledPrograms.append(self.programLookup[program])
+        return Recompile(self.programLookup[program], self)
+
+    # Wakes every function waiting for the signal [name] and returns how many were woken.
+    def Signal(self, name: str) -> int:
+        woken = 0
+        for compiledProgram, functionSymbol, functionInfo in self.signalWaiters.pop(name, []):
+            if functionInfo.blocked and \
+                    compiledProgram.asyncFunctions.get(functionSymbol) is functionInfo:
+                WakeFunction(compiledProgram, functionSymbol, functionInfo)
+                woken += 1
+        return woken
+
+    def Remove(self, program: Chip.Program):
+        if program not in self.programLookup:
+            return
+        self.compiledPrograms.remove(self.programLookup[program])
+        del self.programLookup[program]
+        self.proxies.pop(program, None)
+
+    # Returns the compiled program, compiling it first if it is new or out-of-date.
+    def Get(self, program: Chip.Program) -> CompiledProgram:
+        if program not in self.programLookup or IsOutOfDate(self.programLookup[program]):
+            return self.Compile(program)
+        return self.programLookup[program]
+
+    # Returns the ucscript.Program proxy for a chip program.
+    def Proxy(self, program: Chip.Program) -> 'BoundProgram':
+        proxy = self.proxies.get(program)
+        if proxy is None:
+            proxy = self.proxies[program] = BoundProgram(program, self)
+        return proxy
+
+
+# A ucscript.Program bound to a chip program. Functions and parameters are looked up in the
+# registry on access, so the proxy always refers to the latest compilation.
+class BoundProgram(ucscript.Program):
+    def __init__(self, program: Chip.Program, registry: ProgramRegistry):
+        self._program = program
+        self._registry = registry
+
+    def __getattr__(self, symbol):
+        compiledProgram = self._registry.programLookup.get(self._program)
+        if compiledProgram is None:
+            if self._program not in self._registry.chip.programs:
+                raise Exception("Program '%s' has been removed from the chip." % self._program.name)
+            compiledProgram = self._registry.Get(self._program)
+        value = compiledProgram.programFunctions.get(symbol)
+        if value is None:
+            value = compiledProgram.parameters.get(symbol)
+        if value is None:
+            raise AttributeError("Program '%s' has no function or parameter named '%s'." %
+                                 (self._program.name, symbol))
+        return value
+
+    def Name(self) -> str:
+        return self._program.name
+
+    def SetName(self, name: str):
+        self._program.name = name
+
+
+# Put in front of every script before it is compiled.
+SCRIPT_PREFIX = "from ucscript import *\n"
+
+
+# Recompiles a CompiledProgram object (which must have a Chip.Program already attached). This is an
+# incremental reload: functions that are running when the script is reloaded are kept alive. If
+# their code is unchanged they continue seamlessly with the new definitions around them, otherwise
+# they are flagged as stale so that the user can restart them. If the script fails to compile while
+# functions are running, the previous functions, parameters and globals are kept, so that the
+# running functions can still be stopped and do not see a half-run script.
+def Recompile(compiledProgram: CompiledProgram, registry: ProgramRegistry) -> CompiledProgram:
+    compiledProgram.registry = registry
+    startTime = time.perf_counter()
+    previousSymbols = (compiledProgram.description, compiledProgram.parameters,
+                       compiledProgram.programFunctions, compiledProgram.showableFunctions,
+                       compiledProgram.functionFingerprints)
+    previousGlobals = None
     try:
-        compiledProgram.messages = []
         program = compiledProgram.program
+        compiledProgram.messages.RemoveWhere(lambda m: m.messageType == Message.ERROR_CT)
+        compiledProgram.messages.name = program.name
         script = program.script.Read()
-        script = "from ucscript import *\n" + script
+        script = SCRIPT_PREFIX + script
 
-        CompiledProgram.__init__(compiledProgram, program)
+        compiledProgram.ResetCompiledSymbols()
         if program.script.isBuiltIn:
-            compiledProgram.lastBuiltin = program.script
+            compiledProgram.lastBuiltin = program.script.Key()
         else:
             compiledProgram.lastBuiltin = None
             compiledProgram.lastModTime = program.script.path.stat().st_mtime
             compiledProgram.compiledPath = program.script.path.absolute()
 
-        globalsDict = BuildEnvironment()
+        if compiledProgram.globalsDict is None or len(compiledProgram.asyncFunctions) == 0:
+            compiledProgram.globalsDict = BuildEnvironment()
+        else:
+            # The running functions keep using this dictionary, so it is updated in place and
+            # put back as it was if the reload fails.
+            previousGlobals = compiledProgram.globalsDict.copy()
+        globalsDict = compiledProgram.globalsDict
         # Compile the script. The globals dictionary will have everything that resulted from
         # compilation.
-        exec(script, globalsDict)
-        # We can then extract symbols from the dictionary and validate them.
-        ExtractSymbols(globalsDict, compiledProgram)
+        code = compile(script, "<%s>" % program.script.Name(), "exec")
+        exec(code, globalsDict)
+        # We can then extract symbols from the dictionary and validate them. Only symbols that are
+        # defined by the script itself are extracted, so removed symbols left over in the
+        # persistent globals are ignored.
+        definedSymbols = DefinedSymbols(script)
+        ExtractSymbols({s: v for s, v in globalsDict.items() if s in definedSymbols},
+                       compiledProgram)
         MatchParameterValues(compiledProgram)
-        AttachEnvironment(globalsDict, compiledProgram, chip, rig, programList)
+        AttachEnvironment(globalsDict, compiledProgram, registry)
+        compiledProgram.functionFingerprints = {s: FunctionFingerprint(f.function) for s, f in
+                                                compiledProgram.programFunctions.items()}
+        UpdateRunningFunctions(compiledProgram)
     except Exception as e:
         LogError(compiledProgram, e, True)
+        if previousGlobals is not None:
+            compiledProgram.globalsDict.clear()
+            compiledProgram.globalsDict.update(previousGlobals)
+        if len(compiledProgram.asyncFunctions) > 0:
+            (compiledProgram.description, compiledProgram.parameters,
+             compiledProgram.programFunctions, compiledProgram.showableFunctions,
+             compiledProgram.functionFingerprints) = previousSymbols
+    compiledProgram.compileSeconds = time.perf_counter() - startTime
+    compiledProgram.compiles += 1
+    registry.compileTimes.Add(compiledProgram.compileSeconds)
     return compiledProgram
 
 
+# Returns the names that the script binds on its global scope (functions, classes, assignments and
+# imports). Star imports are not included.
+def DefinedSymbols(script: str):
+    symbols = set()
+
+    def AddTargets(target):
+        if isinstance(target, ast.Name):
+            symbols.add(target.id)
+        elif isinstance(target, (ast.Tuple, ast.List)):
+            [AddTargets(t) for t in target.elts]
+
+    for node in ast.parse(script).body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            symbols.add(node.name)
+        elif isinstance(node, ast.Assign):
+            [AddTargets(t) for t in node.targets]
+        elif isinstance(node, (ast.AnnAssign, ast.AugAssign)):
+            AddTargets(node.target)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            symbols.update((a.asname or a.name).split(".")[0] for a in node.names if a.name != "*")
+    return symbols
+
+
+# A comparable summary of a function's code that ignores line numbers, so that edits elsewhere in
+# the script do not mark the function as changed.
+def FunctionFingerprint(function):
+    def CodeFingerprint(code: types.CodeType):
+        return (code.co_code, code.co_names, code.co_varnames, code.co_freevars, code.co_flags,
+                code.co_argcount, code.co_kwonlyargcount,
+                tuple(CodeFingerprint(c) if isinstance(c, types.CodeType) else c for c in
+                      code.co_consts))
+
+    return CodeFingerprint(function.__code__), function.__defaults__
+
+
+# After a reload, running functions whose code differs from the code they were started with are
+# flagged as stale. Running functions that no longer exist in the script are stopped.
+def UpdateRunningFunctions(compiledProgram: CompiledProgram):
+    wasStale = compiledProgram.staleFunctions
+    compiledProgram.staleFunctions = set()
+    for symbol, functionInfo in list(compiledProgram.asyncFunctions.items()):
+        if symbol not in compiledProgram.programFunctions:
+            StopFunction(compiledProgram, symbol)
+            compiledProgram.messages.Add(
+                "Function '%s' was removed from the script and has been stopped." % symbol)
+        elif compiledProgram.functionFingerprints[symbol] != functionInfo.fingerprint:
+            compiledProgram.staleFunctions.add(symbol)
+            if symbol not in wasStale:
+                compiledProgram.messages.Add(
+                    "Function '%s' was modified while running. Restart it to apply the "
+                    "changes." % symbol)
+
+
 # Sort symbols from the compiled global dictionary into the CompiledProgram symbol dictionaries.
 def ExtractSymbols(globalsDict: Dict, compiledProgram: CompiledProgram):
     for symbol in globalsDict:
@@ -176,65 +474,55 @@ def MatchParameterValues(compiledProgram: CompiledProgram):
 # Binds the following elements of the uChip script to the current uChip environment:
 #   - Get() and Set() methods of all Parameter objects
 #   - Asynchronous calling and Stop/Pause methods for all ProgramFunction objects
-#   - FindValve() and FindProgram()
-def AttachEnvironment(globalsDict: Dict, compiledProgram: CompiledProgram, chip: Chip, rig: Rig,
-                      compiledProgramList: List[CompiledProgram]):
+#   - FindValve(), FindValves() and FindProgram()
+def AttachEnvironment(globalsDict: Dict, compiledProgram: CompiledProgram,
+                      registry: ProgramRegistry):
     # When FindValve() or Parameter.Get() is used to get a ucscript.Valve object, it must be bound
-    # to the rig and the underlying Valve object.
-    def BuildUCSValve(valve: Chip.Valve):
-        v = ucscript.Valve()
-        v.IsOpen = lambda: rig.GetSolenoidState(valve.solenoidNumber)
-        v.SetOpen = lambda x: rig.SetSolenoidState(valve.solenoidNumber, bool(x))
-
-        def SetSolenoidNumber(x):
-            valve.solenoidNumber = x
-
-        def SetName(x):
-            valve.name = x
-
-        v.SetSolenoidNumber = SetSolenoidNumber
-        v.SetName = SetName
-        v.Name = lambda: valve.name
-        v.SolenoidNumber = lambda: valve.solenoidNumber
-        return v
-
-    # When FindProgram() or Parameter.Get() is used to get a ucscript.Program object, it must be
-    # bound to the functions and parameters that are bound to the uChip environment.
-    def BuildUCSProgram(program: Chip.Program):
-        p = ucscript.Program()
-        cp = next((x for x in compiledProgramList if x.program == program), None)
-        for fs in cp.programFunctions:
-            p.__dict__[fs] = cp.programFunctions[fs]
-        for ps in cp.parameters:
-            p.__dict__[ps] = cp.parameters[ps]
-        p.Name = lambda: program.name
-
-        def SetName(x):
-            program.name = x
-
-        p.SetName = SetName
-        return p
+    # to the rig and the underlying Valve object. Bound valves are cached.
+    valveHandles = ValveHandleCache(registry.chip, registry.rig, registry.solenoidOffset)
+
+    # Programs are given to the script as proxies that are cached by the registry.
+    def BuildUCSProgram(program: Optional[Chip.Program]):
+        return None if program is None else registry.Proxy(program)
+
+    # Builds a function that converts stored parameter values of a given type into the objects
+    # that the script sees.
+    def BuildPreparer(parameterType):
+        if parameterType == ucscript.Valve:
+            return valveHandles.Handle
+        if parameterType == ucscript.Program:
+            return BuildUCSProgram
+        if isinstance(parameterType, ucscript.ListParameterType):
+            prepareItem = BuildPreparer(parameterType.listType)
+            if prepareItem is None:
+                return list
+            return lambda v: [prepareItem(lv) for lv in v]
+        return None
 
     # Binds a parameter to the uChip environment (Set(value) and Get() methods).
     def BindParameter(symbol: str):
         p = compiledProgram.parameters[symbol]
+        prepare = BuildPreparer(p.parameterType)
+
+        if prepare is None:
+            def GetParameterValue():
+                return compiledProgram.program.parameterValues[symbol]
+        elif not isinstance(p.parameterType, ucscript.ListParameterType):
+            def GetParameterValue():
+                return prepare(compiledProgram.program.parameterValues[symbol])
+        else:
+            # Prepared lists are cached until the stored value or the chip valves change. A copy
+            # is returned so that the script cannot modify the cache.
+            cache = [None, None, None]
 
-        def GetParameterValue():
-            value = compiledProgram.program.parameterValues[symbol]
-
-            def Prepare(v):
-                if isinstance(v, Chip.Valve):
-                    return BuildUCSValve(v)
-                if isinstance(v, Chip.Program):
-                    return BuildUCSProgram(v)
-                if isinstance(v, list):
-                    return [Prepare(lv) for lv in v]
-                return v
-
-            return Prepare(value)
+            def GetParameterValue():
+                value = compiledProgram.program.parameterValues[symbol]
+                if cache[0] is not value or cache[1] != Chip.Valve.generation:
+                    cache[:] = [value, Chip.Valve.generation, prepare(value)]
+                prepared = cache[2]
+                return prepared.copy() if isinstance(prepared, list) else prepared
 
         def SetParameterValue(value: Any):
-            print("Setting %s to %s" % (symbol, str(value)))
             if not DoesValueMatchType(value, p.parameterType):
                 raise Exception("Value did not match type of parameter '%s' (%s)" % (
                     symbol, str(p.parameterType)))
@@ -255,6 +543,7 @@ def AttachEnvironment(globalsDict: Dict, compiledProgram: CompiledProgram, chip:
         programFunction.Resume = lambda: SetFunctionPaused(compiledProgram, symbol, False)
         programFunction.Pause = lambda: SetFunctionPaused(compiledProgram, symbol, True)
         programFunction.IsRunning = lambda: IsFunctionRunning(compiledProgram, symbol)
+        programFunction.runningInfo = lambda: compiledProgram.asyncFunctions.get(symbol)
 
     # Bind parameters to the uChip environment.
     for parameterSymbol, parameter in compiledProgram.parameters.items():
@@ -268,49 +557,308 @@ def AttachEnvironment(globalsDict: Dict, compiledProgram: CompiledProgram, chip:
     for functionSymbol in compiledProgram.programFunctions:
         BindFunction(functionSymbol)
 
-    # Bind the FindValve and FindProgram global methods to the uChip environment.
+    # Bind the FindValve, FindValves and FindProgram global methods to the uChip environment.
     def FindValveInChip(name: str):
-        valve = ExceptionIfNone(next((x for x in chip.valves if x.name == name), None),
-                                "Could not find a valve named '%s'." % name)
-        return BuildUCSValve(valve)
+        return ExceptionIfNone(valveHandles.Find(name), "Could not find a valve named '%s'." % name)
 
     def FindProgramInChip(name: str):
-        program = ExceptionIfNone(next((x for x in chip.programs if x.name == name), None),
+        program = ExceptionIfNone(registry.chip.FindProgram(name),
                                   "Could not find a program named '%s'." % name)
         return BuildUCSProgram(program)
 
     def DoPrint(text: str):
-        compiledProgram.messages.append(Message(text, Message.MESSAGE))
+        compiledProgram.messages.Add(str(text))
+
+    def SendSignal(name: str):
+        registry.Signal(name)
+
+    def FindValvesInChip(*selectors):
+        return BoundValveGroup(selectors, valveHandles)
+
+    def TryClaimValves(*selectors):
+        leases = registry.rig.leases
+        owner = ExceptionIfNone(leases.currentOwner, "Only running functions can claim valves.")
+        numbers = registry.RigNumbers(ResolveValveSelectors(selectors, registry.chip))
+        conflicts = leases.Acquire(owner, owner.label, numbers)
+        leases.RecordConflicts(owner.label, numbers, conflicts)
+        return len(conflicts) == 0
+
+    def ReleaseValves(*selectors):
+        leases = registry.rig.leases
+        if leases.currentOwner is None:
+            return
+        numbers = None if len(selectors) == 0 else \
+            registry.RigNumbers(ResolveValveSelectors(selectors, registry.chip))
+        leases.Release(leases.currentOwner, numbers)
 
     globalsDict['FindValve'] = FindValveInChip
     globalsDict['FindProgram'] = FindProgramInChip
+    globalsDict['FindValves'] = FindValvesInChip
     globalsDict['Log'] = DoPrint
+    globalsDict['Signal'] = SendSignal
+    globalsDict['TryClaim'] = TryClaimValves
+    globalsDict['ReleaseClaim'] = ReleaseValves
+
+
+# A ucscript.Valve that is bound to a chip valve and the rig. The solenoid number is read from the
+# chip valve on every call, so a handle stays valid when the valve is renamed or renumbered.
+# [offset] is the project's solenoid offset on the rig; SolenoidNumber() is the chip's own number.
+class BoundValve(ucscript.Valve):
+    def __init__(self, valve: Chip.Valve, rig: Rig, offset: int = 0):
+        self.valve = valve
+        self.rig = rig
+        self.offset = offset
+
+    def SetOpen(self, state: bool):
+        number = self.valve.solenoidNumber + self.offset
+        leases = self.rig.leases
+        if leases.leasedMask >> number & 1:
+            leases.CheckWrite((number,), (self.valve.name,))
+        self.rig.SetSolenoidState(number, bool(state))
+
+    def Open(self):
+        self.SetOpen(True)
+
+    def Close(self):
+        self.SetOpen(False)
+
+    def IsOpen(self) -> bool:
+        return self.rig.GetSolenoidState(self.valve.solenoidNumber + self.offset)
+
+    def Name(self) -> str:
+        return self.valve.name
+
+    def SetName(self, name: str):
+        self.valve.name = name
+
+    def SolenoidNumber(self) -> int:
+        return self.valve.solenoidNumber
+
+    def SetSolenoidNumber(self, number: int):
+        self.valve.solenoidNumber = number
+
+
+# Caches one BoundValve per chip valve so that FindValve() and Parameter.Get() do not allocate new
+# objects on every call. The cache is dropped whenever a valve is renamed, renumbered, added or
+# removed.
+class ValveHandleCache:
+    def __init__(self, chip: Chip.Chip, rig: Rig, offset: int = 0):
+        self.chip = chip
+        self.rig = rig
+        self.offset = offset
+        self.handles: Dict[Chip.Valve, BoundValve] = {}
+        self.generation = Chip.Valve.generation
+
+    def Handle(self, valve: Optional[Chip.Valve]) -> Optional[BoundValve]:
+        if valve is None:
+            return None
+        if self.generation != Chip.Valve.generation:
+            self.handles.clear()
+            self.generation = Chip.Valve.generation
+        handle = self.handles.get(valve)
+        if handle is None:
+            handle = self.handles[valve] = BoundValve(valve, self.rig, self.offset)
+        return handle
+
+    def Find(self, name: str) -> Optional[BoundValve]:
+        return self.Handle(self.chip.FindValve(name))
+
+
+# A ucscript.ValveGroup that is bound to the chip and the rig. The selectors are resolved to
+# solenoid numbers once, and again only after a valve is added, removed, renamed or renumbered.
+# Setting the group is a single update of the rig's state table, so all of its valves change in
+# the same flush.
+class BoundValveGroup(ucscript.ValveGroup):
+    # How many integer patterns are kept converted to solenoid states.
+    PATTERN_CACHE_SIZE = 64
+
+    def __init__(self, selectors, valveHandles: ValveHandleCache):
+        self.selectors = selectors
+        self.valveHandles = valveHandles
+        self.rig = valveHandles.rig
+        self.generation = None
+        self.Resolve()
+
+    def Resolve(self):
+        if self.generation == Chip.Valve.generation:
+            return
+        self.valves = ResolveValveSelectors(self.selectors, self.valveHandles.chip)
+        offset = self.valveHandles.offset
+        self.numbers = tuple(v.solenoidNumber + offset for v in self.valves)
+        # The solenoids of the group as a bitmask (bit n is solenoid n).
+        self.mask = sum(1 << n for n in set(self.numbers))
+        self.indices = {}
+        for i, v in enumerate(self.valves):
+            self.indices.setdefault(v.name, i)
+        self.patterns: Dict[int, Dict[int, bool]] = {}
+        self.generation = Chip.Valve.generation
+
+    def SetAll(self, state: bool):
+        self.Resolve()
+        self.CheckLeases()
+        self.rig.SetSolenoidStates(dict.fromkeys(self.numbers, bool(state)))
+
+    def SetPattern(self, pattern: Union[Dict, int]):
+        self.Resolve()
+        self.CheckLeases()
+        if isinstance(pattern, dict):
+            self.rig.SetSolenoidStates({self.numbers[self.Index(key)]: bool(state) for
+                                        key, state in pattern.items()})
+            return
+        bits = operator.index(pattern)
+        states = self.patterns.get(bits)
+        if states is None:
+            states = {n: bool((bits >> i) & 1) for i, n in enumerate(self.numbers)}
+            if len(self.patterns) < BoundValveGroup.PATTERN_CACHE_SIZE:
+                self.patterns[bits] = states
+        self.rig.SetSolenoidStates(states)
+
+    # Raises an exception if another function has claimed any valve of the group.
+    def CheckLeases(self):
+        leases = self.rig.leases
+        if leases.leasedMask & self.mask:
+            leases.CheckWrite(self.numbers, [v.name for v in self.valves])
+
+    def Snapshot(self) -> int:
+        self.Resolve()
+        get = self.rig.solenoidStates.get
+        bits = 0
+        for i, n in enumerate(self.numbers):
+            if get(n, False):
+                bits |= 1 << i
+        return bits
+
+    def Names(self) -> List[str]:
+        self.Resolve()
+        return [v.name for v in self.valves]
+
+    def Valves(self) -> List[BoundValve]:
+        self.Resolve()
+        return [self.valveHandles.Handle(v) for v in self.valves]
+
+    def __len__(self):
+        self.Resolve()
+        return len(self.valves)
+
+    # The position in the group of a valve given by index, name or ucscript.Valve.
+    def Index(self, key) -> int:
+        if isinstance(key, ucscript.Valve):
+            key = key.Name()
+        if isinstance(key, str):
+            return ExceptionIfNone(self.indices.get(key),
+                                   "Valve '%s' is not in the valve group." % key)
+        index = operator.index(key)
+        if not -len(self.valves) <= index < len(self.valves):
+            raise Exception("Valve index %d is outside the valve group." % index)
+        return index
+
+
+# Resolves valve names, wildcard patterns, regular expressions, bound valves and valve groups (or
+# lists of these) to the matching chip valves, without duplicates.
+def ResolveValveSelectors(selectors, chip: Chip.Chip) -> List[Chip.Valve]:
+    found: Dict[Chip.Valve, None] = {}
+
+    def Add(selector):
+        if isinstance(selector, (list, tuple, set)):
+            for s in selector:
+                Add(s)
+            return
+        if isinstance(selector, BoundValveGroup):
+            selector.Resolve()
+            matches = selector.valves
+        elif isinstance(selector, BoundValve):
+            matches = [selector.valve]
+        elif isinstance(selector, re.Pattern):
+            matches = [v for v in chip.valves if selector.fullmatch(v.name)]
+        elif isinstance(selector, str):
+            valve = chip.FindValve(selector)
+            if valve is not None:
+                matches = [valve]
+            elif any(c in selector for c in "*?["):
+                matches = [v for v in chip.valves if fnmatch.fnmatchcase(v.name, selector)]
+            else:
+                raise Exception("Could not find a valve named '%s'." % selector)
+        else:
+            raise Exception("Cannot select valves with %r." % (selector,))
+        if len(matches) == 0:
+            raise Exception("No valves match %r." % (selector,))
+        for v in matches:
+            found[v] = None
+
+    Add(list(selectors))
+    return list(found)
 
 
 # Calls a function named [functionSymbol] in [compiledProgram]. This is often called by the GUI when
 # a program button is clicked, but functions can also be called by a UCS program indirectly via
-# FindProgram() or Parameter.Get().
-def CallFunction(compiledProgram: CompiledProgram, functionSymbol: str, *fargs, **fkwargs):
+# FindProgram() or Parameter.Get(). Errors raised by the function are logged, and raised again if
+# [raiseErrors] is set.
+def CallFunction(compiledProgram: CompiledProgram, functionSymbol: str, *fargs,
+                 raiseErrors=False, **fkwargs):
     if functionSymbol in compiledProgram.asyncFunctions:
         # Function is already running!
-        return
+        return compiledProgram.asyncFunctions[functionSymbol].programFunction
     if functionSymbol not in compiledProgram.programFunctions:
         raise Exception("Could not find function '%s' in program '%s'" %
                         (functionSymbol, compiledProgram.program.name))
     function = compiledProgram.programFunctions[functionSymbol].function
     try:
-        returnValue = function(*fargs, **fkwargs)
+        returnValue = RunScript(compiledProgram, function, *fargs, **fkwargs)
     except Exception as e:
         LogError(compiledProgram, e, False)
+        if raiseErrors:
+            raise
         return
     if isinstance(returnValue, types.GeneratorType) and \
             compiledProgram.programFunctions[functionSymbol].canAsync:
-        newRunning = CompiledProgram.AsyncFunctionInfo(returnValue)
+        newRunning = CompiledProgram.AsyncFunctionInfo(returnValue,
+                                                       compiledProgram.programFunctions[functionSymbol])
+        newRunning.fingerprint = compiledProgram.functionFingerprints.get(functionSymbol)
+        newRunning.label = "%s.%s" % (compiledProgram.program.name, functionSymbol)
+        if compiledProgram.registry.name is not None:
+            newRunning.label = compiledProgram.registry.name + ": " + newRunning.label
         compiledProgram.asyncFunctions[functionSymbol] = newRunning
+        if newRunning.programFunction.claims is not None and \
+                not ClaimDeclaredValves(compiledProgram, functionSymbol, newRunning):
+            if raiseErrors:
+                raise newRunning.error
+            return
+        return compiledProgram.programFunctions[functionSymbol]
     else:
         return returnValue
 
 
+# Claims the valves of a function's @claims decorator as it starts. If they are held by another
+# function, the function either waits for them or is not started. Returns False if the function
+# was not started.
+def ClaimDeclaredValves(compiledProgram: CompiledProgram, functionSymbol: str,
+                        functionInfo: CompiledProgram.AsyncFunctionInfo):
+    programFunction = functionInfo.programFunction
+    claim = ucscript.Claim(*programFunction.claims)
+    try:
+        if programFunction.waitForClaims:
+            functionInfo.yieldedValue = claim
+            BeginWait(compiledProgram, functionSymbol, functionInfo,
+                      compiledProgram.registry.clock.Time())
+            return True
+        leases = compiledProgram.registry.rig.leases
+        registry = compiledProgram.registry
+        numbers = registry.RigNumbers(ResolveValveSelectors(claim.selectors, registry.chip))
+        conflicts = leases.Acquire(functionInfo, functionInfo.label, numbers)
+        if len(conflicts) > 0:
+            leases.RecordConflicts(functionInfo.label, numbers, conflicts)
+            raise Exception("Did not start %s: its valves are claimed by %s." %
+                            (functionInfo.label, ", ".join(c.label for c in conflicts)))
+    except Exception as e:
+        LogError(compiledProgram, e, False)
+        functionInfo.error = e
+        del compiledProgram.asyncFunctions[functionSymbol]
+        EndWait(compiledProgram, functionSymbol, functionInfo)
+        functionInfo.iterator.close()
+        return False
+    return True
+
+
 def TickFunction(compiledProgram: CompiledProgram, currentTime: float, functionSymbol: str):
     if functionSymbol not in compiledProgram.asyncFunctions:
         return
@@ -321,38 +869,306 @@ def TickFunction(compiledProgram: CompiledProgram, currentTime: float, functionS
         pass
 
     FinishedIndicator = FinishedIndicator()
-    if functionInfo.paused:
+    if functionInfo.paused or functionInfo.blocked:
         return
     if isinstance(functionInfo.yieldedValue, ucscript.WaitForSeconds):
         if currentTime - functionInfo.lastIterationTime < functionInfo.yieldedValue.seconds:
             return
+    # Valve writes are checked against the claims of the function that is running.
+    leases = compiledProgram.registry.rig.leases
+    previousOwner = leases.currentOwner
+    leases.currentOwner = functionInfo
+    profiler = compiledProgram.profiler
     try:
-        functionInfo.yieldedValue = next(functionInfo.iterator, FinishedIndicator)
-        functionInfo.lastIterationTime = currentTime
-    except Exception as e:
-        LogError(compiledProgram, e, False)
-        StopFunction(compiledProgram, functionSymbol)
+        try:
+            if profiler is None:
+                functionInfo.yieldedValue = next(functionInfo.iterator, FinishedIndicator)
+            else:
+                functionInfo.yieldedValue = profiler.Run(next, functionInfo.iterator,
+                                                         FinishedIndicator)
+            functionInfo.lastIterationTime = currentTime
+        except Exception as e:
+            FailFunction(compiledProgram, functionSymbol, e)
+            return
+        compiledProgram.lastCallTime = currentTime
+        if functionInfo.yieldedValue is FinishedIndicator:
+            RemoveAsyncFunction(compiledProgram, functionSymbol)
+        elif isinstance(functionInfo.yieldedValue, WAIT_TYPES):
+            try:
+                BeginWait(compiledProgram, functionSymbol, functionInfo, currentTime)
+            except Exception as e:
+                FailFunction(compiledProgram, functionSymbol, e)
+    finally:
+        leases.currentOwner = previousOwner
+
+
+# The yieldable values that block a function until something happens.
+WAIT_TYPES = (ucscript.WaitForFunction, ucscript.WaitForSignal, ucscript.WaitUntil,
+              ucscript.PlayPattern, ucscript.Claim)
+
+
+# Blocks a function that yielded WaitForFunction/WaitAll/WaitAny, WaitForSignal, WaitUntil,
+# PlayPattern or Claim. Blocked functions are not ticked until they are woken by WakeFunction. The
+# function stays unblocked (and resumes on the next tick) if the wait is already satisfied.
+def BeginWait(compiledProgram: CompiledProgram, functionSymbol: str,
+              functionInfo: CompiledProgram.AsyncFunctionInfo, currentTime: float):
+    wait = functionInfo.yieldedValue
+    if isinstance(wait, ucscript.WaitForFunction):
+        # The same function can be listed twice, or through two proxies, so WaitAny is satisfied
+        # by a listed function that is not running rather than by counting the targets.
+        targets = []
+        anyFinished = False
+        for function in wait.functions:
+            if not isinstance(function, ucscript.ProgramFunction):
+                raise Exception("%s can only wait for program functions, not %r." %
+                                (type(wait).__name__, function))
+            target = function.runningInfo()
+            if target is None:
+                anyFinished = True
+            elif target not in targets:
+                targets.append(target)
+        isSatisfied = len(targets) == 0 or (not wait.waitForAll and anyFinished)
+        if isSatisfied:
+            functionInfo.yieldedValue = None
+            return
+        functionInfo.waitTargets = targets
+        functionInfo.waitForAll = wait.waitForAll
+        for target in targets:
+            target.waiters.append((compiledProgram, functionSymbol, functionInfo))
+    elif isinstance(wait, ucscript.WaitForSignal):
+        compiledProgram.registry.signalWaiters.setdefault(wait.name, []).append(
+            (compiledProgram, functionSymbol, functionInfo))
+    elif isinstance(wait, ucscript.PlayPattern):
+        registry = compiledProgram.registry
+        valves = ResolveValveSelectors([wait.valves], registry.chip)
+        numbers = registry.RigNumbers(valves)
+        registry.rig.leases.CheckWrite(numbers, [v.name for v in valves])
+        stepSeconds = wait.stepSeconds
+        if callable(stepSeconds):
+            functionInfo.waitVersion = StateVersion(registry.rig)
+            stepSeconds = RunScript(compiledProgram, wait.stepSeconds)
+            if stepSeconds is None:
+                functionInfo.yieldedValue = None
+                return
+        pattern = CompilePattern(numbers, wait.table, stepSeconds)
+        if wait.repeat is not None and wait.repeat <= 0:
+            functionInfo.yieldedValue = None
+            return
+        functionInfo.playback = Playback(pattern, wait.repeat)
+        GetSequencer(registry.rig, registry.clock).Play(functionInfo.playback)
+    elif isinstance(wait, ucscript.Claim):
+        registry = compiledProgram.registry
+        leases = registry.rig.leases
+        wait.numbers = registry.RigNumbers(ResolveValveSelectors(wait.selectors, registry.chip))
+        conflicts = leases.Acquire(functionInfo, functionInfo.label, wait.numbers)
+        if len(conflicts) == 0:
+            functionInfo.yieldedValue = None
+            return
+        leases.RecordConflicts(functionInfo.label, wait.numbers, conflicts)
+        compiledProgram.messages.Add("%s is waiting for valves claimed by %s." %
+                                     (functionInfo.label, ", ".join(c.label for c in conflicts)))
+        functionInfo.waitVersion = leases.version
+    else:
+        version = StateVersion(compiledProgram.registry.rig)
+        if RunScript(compiledProgram, wait.predicate):
+            functionInfo.yieldedValue = None
+            return
+        functionInfo.waitVersion = version
+
+    functionInfo.blocked = True
+    timeout = getattr(wait, "timeout", None)
+    functionInfo.waitDeadline = None if timeout is None else currentTime + timeout
+    if functionInfo.waitDeadline is not None or isinstance(wait, (ucscript.WaitUntil,
+                                                                   ucscript.PlayPattern,
+                                                                   ucscript.Claim)):
+        compiledProgram.waitingFunctions[functionSymbol] = functionInfo
+
+
+# Unblocks a waiting function and queues it to be ticked again in the current tick.
+def WakeFunction(compiledProgram: CompiledProgram, functionSymbol: str,
+                 functionInfo: CompiledProgram.AsyncFunctionInfo, timedOut=False):
+    if isinstance(functionInfo.yieldedValue, (ucscript.WaitForSignal, ucscript.WaitUntil,
+                                              ucscript.Claim)):
+        functionInfo.yieldedValue.timedOut = timedOut
+    EndWait(compiledProgram, functionSymbol, functionInfo)
+    compiledProgram.wokenFunctions.append(functionSymbol)
+
+
+# Removes every trace of a function's wait.
+def EndWait(compiledProgram: CompiledProgram, functionSymbol: str,
+            functionInfo: CompiledProgram.AsyncFunctionInfo):
+    if not functionInfo.blocked:
         return
-    compiledProgram.lastCallTime = currentTime
-    if functionInfo.yieldedValue is FinishedIndicator:
-        del compiledProgram.asyncFunctions[functionSymbol]
+    for target in functionInfo.waitTargets:
+        target.waiters = [w for w in target.waiters if w[2] is not functionInfo]
+    functionInfo.waitTargets = []
+    StopPlayback(compiledProgram, functionInfo)
+    wait = functionInfo.yieldedValue
+    if isinstance(wait, ucscript.WaitForSignal):
+        signalWaiters = compiledProgram.registry.signalWaiters
+        waiters = [w for w in signalWaiters.get(wait.name, []) if w[2] is not functionInfo]
+        if len(waiters) > 0:
+            signalWaiters[wait.name] = waiters
+        else:
+            signalWaiters.pop(wait.name, None)
+    if compiledProgram.waitingFunctions.get(functionSymbol) is functionInfo:
+        del compiledProgram.waitingFunctions[functionSymbol]
+    functionInfo.blocked = False
+    functionInfo.waitDeadline = None
+    functionInfo.yieldedValue = None
+
+
+# Stops the pattern that a function is playing, if any, and reports its timing to the PlayPattern.
+def StopPlayback(compiledProgram: CompiledProgram, functionInfo: CompiledProgram.AsyncFunctionInfo):
+    playback = functionInfo.playback
+    if playback is None:
+        return
+    compiledProgram.registry.rig.sequencer.Stop(playback)
+    functionInfo.playback = None
+    wait = functionInfo.yieldedValue
+    if isinstance(wait, ucscript.PlayPattern):
+        wait.stepsPlayed = playback.stepsPlayed
+        wait.requestedSeconds = playback.requestedSeconds
+        wait.achievedSeconds = playback.AchievedSeconds()
+        wait.meanLateness = playback.lateness.Mean()
+        wait.maxLateness = playback.lateness.maximum
+
+
+# Wakes the functions of [compiledProgram] whose WaitUntil condition has become true, whose pattern
+# has finished playing or whose wait has timed out. Conditions (and PlayPattern step durations that
+# are functions) are only evaluated when [version] (see StateVersion) has changed since they were
+# last evaluated.
+def CheckWaits(compiledProgram: CompiledProgram, currentTime: float, version):
+    for functionSymbol, functionInfo in list(compiledProgram.waitingFunctions.items()):
+        if not functionInfo.blocked:
+            continue
+        wait = functionInfo.yieldedValue
+        playback = functionInfo.playback
+        if playback is not None and playback.finished:
+            if playback.error is not None:
+                FailFunction(compiledProgram, functionSymbol, playback.error)
+            else:
+                WakeFunction(compiledProgram, functionSymbol, functionInfo)
+            continue
+        if isinstance(wait, ucscript.PlayPattern) and callable(wait.stepSeconds) and \
+                functionInfo.waitVersion != version:
+            functionInfo.waitVersion = version
+            try:
+                stepSeconds = RunScript(compiledProgram, wait.stepSeconds)
+                if stepSeconds is not None and stepSeconds != playback.durations[0]:
+                    compiledProgram.registry.rig.sequencer.SetStepSeconds(playback, stepSeconds)
+            except Exception as e:
+                FailFunction(compiledProgram, functionSymbol, e)
+                continue
+            if stepSeconds is None:
+                WakeFunction(compiledProgram, functionSymbol, functionInfo)
+                continue
+        if isinstance(wait, ucscript.Claim):
+            leases = compiledProgram.registry.rig.leases
+            if functionInfo.waitVersion != leases.version:
+                functionInfo.waitVersion = leases.version
+                if len(leases.Acquire(functionInfo, functionInfo.label, wait.numbers)) == 0:
+                    WakeFunction(compiledProgram, functionSymbol, functionInfo)
+                    continue
+        if isinstance(wait, ucscript.WaitUntil) and functionInfo.waitVersion != version:
+            functionInfo.waitVersion = version
+            try:
+                isSatisfied = RunScript(compiledProgram, wait.predicate)
+            except Exception as e:
+                FailFunction(compiledProgram, functionSymbol, e)
+                continue
+            if isSatisfied:
+                WakeFunction(compiledProgram, functionSymbol, functionInfo)
+                continue
+        if functionInfo.waitDeadline is not None and currentTime >= functionInfo.waitDeadline:
+            WakeFunction(compiledProgram, functionSymbol, functionInfo, True)
+
+
+# Changes whenever a solenoid state, a parameter value or a chip valve changes.
+def StateVersion(rig: Rig):
+    return rig.stateVersion, Chip.Program.parameterGeneration, Chip.Valve.generation
+
+
+# Removes a function from the running functions once it has finished or been stopped, and wakes
+# the functions that were waiting for it.
+def RemoveAsyncFunction(compiledProgram: CompiledProgram, functionSymbol: str):
+    functionInfo = compiledProgram.asyncFunctions.pop(functionSymbol)
+    compiledProgram.staleFunctions.discard(functionSymbol)
+    EndWait(compiledProgram, functionSymbol, functionInfo)
+    compiledProgram.registry.rig.leases.Release(functionInfo)
+    for waiterProgram, waiterSymbol, waiterInfo in functionInfo.waiters:
+        if not waiterInfo.blocked or waiterProgram.asyncFunctions.get(waiterSymbol) is not waiterInfo:
+            continue
+        waiterInfo.waitTargets.remove(functionInfo)
+        if not waiterInfo.waitForAll or len(waiterInfo.waitTargets) == 0:
+            WakeFunction(waiterProgram, waiterSymbol, waiterInfo)
+    functionInfo.waiters = []
+
+
+# Logs the error that ended a running function, keeps it as the function's error and stops it.
+def FailFunction(compiledProgram: CompiledProgram, functionSymbol: str, error: Exception):
+    compiledProgram.asyncFunctions[functionSymbol].error = error
+    LogError(compiledProgram, error, False)
+    StopFunction(compiledProgram, functionSymbol)
 
 
 def StopFunction(compiledProgram: CompiledProgram, functionSymbol: str):
     if functionSymbol not in compiledProgram.asyncFunctions:
         raise Exception("Could not find running function '%s' in program '%s'" %
                         (functionSymbol, compiledProgram.program.name))
-    compiledProgram.programFunctions[functionSymbol].onStop()
-    del compiledProgram.asyncFunctions[functionSymbol]
+    functionInfo = compiledProgram.asyncFunctions[functionSymbol]
+    # The pattern stops first, so that it cannot overwrite the valves set by onStop.
+    StopPlayback(compiledProgram, functionInfo)
+    CallAsOwner(compiledProgram, functionInfo, functionInfo.programFunction.onStop)
+    RemoveAsyncFunction(compiledProgram, functionSymbol)
 
 
 def SetFunctionPaused(compiledProgram: CompiledProgram, functionSymbol: str, paused: bool):
     if functionSymbol not in compiledProgram.asyncFunctions:
         raise Exception("Could not find running function '%s' in program '%s'" %
                         (functionSymbol, compiledProgram.program.name))
-    compiledProgram.programFunctions[functionSymbol].onPause() if paused else \
-        compiledProgram.programFunctions[functionSymbol].onResume()
-    compiledProgram.asyncFunctions[functionSymbol].paused = paused
+    functionInfo = compiledProgram.asyncFunctions[functionSymbol]
+    sequencer = compiledProgram.registry.rig.sequencer
+    # A playing pattern is paused before onPause and resumed after onResume.
+    if paused and functionInfo.playback is not None:
+        sequencer.SetPaused(functionInfo.playback, True)
+    CallAsOwner(compiledProgram, functionInfo, functionInfo.programFunction.onPause if paused else
+                functionInfo.programFunction.onResume)
+    functionInfo.paused = paused
+    if not paused and functionInfo.playback is not None:
+        sequencer.SetPaused(functionInfo.playback, False)
+
+
+# Calls a callback of a running function (e.g. onStop) with the function's valve claims.
+def CallAsOwner(compiledProgram: CompiledProgram, functionInfo: CompiledProgram.AsyncFunctionInfo,
+                callback: Callable):
+    leases = compiledProgram.registry.rig.leases
+    previousOwner = leases.currentOwner
+    leases.currentOwner = functionInfo
+    try:
+        RunScript(compiledProgram, callback)
+    finally:
+        leases.currentOwner = previousOwner
+
+
+# Calls script code of [compiledProgram], under its profiler if profiling is on.
+def RunScript(compiledProgram: CompiledProgram, function: Callable, *args, **kwargs):
+    profiler = compiledProgram.profiler
+    if profiler is None:
+        return function(*args, **kwargs)
+    return profiler.Run(function, *args, **kwargs)
+
+
+# Turns the line profiler of a program on or off. Turning it on again adds to the earlier results.
+def SetProfiling(compiledProgram: CompiledProgram, enabled: bool):
+    if not enabled:
+        compiledProgram.profiler = None
+        return
+    if compiledProgram.profileResults is None:
+        compiledProgram.profileResults = ScriptProfiler(lambda: compiledProgram.globalsDict,
+                                                        {__file__, ucscript.__file__},
+                                                        SCRIPT_PREFIX.count("\n"))
+    compiledProgram.profiler = compiledProgram.profileResults
 
 
 def IsFunctionRunning(compiledProgram: CompiledProgram, functionSymbol: str):
@@ -377,6 +1193,34 @@ def NoneValueForType(t):
         return []
 
 
+# Converts text (e.g. from the command line) into a parameter value of the given type. Valves and
+# programs are given by name and list items are separated by commas.
+def ParseParameterValue(text: str, t, chip: Chip.Chip):
+    if t == bool:
+        if text.strip().lower() in ("1", "true", "yes", "on"):
+            return True
+        if text.strip().lower() in ("0", "false", "no", "off"):
+            return False
+        raise Exception("Could not read '%s' as a yes/no value." % text)
+    if t == int or t == float:
+        return t(text)
+    if t == str:
+        return text
+    if t == ucscript.Valve:
+        return ExceptionIfNone(chip.FindValve(text), "Could not find a valve named '%s'." % text)
+    if t == ucscript.Program:
+        return ExceptionIfNone(chip.FindProgram(text),
+                               "Could not find a program named '%s'." % text)
+    if isinstance(t, ucscript.OptionsParameterType):
+        if text not in t.options:
+            raise Exception("'%s' is not one of the options %s." % (text, ", ".join(t.options)))
+        return text
+    if isinstance(t, ucscript.ListParameterType):
+        return [ParseParameterValue(x.strip(), t.listType, chip) for x in text.split(",") if
+                x.strip() != ""]
+    raise Exception("Parameter type is not valid.")
+
+
 def IsTypeValid(parameterType):
     return (parameterType in [float, int, str, bool, ucscript.Valve, ucscript.Program]) or \
         IsTypeValidOptions(parameterType) or IsTypeValidList(parameterType)
@@ -425,4 +1269,4 @@ def ExceptionIfNone(value, message):
 
 def LogError(compiledProgram: CompiledProgram, error: Exception, compileTime: bool):
     errorText = "".join(traceback.format_exception(type(error), error, error.__traceback__))
-    compiledProgram.messages.append(Message(errorText, Message.ERROR_CT if compileTime else Message.ERROR_RT))
+    compiledProgram.messages.Add(errorText, Message.ERROR_CT if compileTime else Message.ERROR_RT)
@@ -0,0 +1,320 @@
+import gc
+import json
+import os
+from pathlib import Path
+from typing import Dict, Iterator, Tuple, Callable, Any, List, Optional, IO
+
+from Data.BuiltinScripts import FindBuiltin, ResolveBuiltins
+from Data.Chip import Chip, Valve, Text, Image, Script, Program
+from Data.FileIO import LoadObject
+
+# uChip project files (.ucp) are JSON Lines: a header, then one line per section.
+#
+#   {"format": "uchip-project", "version": 2}
+#   {"section": "valves", "rows": [[name, x, y, width, height, solenoidNumber], ...]}
+#   {"section": "text", "rows": [[x, y, width, height, fontSize, text, [r, g, b]], ...]}
+#   {"section": "images", "rows": [[x, y, width, height, path], ...]}
+#   {"section": "scripts", "rows": [[path, null, null] or [null, builtinName, digest], ...]}
+#   {"section": "programs", "items": [{"name": ..., "script": scriptIndex, "position": [x, y],
+#                                      "scale": ..., "hideMessages": ..., "parameters": {...},
+#                                      "visibility": {...}}, ...]}
+#
+# Paths are relative to the project file and use "/" on every platform. Parameter values are
+# JSON values, except that valves and programs are stored as {"valve": index} and
+# {"program": index} into their sections. Valves, text and images are stored as rows rather than
+# objects, which keeps large chips small and fast to parse. Built-in scripts are stored by name
+# and digest (see Script.Key); their source is only added to the row, as [null, builtinName,
+# digest, source], if this version of uChip does not ship that built-in.
+#
+# Sections are read one line at a time (see ReadSections), so a reader can use the valves before
+# the rest of the file has been parsed. Sections that a reader does not know are skipped. Files
+# written by an older version are upgraded section by section with MIGRATIONS, so old projects keep
+# loading when the format changes. Projects saved with dill by earlier versions of uChip are still
+# loaded and are converted when they are saved again (or with python -m uchip convert).
+
+FORMAT_NAME = "uchip-project"
+FORMAT_VERSION = 2
+
+
+# Version 1 stored the source of every built-in script.
+def MigrateVersion1(name: str, record: Dict) -> Tuple[str, Dict]:
+    if name == "scripts":
+        record["rows"] = [row if row[0] is not None else
+                          [None, row[1], Script(None, True, row[2], row[1]).Key()[1], row[2]]
+                          for row in record["rows"]]
+    return name, record
+
+
+# Upgrades a section record from version v to v + 1, by v. Each function takes and returns
+# (section name, record).
+MIGRATIONS: Dict[int, Callable[[str, Dict], Tuple[str, Dict]]] = {1: MigrateVersion1}
+
+
+class ProjectFormatError(Exception):
+    pass
+
+
+def IsProjectFile(path: Path) -> bool:
+    with open(path, "rb") as file:
+        return file.read(1) == b"{"
+
+
+# Loads a project in either format. Paths in the returned chip are absolute.
+def LoadProject(path: Path) -> Chip:
+    if not IsProjectFile(path):
+        chip: Chip = LoadObject(path)
+        chip.ConvertPathsToAbsolute(path)
+        ResolveBuiltins(chip)
+        return chip
+    # Loading creates many objects and none of them are garbage, so collecting while loading only
+    # costs time.
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            return BuildChip(ReadSections(file), path)
+    finally:
+        if collecting:
+            gc.enable()
+
+
+# Saves a project in the current format. The chip is not changed.
+def SaveProject(chip: Chip, path: Path):
+    WriteAtomically(path, EncodeRecords(ProjectRecords(chip, path)))
+
+
+# Where unsaved changes to the project at [path] are autosaved (see Data.ProjectSaver). It is in
+# the same folder, so relative paths are the same as in the project.
+def AutosavePath(path: Path) -> Path:
+    return path.with_name(path.name + ".autosave")
+
+
+# Converts a dill project to the current format. Returns False if it already was.
+def ConvertProject(source: Path, destination: Path) -> bool:
+    if IsProjectFile(source):
+        return False
+    SaveProject(LoadProject(source), destination)
+    return True
+
+
+# Yields (section name, record) for each section of an open project file, upgraded to the current
+# version.
+def ReadSections(file: IO[str]) -> Iterator[Tuple[str, Dict]]:
+    try:
+        header = json.loads(file.readline())
+    except ValueError:
+        raise ProjectFormatError("This is not a uChip project.")
+    if not isinstance(header, dict) or header.get("format") != FORMAT_NAME:
+        raise ProjectFormatError("This is not a uChip project.")
+    version = header.get("version", 1)
+    if version > FORMAT_VERSION:
+        raise ProjectFormatError("The project was saved by a newer version of uChip (format %d, "
+                                 "this version reads up to %d)." % (version, FORMAT_VERSION))
+    for lineNumber, line in enumerate(file, 2):
+        if line.strip() == "":
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise ProjectFormatError("The project file is damaged at line %d: %s" % (lineNumber, e))
+        name = record.get("section")
+        for v in range(version, FORMAT_VERSION):
+            name, record = MIGRATIONS[v](name, record)
+        yield name, record
+
+
+def BuildChip(sections: Iterator[Tuple[str, Dict]], path: Path) -> Chip:
+    # Like unpickling, this does not run Chip.__init__: the scripts come from the file, and the
+    # built-ins that the file does not list are added by ResolveBuiltins.
+    chip = Chip.__new__(Chip)
+    chip.valves, chip.text, chip.images, chip.scripts, chip.programs = [], [], [], [], []
+    basePath = Path(path)
+
+    for name, record in sections:
+        if name == "valves":
+            chip.valves = BuildValves(record["rows"])
+        elif name == "text":
+            chip.text = [BuildText(row) for row in record["rows"]]
+        elif name == "images":
+            chip.images = [BuildImage(row, basePath) for row in record["rows"]]
+        elif name == "scripts":
+            chip.scripts = [BuildScript(row, basePath) for row in record["rows"]]
+        elif name == "programs":
+            chip.programs = [BuildProgram(item, chip) for item in record["items"]]
+    ResolveReferences(chip)
+    ResolveBuiltins(chip)
+    Valve.generation += 1
+    Program.generation += 1
+    return chip
+
+
+# Building the valves is most of the time it takes to load a large chip, so they are built without
+# going through Valve.__setattr__. Valve.generation is incremented once for all of them.
+def BuildValves(rows: List[List]) -> List[Valve]:
+    valves = []
+    append = valves.append
+    new = Valve.__new__
+    for name, x, y, width, height, solenoidNumber in rows:
+        valve = new(Valve)
+        state = valve.__dict__
+        state["name"] = name
+        state["rect"] = [x, y, width, height]
+        state["solenoidNumber"] = solenoidNumber
+        append(valve)
+    return valves
+
+
+def BuildText(row: List) -> Text:
+    text = Text.__new__(Text)
+    text.__dict__.update(rect=row[0:4], fontSize=row[4], text=row[5], color=tuple(row[6]))
+    return text
+
+
+def BuildImage(row: List, basePath: Path) -> Image:
+    image = Image.__new__(Image)
+    image.__dict__.update(rect=row[0:4], path=AbsolutePath(row[4], basePath))
+    return image
+
+
+# Built-in scripts are the shared ones when this version of uChip ships the same script. Otherwise
+# the source saved with the project is used, so that programs keep the code they were written for;
+# without it, the current built-in of that name is used.
+def BuildScript(row: List, basePath: Path) -> Script:
+    if row[0] is not None:
+        return Script(AbsolutePath(row[0], basePath))
+    name, digest = row[1], row[2]
+    script = FindBuiltin(name, digest)
+    if script is None and len(row) > 3:
+        script = Script(None, True, row[3], name)
+    if script is None:
+        script = FindBuiltin(name)
+    if script is None:
+        script = Script(None, True, "raise Exception(%r)" % (
+            "The built-in script '%s' is not available in this version of uChip." % name), name)
+        # Keeps the key, so the project still refers to the built-in it was saved with.
+        script.biKey = (name, digest)
+    return script
+
+
+def BuildProgram(item: Dict, chip: Chip) -> Program:
+    program = Program(chip.scripts[item["script"]])
+    program.name = item["name"]
+    program.position = list(item.get("position", [0, 0]))
+    program.scale = item.get("scale", 1)
+    program.hideMessages = item.get("hideMessages", False)
+    program.parameterVisibility = dict(item.get("visibility", {}))
+    # Valve and program references are resolved once every program exists.
+    program.parameterValues = item.get("parameters", {})
+    return program
+
+
+def ResolveReferences(chip: Chip):
+    for program in chip.programs:
+        program.parameterValues = {symbol: DecodeValue(value, chip) for symbol, value in
+                                   program.parameterValues.items()}
+
+
+def DecodeValue(value: Any, chip: Chip) -> Any:
+    if isinstance(value, list):
+        return [DecodeValue(v, chip) for v in value]
+    if isinstance(value, dict):
+        if "valve" in value:
+            return chip.valves[value["valve"]]
+        if "program" in value:
+            return chip.programs[value["program"]]
+        return None
+    return value
+
+
+# The records of a project file to be saved at [path]. The records share nothing mutable with the
+# chip, so they can be encoded and written on another thread while the chip keeps changing.
+def ProjectRecords(chip: Chip, path: Path) -> List[Dict]:
+    basePath = Path(path)
+    valveIndices = {id(v): i for i, v in enumerate(chip.valves)}
+    programIndices = {id(p): i for i, p in enumerate(chip.programs)}
+    scriptIndices = {id(s): i for i, s in enumerate(chip.scripts)}
+
+    def EncodeValue(value: Any) -> Any:
+        if isinstance(value, (list, tuple)):
+            return [EncodeValue(v) for v in value]
+        if isinstance(value, Valve):
+            index = valveIndices.get(id(value))
+            return None if index is None else {"valve": index}
+        if isinstance(value, Program):
+            index = programIndices.get(id(value))
+            return None if index is None else {"program": index}
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return value
+        # Parameter types are limited to the ones above; anything else cannot be restored.
+        return None
+
+    def EncodeProgram(program: Program) -> Dict:
+        scriptIndex = scriptIndices.get(id(program.script))
+        if scriptIndex is None:
+            # Programs whose script is not in the chip's list (e.g. from very old projects).
+            scriptIndex = len(chip.scripts) + len(extraScripts)
+            extraScripts.append(program.script)
+        return {"name": program.name, "script": scriptIndex, "position": list(program.position),
+                "scale": program.scale, "hideMessages": program.hideMessages,
+                "parameters": {s: EncodeValue(v) for s, v in
+                               list(program.parameterValues.items())},
+                "visibility": dict(program.parameterVisibility)}
+
+    extraScripts: List[Script] = []
+    programs = [EncodeProgram(p) for p in chip.programs]
+
+    def EncodeScript(script: Script) -> List:
+        if script.isBuiltIn:
+            name, digest = script.Key()
+            if FindBuiltin(name, digest) is None:
+                return [None, name, digest, script.biScript]
+            return [None, name, digest]
+        return [RelativePath(script.path, basePath), None, None]
+
+    return [{"format": FORMAT_NAME, "version": FORMAT_VERSION},
+            {"section": "valves",
+             "rows": [[v.name] + list(v.rect) + [v.solenoidNumber] for v in chip.valves]},
+            {"section": "text",
+             "rows": [list(t.rect) + [t.fontSize, t.text, list(t.color)] for t in chip.text]},
+            {"section": "images",
+             "rows": [list(i.rect) + [RelativePath(i.path, basePath)] for i in chip.images]},
+            {"section": "scripts",
+             "rows": [EncodeScript(s) for s in chip.scripts + extraScripts]},
+            {"section": "programs", "items": programs}]
+
+
+def EncodeRecords(records: List[Dict]) -> str:
+    return "".join(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+                   for record in records)
+
+
+# Replaces the file at [path] with [text] in one step: the text is written to a temporary file in
+# the same folder, which is then renamed over the file. A crash while writing leaves the old file
+# intact.
+def WriteAtomically(path: Path, text: str):
+    path = Path(path)
+    temporaryPath = path.with_name(".%s.%d.tmp" % (path.name, os.getpid()))
+    try:
+        with open(temporaryPath, "w", encoding="utf-8", newline="\n") as file:
+            file.write(text)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporaryPath, path)
+    except BaseException:
+        try:
+            os.remove(temporaryPath)
+        except OSError:
+            pass
+        raise
+
+
+def RelativePath(path: Optional[Path], basePath: Path) -> Optional[str]:
+    if path is None:
+        return None
+    return Path(os.path.relpath(path, basePath)).as_posix()
+
+
+def AbsolutePath(text: Optional[str], basePath: Path) -> Optional[Path]:
+    if text is None:
+        return None
+    return Path(os.path.abspath(basePath / text))
@@ -0,0 +1,78 @@
+import hashlib
+import queue
+import threading
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from Data.ProjectFile import EncodeRecords, WriteAtomically
+
+
+# Writes project files on a background thread, so that saving never stalls the user interface.
+# The caller takes a snapshot of the chip with ProjectRecords (which is quick) and hands it over;
+# encoding and writing happen here, one save at a time in the order they were requested.
+#
+# The saver remembers a digest of what it last wrote for each project. Saves with onlyIfChanged
+# (autosaves) are skipped if the project has not changed since, so unchanged projects are never
+# rewritten.
+class ProjectSaver:
+    def __init__(self):
+        self.requests: queue.Queue = queue.Queue()
+        # The digest of the last text written for each project, by project path.
+        self.digests: Dict[Path, str] = {}
+        self.thread = threading.Thread(target=self.Loop, daemon=True)
+        self.thread.start()
+
+    # Writes [records] to [path] as the project [project] (by default [path] itself). Once done,
+    # [onDone] is called on the saver's thread with whether the file was written and the error,
+    # if any. After a successful write, the file [obsolete] (e.g. an autosave) is deleted.
+    def Save(self, records: List[Dict], path: Path, project: Optional[Path] = None,
+             onlyIfChanged: bool = False, obsolete: Optional[Path] = None,
+             onDone: Optional[Callable[[bool, Optional[Exception]], None]] = None):
+        self.requests.put(lambda: self.Write(records, Path(path), Path(project or path),
+                                             onlyIfChanged, obsolete, onDone))
+
+    # Deletes [path] (e.g. an autosave whose changes were discarded) after the pending saves.
+    def Remove(self, path: Path):
+        def RemoveFile():
+            try:
+                Path(path).unlink(missing_ok=True)
+            except OSError:
+                pass
+        self.requests.put(RemoveFile)
+
+    def Loop(self):
+        while True:
+            request = self.requests.get()
+            try:
+                if request is None:
+                    return
+                request()
+            finally:
+                self.requests.task_done()
+
+    def Write(self, records, path: Path, project: Path, onlyIfChanged: bool,
+              obsolete: Optional[Path], onDone):
+        written = False
+        error = None
+        try:
+            text = EncodeRecords(records)
+            digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+            if not onlyIfChanged or self.digests.get(project) != digest:
+                WriteAtomically(path, text)
+                self.digests[project] = digest
+                written = True
+            if obsolete is not None:
+                obsolete.unlink(missing_ok=True)
+        except Exception as e:
+            error = e
+        if onDone is not None:
+            onDone(written, error)
+
+    # Blocks until every requested save has been written.
+    def Wait(self):
+        self.requests.join()
+
+    # Writes the pending saves and stops the thread.
+    def Close(self):
+        self.requests.put(None)
+        self.thread.join()
@@ -0,0 +1,457 @@
+import collections
+import hashlib
+import hmac
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Deque
+
+from Data.Clock import RealClock
+from Data.Rig import Rig
+
+
+# Lets one uChip controller drive solenoid boards that are plugged into other computers. Each of
+# those computers runs an agent (python -m uchip agent) that owns its local Rig. The controller
+# maps a range of its own solenoid numbers onto each agent, e.g. solenoids 48-95 onto solenoids
+# 0-47 of the agent on "bench2", and pushes state changes to the agents whenever it flushes.
+#
+# The protocol is a stream of binary messages over TCP. Each message is a type byte and the length
+# of the payload (network byte order), followed by the payload:
+#   HELLO   controller  -> agent   version (B)
+#   HELLO   agent  -> controller   version (B), challenge (16s)
+#   AUTH    controller  -> agent   HMAC-SHA256 of the challenge, keyed with the shared secret (32s)
+#   AUTH    agent  -> controller   accepted (B)
+#   STATES  controller  -> agent   sequence (I), applyAt (d), count (H), count x entry (H)
+#   ACK     agent  -> controller   sequence (I), agent time when applied (d)
+#   PING    controller  -> agent   sequence (I), controller time (d)
+#   PONG    agent  -> controller   sequence (I), controller time (d), agent time (d)
+# A STATES entry is the agent's solenoid number in the low 15 bits and the state in the top bit.
+# Only solenoids that changed since the last push are sent, all in one message, so a flush costs
+# one small message per agent. applyAt is 0 to apply at once, or a time on the agent's clock.
+#
+# Agents listen on localhost unless told otherwise. An agent that other computers can reach should
+# be given a shared secret (see SECRET_VARIABLE), which controllers must prove they know before
+# they can set any valve. The secret itself is never sent.
+PROTOCOL_VERSION = 2
+
+HELLO = ord('H')
+STATES = ord('S')
+ACK = ord('A')
+PING = ord('P')
+PONG = ord('Q')
+AUTH = ord('U')
+
+HEADER = struct.Struct("!BI")
+HELLO_BODY = struct.Struct("!B")
+AGENT_HELLO_BODY = struct.Struct("!B16s")
+AUTH_BODY = struct.Struct("!32s")
+AUTH_REPLY_BODY = struct.Struct("!B")
+STATES_BODY = struct.Struct("!IdH")
+ACK_BODY = struct.Struct("!Id")
+PING_BODY = struct.Struct("!Id")
+PONG_BODY = struct.Struct("!Idd")
+
+OPEN_BIT = 0x8000
+MAX_SOLENOID = 0x7FFF
+
+# The longest payloads that are read: a STATES message for every solenoid, and before the
+# controller has proved it knows the secret, an AUTH message. Longer messages close the connection.
+MAX_PAYLOAD = STATES_BODY.size + 2 * (MAX_SOLENOID + 1)
+MAX_HANDSHAKE_PAYLOAD = 64
+
+DEFAULT_PORT = 8766
+DEFAULT_HOST = "127.0.0.1"
+
+# The environment variable that holds the shared secret of agents and controllers, if they have
+# none of their own.
+SECRET_VARIABLE = "UCHIP_AGENT_SECRET"
+
+
+def DefaultSecret() -> str:
+    return os.environ.get(SECRET_VARIABLE, "")
+
+
+def AuthenticationCode(secret: str, challenge: bytes) -> bytes:
+    return hmac.new(secret.encode("utf-8"), challenge, hashlib.sha256).digest()
+
+
+def SendMessage(connection: socket.socket, messageType: int, payload: bytes):
+    connection.sendall(HEADER.pack(messageType, len(payload)) + payload)
+
+
+# Reads [size] bytes. If [patient], socket timeouts are ignored, so that a socket with a send
+# timeout can wait for messages indefinitely.
+def ReceiveExactly(connection: socket.socket, size: int, patient: bool) -> Optional[bytes]:
+    data = b''
+    while len(data) < size:
+        try:
+            chunk = connection.recv(size - len(data))
+        except socket.timeout:
+            if patient:
+                continue
+            raise
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+# Returns (type, payload), or None once the connection has been closed. Raises ConnectionError if
+# the payload is longer than [maxLength].
+def ReceiveMessage(connection: socket.socket, patient: bool = False,
+                   maxLength: int = MAX_PAYLOAD) -> Optional[Tuple[int, bytes]]:
+    header = ReceiveExactly(connection, HEADER.size, patient)
+    if header is None:
+        return None
+    messageType, length = HEADER.unpack(header)
+    if length > maxLength:
+        raise ConnectionError("Received a message of %d bytes; at most %d are allowed." %
+                              (length, maxLength))
+    payload = ReceiveExactly(connection, length, patient)
+    if payload is None:
+        return None
+    return messageType, payload
+
+
+def EncodeStates(sequence: int, applyAt: float, states: Dict[int, bool]) -> bytes:
+    entries = [number | (OPEN_BIT if state else 0) for number, state in states.items()]
+    return STATES_BODY.pack(sequence, applyAt, len(entries)) + \
+        struct.pack("!%dH" % len(entries), *entries)
+
+
+def DecodeStates(payload: bytes) -> Tuple[int, float, Dict[int, bool]]:
+    sequence, applyAt, count = STATES_BODY.unpack_from(payload)
+    entries = struct.unpack_from("!%dH" % count, payload, STATES_BODY.size)
+    return sequence, applyAt, {e & MAX_SOLENOID: bool(e & OPEN_BIT) for e in entries}
+
+
+# The controller's end of the connection to one agent. Controller solenoids
+# [startNumber, startNumber + count) drive the agent's solenoids [remoteStart, remoteStart + count).
+class RemoteRig:
+    # How long a send may block before the agent is considered gone.
+    TIMEOUT = 1.0
+
+    # How many recent pings the clock offset is estimated from.
+    PING_SAMPLES = 8
+
+    def __init__(self, host: str, port: int, startNumber: int, count: int, remoteStart: int = 0,
+                 secret: Optional[str] = None):
+        if remoteStart + count - 1 > MAX_SOLENOID:
+            raise ValueError("Remote solenoid numbers must be below %d." % (MAX_SOLENOID + 1))
+        self.host = host
+        self.port = port
+        self.startNumber = startNumber
+        self.count = count
+        self.remoteStart = remoteStart
+        # The agent's shared secret; DefaultSecret() if None.
+        self.secret = secret
+
+        # If set, pushed states are applied this many seconds after they are sent, at the same
+        # moment on every agent (using the estimated clock offsets), instead of on arrival.
+        self.applyDelay: Optional[float] = None
+
+        self.connection: Optional[socket.socket] = None
+        self.sendLock = threading.Lock()
+        # Held while the connection is replaced.
+        self.connectionLock = threading.Lock()
+
+        # The states last sent, by agent solenoid number, and the rig's stateVersion at the last
+        # push. Cleared on connecting so that the first push sends every solenoid of the range.
+        self.sent: Dict[int, bool] = {}
+        self.pushedVersion: Optional[int] = None
+        self.sequence = 0
+
+        # Round trip times and offsets (agent clock minus controller clock) of recent pings.
+        self.pingSamples: Deque[Tuple[float, float]] = \
+            collections.deque(maxlen=RemoteRig.PING_SAMPLES)
+        self.pingSequence = 0
+
+        self.pushes = 0
+        self.bytesSent = 0
+        self.errors = 0
+        self.connects = 0
+        self.lastAcknowledged = 0
+        # Seconds from sending a push until the agent reported it applied, on the controller clock.
+        self.lastApplyLatency: Optional[float] = None
+        self.sendTimes: Dict[int, float] = {}
+        # Why the agent was last disconnected or could not be connected to, for the rig view.
+        self.lastError: Optional[str] = None
+
+    def Describe(self):
+        return "%s:%d (solenoids %d-%d)" % (self.host, self.port, self.startNumber,
+                                            self.startNumber + self.count - 1)
+
+    def IsConnected(self):
+        return self.connection is not None
+
+    def Status(self):
+        if self.IsConnected():
+            return "connected"
+        if self.lastError is not None:
+            return "not connected: " + self.lastError
+        return "not connected"
+
+    def Connect(self):
+        if self.IsConnected():
+            return
+        try:
+            self.Open()
+        except OSError as e:
+            self.lastError = str(e)
+            raise
+        self.lastError = None
+
+    def Open(self):
+        # The timeout stays set, so that sending to an agent that has gone away fails instead of
+        # blocking the program thread.
+        connection = socket.create_connection((self.host, self.port), RemoteRig.TIMEOUT)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            SendMessage(connection, HELLO, HELLO_BODY.pack(PROTOCOL_VERSION))
+            reply = ReceiveMessage(connection, maxLength=MAX_HANDSHAKE_PAYLOAD)
+            if reply is None or reply[0] != HELLO or len(reply[1]) != AGENT_HELLO_BODY.size or \
+                    AGENT_HELLO_BODY.unpack(reply[1])[0] != PROTOCOL_VERSION:
+                raise ConnectionError("%s is not a uChip agent of the same version." %
+                                      self.Describe())
+            challenge = AGENT_HELLO_BODY.unpack(reply[1])[1]
+            secret = self.secret if self.secret is not None else DefaultSecret()
+            SendMessage(connection, AUTH, AUTH_BODY.pack(AuthenticationCode(secret, challenge)))
+            reply = ReceiveMessage(connection, maxLength=MAX_HANDSHAKE_PAYLOAD)
+            if reply is None or reply[0] != AUTH or AUTH_REPLY_BODY.unpack(reply[1])[0] != 1:
+                raise ConnectionError("The agent %s did not accept the shared secret." %
+                                      self.Describe())
+        except OSError:
+            connection.close()
+            raise
+        self.sent = {}
+        self.pushedVersion = None
+        self.sendTimes = {}
+        self.pingSamples.clear()
+        with self.connectionLock:
+            self.connection = connection
+        self.connects += 1
+        threading.Thread(target=self.Receive, args=(connection,), daemon=True).start()
+        self.Ping()
+
+    # Closes the connection. If [lost] is given, only closes it if it is still the current one, so
+    # that a connection that failed cannot take down the one that replaced it.
+    def Disconnect(self, lost: Optional[socket.socket] = None):
+        with self.connectionLock:
+            if lost is not None and lost is not self.connection:
+                return False
+            connection, self.connection = self.connection, None
+        if connection is not None:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            connection.close()
+        return True
+
+    # Sends the states of the range that changed since the last push. [solenoidStates] uses
+    # controller numbers; nothing is compared unless [stateVersion] changed since the last push.
+    def Push(self, solenoidStates: Dict[int, bool], stateVersion: int):
+        if not self.IsConnected() or stateVersion == self.pushedVersion:
+            return
+        self.pushedVersion = stateVersion
+        changes = {}
+        sent = self.sent
+        shift = self.remoteStart - self.startNumber
+        for number in range(self.startNumber, self.startNumber + self.count):
+            state = solenoidStates.get(number, False)
+            if sent.get(number + shift) != state:
+                changes[number + shift] = state
+        if len(changes) == 0:
+            return
+        now = time.time()
+        applyAt = 0.0
+        offset = self.ClockOffset()
+        if self.applyDelay is not None and offset is not None:
+            applyAt = now + offset + self.applyDelay
+        self.sequence += 1
+        if self.Send(STATES, EncodeStates(self.sequence, applyAt, changes)):
+            sent.update(changes)
+            self.pushes += 1
+            self.sendTimes[self.sequence] = now
+
+    def Ping(self):
+        self.pingSequence += 1
+        self.Send(PING, PING_BODY.pack(self.pingSequence, time.time()))
+
+    def Send(self, messageType: int, payload: bytes) -> bool:
+        connection = self.connection
+        if connection is None:
+            return False
+        try:
+            with self.sendLock:
+                SendMessage(connection, messageType, payload)
+            self.bytesSent += HEADER.size + len(payload)
+            return True
+        except OSError as e:
+            if self.Disconnect(connection):
+                self.lastError = "lost the connection: %s" % e
+                self.errors += 1
+            return False
+
+    # Reads acknowledgements and ping replies until the connection closes.
+    def Receive(self, connection: socket.socket):
+        try:
+            while True:
+                message = ReceiveMessage(connection, True)
+                if message is None:
+                    break
+                messageType, payload = message
+                now = time.time()
+                if messageType == PONG:
+                    _, sentTime, agentTime = PONG_BODY.unpack(payload)
+                    # The agent read its clock about halfway through the round trip.
+                    self.pingSamples.append((now - sentTime, agentTime - (sentTime + now) / 2))
+                elif messageType == ACK:
+                    sequence, _ = ACK_BODY.unpack(payload)
+                    self.lastAcknowledged = sequence
+                    sendTime = self.sendTimes.pop(sequence, None)
+                    if sendTime is not None:
+                        self.lastApplyLatency = now - sendTime
+                    for old in [s for s in self.sendTimes if s < sequence]:
+                        del self.sendTimes[old]
+        except OSError as e:
+            lostError = e
+        else:
+            lostError = "closed by the agent"
+        if self.Disconnect(connection):
+            self.lastError = "lost the connection: %s" % lostError
+            self.errors += 1
+
+    # The agent's clock minus the controller's, from the ping with the shortest round trip, which
+    # is the least affected by network delays. None until a ping has been answered.
+    def ClockOffset(self) -> Optional[float]:
+        samples = list(self.pingSamples)
+        if len(samples) == 0:
+            return None
+        return min(samples)[1]
+
+    def RoundTrip(self) -> Optional[float]:
+        samples = list(self.pingSamples)
+        return None if len(samples) == 0 else min(samples)[0]
+
+    def ToDict(self):
+        d = {"host": self.host, "port": self.port, "first": self.startNumber,
+             "count": self.count, "remoteFirst": self.remoteStart}
+        if self.secret is not None:
+            d["secret"] = self.secret
+        return d
+
+    @staticmethod
+    def FromDict(d: Dict) -> 'RemoteRig':
+        return RemoteRig(d["host"], d.get("port", DEFAULT_PORT), d["first"], d["count"],
+                         d.get("remoteFirst", 0), d.get("secret"))
+
+
+# Reads the remote rigs of a controller from a JSON file, e.g.
+#   [{"host": "bench2", "port": 8766, "first": 48, "count": 48}]
+def LoadRemoteRigs(path: Path) -> List[RemoteRig]:
+    if not path.exists():
+        return []
+    with open(path) as f:
+        return [RemoteRig.FromDict(d) for d in json.load(f)]
+
+
+# Parses "host[:port]=first+count[@remoteFirst]" from the command line, e.g. "bench2=48+48".
+def ParseRemoteRig(text: str) -> RemoteRig:
+    address, _, numbers = text.partition("=")
+    host, _, port = address.partition(":")
+    numbers, _, remoteStart = numbers.partition("@")
+    first, _, count = numbers.partition("+")
+    if host == "" or not first.isdigit() or not count.isdigit():
+        raise ValueError("Give remote rigs as host[:port]=first+count[@remoteFirst], not '%s'." %
+                         text)
+    return RemoteRig(host, int(port) if port else DEFAULT_PORT, int(first), int(count),
+                     int(remoteStart) if remoteStart else 0)
+
+
+# Serves a local rig to controllers. Pushed states are applied to the rig and flushed to its
+# devices at once (or at the requested time), and acknowledged with the time they were applied.
+# Only controllers that know [secret] (DefaultSecret() if None) are served.
+class RigAgent:
+    def __init__(self, rig: Rig, address: Tuple[str, int] = (DEFAULT_HOST, DEFAULT_PORT),
+                 clock=None, secret: Optional[str] = None):
+        self.rig = rig
+        self.secret = secret if secret is not None else DefaultSecret()
+        self.clock = clock if clock is not None else RealClock()
+        self.pushes = 0
+        self.connections = set()
+
+        agent = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                agent.Serve(self.request)
+
+        self.server = socketserver.ThreadingTCPServer(address, Handler, bind_and_activate=False)
+        self.server.daemon_threads = True
+        self.server.allow_reuse_address = True
+        self.server.server_bind()
+        self.server.server_activate()
+        self.address = self.server.server_address
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def Describe(self):
+        return "%s:%d" % self.address[:2]
+
+    def Serve(self, connection: socket.socket):
+        self.connections.add(connection)
+        try:
+            self.ServeConnection(connection)
+        except OSError:
+            pass
+        finally:
+            self.connections.discard(connection)
+
+    def ServeConnection(self, connection: socket.socket):
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        message = ReceiveMessage(connection, maxLength=MAX_HANDSHAKE_PAYLOAD)
+        if message is None or message[0] != HELLO:
+            return
+        challenge = os.urandom(16)
+        SendMessage(connection, HELLO, AGENT_HELLO_BODY.pack(PROTOCOL_VERSION, challenge))
+        message = ReceiveMessage(connection, maxLength=MAX_HANDSHAKE_PAYLOAD)
+        if message is None or message[0] != AUTH or len(message[1]) != AUTH_BODY.size:
+            return
+        accepted = hmac.compare_digest(message[1], AuthenticationCode(self.secret, challenge))
+        SendMessage(connection, AUTH, AUTH_REPLY_BODY.pack(int(accepted)))
+        if not accepted:
+            return
+        while True:
+            message = ReceiveMessage(connection)
+            if message is None:
+                return
+            messageType, payload = message
+            if messageType == PING:
+                sequence, controllerTime = PING_BODY.unpack(payload)
+                SendMessage(connection, PONG,
+                            PONG_BODY.pack(sequence, controllerTime, self.clock.Time()))
+            elif messageType == STATES:
+                sequence, applyAt, states = DecodeStates(payload)
+                delay = applyAt - self.clock.Time()
+                if applyAt > 0 and delay > 0:
+                    self.clock.Sleep(delay)
+                self.rig.SetSolenoidStates(states)
+                self.rig.FlushStates()
+                self.pushes += 1
+                SendMessage(connection, ACK, ACK_BODY.pack(sequence, self.clock.Time()))
+
+    # Stops listening and drops the connected controllers.
+    def Close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for connection in list(self.connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
@@ -1,8 +1,14 @@
+import threading
 from typing import Dict
-from serial.tools.list_ports import comports
-from typing import List, Optional
-from serial import Serial
-from serial.tools.list_ports_common import ListPortInfo
+from typing import List, Optional, TYPE_CHECKING
+
+from Data.ValveLeases import LeaseTable
+
+# pyserial is imported when a port is first scanned or opened, which keeps startup fast.
+if TYPE_CHECKING:
+    from serial import Serial
+    from serial.tools.list_ports_common import ListPortInfo
+    from Data.RemoteRig import RemoteRig
 
 
 class Rig:
@@ -10,7 +16,24 @@ class Rig:
         self.solenoidStates: Dict[int, bool] = {}
         self.allDevices: List[Device] = []
 
+        # Incremented whenever a solenoid state changes.
+        self.stateVersion = 0
+
+        # Held while writing to the devices, so that the sequencer thread and the program thread
+        # never interleave their writes.
+        self.lock = threading.Lock()
+
+        # Plays valve patterns from its own thread. Created on first use (see Data.Sequencer).
+        self.sequencer = None
+
+        # Which running functions have claimed which solenoids.
+        self.leases = LeaseTable()
+
+        # Ranges of solenoids that are driven by agents on other computers (see Data.RemoteRig).
+        self.remoteRigs: List['RemoteRig'] = []
+
     def RescanForDevices(self):
+        self.ReconnectRemoteRigs()
         portInfos = RescanPorts()
 
         for device in self.allDevices:
@@ -33,21 +56,45 @@ class Rig:
                 newDevice.available = True
                 self.allDevices.append(newDevice)
 
+    # Connects to agents that are not connected yet and pings the others, which keeps their clock
+    # offsets up to date.
+    def ReconnectRemoteRigs(self):
+        for remote in self.remoteRigs:
+            if remote.IsConnected():
+                remote.Ping()
+                continue
+            try:
+                remote.Connect()
+            except OSError:
+                pass
+
     def Disconnect(self):
         for device in self.allDevices:
             device.Disconnect()
+        for remote in self.remoteRigs:
+            remote.Disconnect()
 
     def SetSolenoidState(self, number: int, state: bool):
+        if self.solenoidStates.get(number) != state:
+            self.stateVersion += 1
         self.solenoidStates[number] = state
 
+    # Sets many solenoids at once from {number: state}, as a single change.
+    def SetSolenoidStates(self, states: Dict[int, bool]):
+        self.solenoidStates.update(states)
+        self.stateVersion += 1
+
     def GetSolenoidState(self, number: int):
         if number not in self.solenoidStates:
             self.solenoidStates[number] = False
         return self.solenoidStates[number]
 
     def FlushStates(self):
-        for device in self.allDevices:
-            device.SetSolenoids(self.solenoidStates)
+        with self.lock:
+            for device in self.allDevices:
+                device.SetSolenoids(self.solenoidStates)
+            for remote in self.remoteRigs:
+                remote.Push(self.solenoidStates, self.stateVersion)
         # for device in self.allDevices:
         #     device.Flush()
 
@@ -58,19 +105,38 @@ class Rig:
                 for n in range(d.startNumber, d.startNumber + 24):
                     if n not in numbers:
                         numbers.append(n)
+        for remote in self.remoteRigs:
+            if remote.IsConnected():
+                for n in range(remote.startNumber, remote.startNumber + remote.count):
+                    if n not in numbers:
+                        numbers.append(n)
         return sorted(numbers)
 
 
 class Device:
+    PORT_COMMANDS = [b'A', b'B', b'C']
+
     def __init__(self):
-        self.portInfo: Optional[ListPortInfo] = None
+        self.portInfo: Optional['ListPortInfo'] = None
         self.startNumber = 0
         self.polarities = [False, False, False]
         self.enabled = False
         self.available = False
-        self.serialPort: Optional[Serial] = None
+        self.serialPort: Optional['Serial'] = None
         self.solenoidStates = [False for _ in range(24)]
 
+        # The byte last written to each port, with polarities applied.
+        self.portBytes = [0, 0, 0]
+
+        # Counters for monitoring (see Data.Metrics). They are not saved.
+        self.ResetCounters()
+
+    def ResetCounters(self):
+        self.writes = 0
+        self.bytesWritten = 0
+        self.writeErrors = 0
+        self.connects = 0
+
     def IsConnected(self):
         return self.serialPort is not None and self.serialPort.is_open
 
@@ -78,10 +144,14 @@ class Device:
         d = self.__dict__.copy()
         d['serialPort'] = None
         d['available'] = False
+        for counter in ['writes', 'bytesWritten', 'writeErrors', 'connects']:
+            d.pop(counter, None)
         return d
 
     def __setstate__(self, state):
+        state.setdefault('portBytes', [0, 0, 0])
         self.__dict__ = state
+        self.ResetCounters()
 
     def SetSolenoids(self, solenoidStates: Dict[int, bool]):
         if not self.enabled or not self.IsConnected():
@@ -96,12 +166,31 @@ class Device:
         aState = ConvertPinStatesToBytes(polarizedStates[0:8])
         bState = ConvertPinStatesToBytes(polarizedStates[8:16])
         cState = ConvertPinStatesToBytes(polarizedStates[16:24])
+        self.portBytes = [aState[0], bState[0], cState[0]]
         self.Write(b'A' + aState)
         self.Write(b'B' + bState)
         self.Write(b'C' + cState)
 
+    # Writes several ports in one write. For each (port, mask, bits), the pins of the port (0-2)
+    # that are in [mask] are set to [bits], which already has the port's polarity applied. Used by
+    # the sequencer to write precompiled pattern steps.
+    def WritePorts(self, portBits):
+        data = b''
+        for port, mask, bits in portBits:
+            byte = (self.portBytes[port] & ~mask) | bits
+            self.portBytes[port] = byte
+            data += Device.PORT_COMMANDS[port] + bytes((byte,))
+        self.Write(data)
+
     def Write(self, data):
-        self.serialPort.write(data)
+        try:
+            self.serialPort.write(data)
+        except OSError:
+            # pyserial's SerialException is an OSError.
+            self.writeErrors += 1
+            raise
+        self.writes += 1
+        self.bytesWritten += len(data)
 
     def Flush(self):
         if not self.enabled or not self.IsConnected():
@@ -111,11 +200,13 @@ class Device:
     def Connect(self):
         if self.IsConnected():
             return
+        from serial import Serial
         self.serialPort = Serial(self.portInfo.device, baudrate=115200, timeout=0, write_timeout=0)
         self.serialPort.write(b'!A' + bytes([0]))
         self.serialPort.write(b'!B' + bytes([0]))
         self.serialPort.write(b'!C' + bytes([0]))
         self.serialPort.flush()
+        self.connects += 1
 
     def Disconnect(self):
         if self.IsConnected():
@@ -149,6 +240,7 @@ def ConvertPinStatesToBytes(state: List[bool]):
 
 
 def RescanPorts():
+    from serial.tools.list_ports import comports
     return comports()
 
 
@@ -0,0 +1,165 @@
+import collections
+import concurrent.futures
+import time
+import typing
+from typing import Callable, List, Optional
+
+import ucscript
+from Data.Clock import RealClock, VirtualClock
+from Data.ProgramCompilation import CompiledProgram, TickFunction, CheckWaits, StateVersion
+from Data.Rig import Rig
+from Data.TickStats import TickStats
+
+
+# Ticks the running functions of all compiled programs and flushes the rig. The scheduler does not
+# own a thread: the GUI's ProgramWorker and the simulation both drive it.
+class Scheduler:
+    TICK_PERIOD = 0.01
+
+    def __init__(self, rig: Rig, programSource: Callable[[], List[CompiledProgram]], clock=None):
+        self.rig = rig
+        self.programSource = programSource
+        self.clock = RealClock() if clock is None else clock
+
+        # The function that is currently being ticked and the (real) time its tick started. Used
+        # to detect functions that block the program thread.
+        self.tickStartTime: typing.Optional[float] = None
+        self.tickStartProgram: typing.Optional[CompiledProgram] = None
+        self.tickStartFunctionSymbol: str = ""
+
+        # Timing of every tick, flush and function.
+        self.stats = TickStats()
+
+        # Calls from other threads that must run on the thread that ticks the scheduler.
+        self.pendingCalls: typing.Deque[typing.Tuple[Callable, concurrent.futures.Future]] = \
+            collections.deque()
+
+        # Called with the current time on every tick, after the running functions have been
+        # ticked (e.g. to start the next run of an experiment queue).
+        self.tickCallbacks: List[Callable[[float], None]] = []
+
+    # Runs [function] on the scheduler's thread at the start of the next tick and returns a future
+    # for its result. Use this to touch compiled programs or the rig from other threads.
+    def Invoke(self, function: Callable) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        self.pendingCalls.append((function, future))
+        return future
+
+    def RunPendingCalls(self):
+        while len(self.pendingCalls) > 0:
+            function, future = self.pendingCalls.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(function())
+            except Exception as e:
+                future.set_exception(e)
+
+    # Flushes the rig and ticks every running function once. Functions that are woken during the
+    # tick (e.g. because a function they waited for finished) are ticked again straight away.
+    def Tick(self):
+        self.RunPendingCalls()
+        currentTime = self.clock.Time()
+        sequencer = self.rig.sequencer
+        if sequencer is not None and not sequencer.threaded:
+            sequencer.Advance(currentTime)
+        stats = self.stats
+        startTime = time.perf_counter()
+        stats.RecordTickStart(startTime)
+        self.rig.FlushStates()
+        stats.flush.Add(time.perf_counter() - startTime)
+        programs = self.programSource().copy()
+        for x in programs:
+            self.tickStartProgram = x
+            for s in x.asyncFunctions.copy():
+                self.TickOne(x, s, currentTime)
+        for callback in self.tickCallbacks.copy():
+            callback(currentTime)
+
+        # Wake and tick functions whose waits were satisfied during this tick. Each function is
+        # resumed by a wake at most once per tick, so that functions signalling each other back
+        # and forth cannot stall the tick; they continue on the next tick instead.
+        resumed = set()
+        while True:
+            version = StateVersion(self.rig)
+            for x in programs:
+                if len(x.waitingFunctions) > 0:
+                    CheckWaits(x, currentTime, version)
+            if not any(len(x.wokenFunctions) > 0 for x in programs):
+                break
+            for x in programs:
+                self.tickStartProgram = x
+                while len(x.wokenFunctions) > 0:
+                    s = x.wokenFunctions.pop(0)
+                    if (x, s) not in resumed:
+                        resumed.add((x, s))
+                        self.TickOne(x, s, currentTime)
+
+    def TickOne(self, x: CompiledProgram, s: str, currentTime: float):
+        info = x.asyncFunctions.get(s)
+        if info is None or info.paused or info.blocked:
+            return
+        functionStats = self.stats.Function(x.registry.name or "", x.program.name, s)
+        wait = info.yieldedValue
+        if isinstance(wait, ucscript.WaitForSeconds):
+            # Skip functions that are still waiting, so that only ticks that resume the function
+            # are timed.
+            if currentTime - info.lastIterationTime < wait.seconds:
+                return
+            functionStats.lateness.Add(currentTime - info.lastIterationTime - wait.seconds)
+        self.tickStartTime = time.time()
+        self.tickStartFunctionSymbol = s
+        functionStart = time.perf_counter()
+        TickFunction(x, currentTime, s)
+        functionStats.duration.Add(time.perf_counter() - functionStart)
+        self.tickStartTime = None
+
+    # Returns the earliest time at which a running function can make progress, or None if no
+    # function can run (nothing is running or everything is paused).
+    def NextDeadline(self) -> Optional[float]:
+        deadlines = [FunctionDeadline(info) for x in self.programSource() for info in
+                     x.asyncFunctions.copy().values()]
+        sequencer = self.rig.sequencer
+        if sequencer is not None and not sequencer.threaded:
+            deadlines.append(sequencer.NextTime())
+        deadlines = [d for d in deadlines if d is not None]
+        return min(deadlines) if len(deadlines) > 0 else None
+
+    def IsAnythingRunning(self):
+        return any(len(x.asyncFunctions) > 0 for x in self.programSource())
+
+    # Ticks until [isDone] returns True, nothing can run any more, or [maxSeconds] of clock time
+    # (or [maxTicks] ticks) have passed. With a VirtualClock, the clock jumps straight to the next
+    # pending deadline instead of sleeping. Returns True if [isDone] was satisfied.
+    def RunUntil(self, isDone: Callable[[], bool], maxSeconds: Optional[float] = None,
+                 maxTicks: Optional[int] = None):
+        startTime = self.clock.Time()
+        ticks = 0
+        while True:
+            self.Tick()
+            ticks += 1
+            if isDone():
+                return True
+            now = self.clock.Time()
+            if maxSeconds is not None and now - startTime >= maxSeconds:
+                return False
+            if maxTicks is not None and ticks >= maxTicks:
+                return False
+            if isinstance(self.clock, VirtualClock):
+                deadline = self.NextDeadline()
+                if deadline is None:
+                    return False
+                self.clock.AdvanceTo(deadline if deadline > now else now + self.TICK_PERIOD)
+            else:
+                self.clock.Sleep(self.TICK_PERIOD)
+
+
+# The time at which a running function should next be ticked.
+def FunctionDeadline(functionInfo: CompiledProgram.AsyncFunctionInfo) -> Optional[float]:
+    if functionInfo.paused:
+        return None
+    if functionInfo.blocked:
+        return functionInfo.waitDeadline
+    if isinstance(functionInfo.yieldedValue, ucscript.WaitForSeconds):
+        return functionInfo.lastIterationTime + functionInfo.yieldedValue.seconds
+    return -1
@@ -0,0 +1,178 @@
+import sys
+import threading
+import time
+import types
+from typing import Dict, List, Callable, Optional, Set, Any
+
+# Functions of the uChip environment whose code names differ from what scripts call them.
+API_NAMES = {"GetParameterValue": "Parameter.Get", "SetParameterValue": "Parameter.Set",
+             "callOverride": "ProgramFunction.Call"}
+
+
+# Measures where a program's script spends its time: per script line and per call into the uChip
+# API (FindValve, Valve.SetOpen, Parameter.Get, ...). The profiler only traces while the program's
+# own code runs (see Run), so programs that are not profiled are not slowed down at all, and a
+# profiled program pays a fixed cost per executed line and per API call.
+#
+# Line times include everything called from the line, including API calls and other script
+# functions. API call times only count calls made directly from the script.
+class ScriptProfiler:
+    def __init__(self, globalsSource: Callable[[], Optional[Dict]], apiFiles: Set[str],
+                 lineOffset: int = 0):
+        # The script's globals. Frames that run with them are the script's own code.
+        self.globalsSource = globalsSource
+        # The source files of the uChip API.
+        self.apiFiles = apiFiles
+        # How many lines are prepended to the script before it is compiled.
+        self.lineOffset = lineOffset
+
+        # [hits, seconds, function name] by script line number.
+        self.lines: Dict[int, List] = {}
+        # [calls, seconds] by API name.
+        self.apiCalls: Dict[str, List] = {}
+        # Seconds spent running the script under the profiler.
+        self.totalSeconds = 0.0
+        self.runs = 0
+
+        # When each traced script frame got to its current line and that line's stats, and the
+        # name and start of each API call that is in progress.
+        self.frames: Dict[types.FrameType, List] = {}
+        self.apiFrames: Dict[types.FrameType, List] = {}
+        self.apiNames: Dict[types.CodeType, str] = {}
+        self.globals: Optional[Dict] = None
+
+        # Held while adding lines or API names and while taking a snapshot from another thread.
+        self.lock = threading.Lock()
+        self.startTime = time.time()
+
+    # Runs [function] (script code) with tracing on, and returns its result.
+    def Run(self, function: Callable, *args, **kwargs) -> Any:
+        self.globals = self.globalsSource()
+        previousTrace = sys.gettrace()
+        start = time.perf_counter()
+        sys.settrace(self.Trace)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            sys.settrace(previousTrace)
+            self.totalSeconds += time.perf_counter() - start
+            self.runs += 1
+            self.frames.clear()
+            self.apiFrames.clear()
+
+    def Trace(self, frame: types.FrameType, event: str, arg):
+        if event != "call":
+            return None
+        if frame.f_globals is self.globals:
+            self.frames[frame] = [time.perf_counter(),
+                                  self.LineStats(frame.f_lineno, frame.f_code.co_name)]
+            return self.TraceScript
+        caller = frame.f_back
+        if caller is not None and caller.f_globals is self.globals and \
+                frame.f_code.co_filename in self.apiFiles:
+            frame.f_trace_lines = False
+            self.apiFrames[frame] = [self.APIName(frame), time.perf_counter()]
+            return self.TraceAPI
+        return None
+
+    def TraceScript(self, frame: types.FrameType, event: str, arg):
+        now = time.perf_counter()
+        entry = self.frames.get(frame)
+        if entry is None:
+            return self.TraceScript
+        if event == "line" or event == "return":
+            entry[1][1] += now - entry[0]
+            if event == "return":
+                del self.frames[frame]
+            else:
+                stats = self.LineStats(frame.f_lineno, frame.f_code.co_name)
+                stats[0] += 1
+                entry[0] = now
+                entry[1] = stats
+        return self.TraceScript
+
+    def TraceAPI(self, frame: types.FrameType, event: str, arg):
+        if event == "return":
+            entry = self.apiFrames.pop(frame, None)
+            if entry is not None:
+                stats = self.apiCalls.get(entry[0])
+                if stats is None:
+                    with self.lock:
+                        stats = self.apiCalls.setdefault(entry[0], [0, 0.0])
+                stats[0] += 1
+                stats[1] += time.perf_counter() - entry[1]
+        return self.TraceAPI
+
+    # The [hits, seconds, function name] of a line, given its number in the compiled code.
+    def LineStats(self, lineNumber: int, functionName: str) -> List:
+        line = lineNumber - self.lineOffset
+        stats = self.lines.get(line)
+        if stats is None:
+            with self.lock:
+                stats = self.lines.setdefault(line, [0, 0.0, functionName])
+        return stats
+
+    # The name scripts use for the API function running in [frame], e.g. "Valve.SetOpen".
+    def APIName(self, frame: types.FrameType) -> str:
+        code = frame.f_code
+        name = self.apiNames.get(code)
+        if name is not None:
+            return name
+        if code.co_argcount > 0 and code.co_varnames[0] == "self":
+            className = type(frame.f_locals["self"]).__name__
+            if className.startswith("Bound"):
+                className = className[len("Bound"):]
+            name = className if code.co_name == "__init__" else className + "." + code.co_name
+        else:
+            name = API_NAMES.get(code.co_name, code.co_name)
+            for symbol, value in list(self.globals.items()):
+                if getattr(value, "__code__", None) is code:
+                    name = symbol
+                    break
+        with self.lock:
+            self.apiNames[code] = name
+        return name
+
+    def Reset(self):
+        with self.lock:
+            self.lines = {}
+            self.apiCalls = {}
+            self.totalSeconds = 0.0
+            self.runs = 0
+            self.startTime = time.time()
+
+    # A copy of the results, slowest first, that can be turned into JSON.
+    def Snapshot(self) -> Dict:
+        with self.lock:
+            lines = [(line, list(stats)) for line, stats in self.lines.items()]
+            apiCalls = [(name, list(stats)) for name, stats in self.apiCalls.items()]
+            total = self.totalSeconds
+            return {"total": total, "runs": self.runs, "elapsed": time.time() - self.startTime,
+                    "lines": [{"line": line, "function": stats[2], "hits": stats[0],
+                               "seconds": stats[1], "share": stats[1] / total if total > 0 else 0}
+                              for line, stats in sorted(lines, key=lambda x: -x[1][1])],
+                    "api": [{"name": name, "calls": stats[0], "seconds": stats[1],
+                             "share": stats[1] / total if total > 0 else 0}
+                            for name, stats in sorted(apiCalls, key=lambda x: -x[1][1])]}
+
+    # The hotspots as a text table. [scriptLines] is the script's source, to show each line's code.
+    def Table(self, scriptLines: List[str], count: int = 20) -> str:
+        snapshot = self.Snapshot()
+        rows = [("Line", "Function", "Hits", "Total ms", "Per hit us", "Share", "Code")]
+        for line in snapshot["lines"][:count]:
+            code = scriptLines[line["line"] - 1].strip() if \
+                0 < line["line"] <= len(scriptLines) else ""
+            rows.append((str(line["line"]), line["function"], str(line["hits"]),
+                         "%.3f" % (line["seconds"] * 1000),
+                         "%.1f" % (line["seconds"] / max(line["hits"], 1) * 1e6),
+                         "%.1f%%" % (line["share"] * 100), code))
+        rows.append(("", "", "", "", "", "", ""))
+        rows.append(("API call", "", "Calls", "Total ms", "Per call us", "Share", ""))
+        for call in snapshot["api"][:count]:
+            rows.append((call["name"], "", str(call["calls"]), "%.3f" % (call["seconds"] * 1000),
+                         "%.1f" % (call["seconds"] / max(call["calls"], 1) * 1e6),
+                         "%.1f%%" % (call["share"] * 100), ""))
+        widths = [max(len(r[i]) for r in rows) for i in range(len(rows[0]) - 1)] + [0]
+        return "\n".join("  ".join(c.ljust(w) if i in (0, 1, 6) else c.rjust(w)
+                                   for i, (c, w) in enumerate(zip(r, widths))).rstrip()
+                         for r in rows)
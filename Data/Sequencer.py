@@ -0,0 +1,326 @@
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from Data.Clock import VirtualClock
+from Data.Rig import Rig, Device
+from Data.TickStats import DurationHistogram
+
+
+# A pattern table compiled for playback. Identical rows are stored once: [rowStates] holds the
+# solenoid states of each distinct row and [rowFrames] what each distinct row writes to the
+# connected devices, as (device, ((port, mask, bits), ...)) with the device's polarity already
+# applied. Each step of the table refers to a distinct row and has its own duration.
+class Pattern:
+    def __init__(self, numbers: Sequence[int], rows, stepRows: List[int], durations: List[float]):
+        self.numbers = list(numbers)
+        # The distinct rows, as tuples of bools or as a NumPy bool matrix.
+        self.rows = rows
+        self.stepRows = stepRows
+        self.durations = durations
+        self.rowStates: List[Dict[int, bool]] = [dict(zip(self.numbers, row)) for row in
+                                                 (rows.tolist() if hasattr(rows, "tolist")
+                                                  else rows)]
+        self.rowFrames: List[List[Tuple[Device, Tuple[Tuple[int, int, int], ...]]]] = []
+        # The devices that the frames were compiled for (see DeviceLayout).
+        self.layout = None
+
+    def Seconds(self):
+        return sum(self.durations)
+
+
+# Compiles a pattern table for the solenoids [numbers]. Each row of [table] is a sequence with one
+# truthy or falsy entry per solenoid, or an integer with bit i set to open solenoid i. [stepSeconds]
+# is the duration of every step, a sequence with the duration of each step, or None if the last
+# column of the table holds the durations. NumPy arrays and other buffer-protocol objects are
+# converted as a whole, without per-valve Python work.
+def CompilePattern(numbers: Sequence[int], table, stepSeconds: Union[None, float, Sequence[float]]):
+    if not isinstance(table, (list, tuple)):
+        return CompileArrayPattern(numbers, table, stepSeconds)
+    if len(table) == 0:
+        raise Exception("The pattern table is empty.")
+    width = len(numbers) + (1 if stepSeconds is None else 0)
+    rowIndices: Dict[Tuple[bool, ...], int] = {}
+    stepRows = []
+    columnDurations = []
+    for row in table:
+        if isinstance(row, int):
+            if stepSeconds is None:
+                raise Exception("Integer pattern rows need a step duration.")
+            key = tuple(bool((row >> i) & 1) for i in range(len(numbers)))
+        else:
+            row = list(row)
+            if len(row) != width:
+                raise Exception("A pattern row has %d entries for %d valves%s." %
+                                (len(row), len(numbers),
+                                 " and a duration" if stepSeconds is None else ""))
+            if stepSeconds is None:
+                columnDurations.append(row.pop())
+            key = tuple(bool(x) for x in row)
+        stepRows.append(rowIndices.setdefault(key, len(rowIndices)))
+    durations = StepDurations(columnDurations if stepSeconds is None else stepSeconds, len(table))
+    return Pattern(numbers, list(rowIndices), stepRows, durations)
+
+
+def CompileArrayPattern(numbers: Sequence[int], table, stepSeconds):
+    try:
+        import numpy
+    except ImportError:
+        # Without NumPy, buffers are converted to lists.
+        return CompilePattern(numbers, memoryview(table).tolist(), stepSeconds)
+    matrix = numpy.asarray(table)
+    if matrix.ndim == 1 and matrix.dtype.kind in "iu" and stepSeconds is not None:
+        # One integer bitmask per row.
+        matrix = (matrix[:, None] >> numpy.arange(len(numbers))) & 1
+    if matrix.ndim != 2 or len(matrix) == 0:
+        raise Exception("The pattern table must be a non-empty steps x valves matrix.")
+    width = len(numbers) + (1 if stepSeconds is None else 0)
+    if matrix.shape[1] != width:
+        raise Exception("The pattern table has %d columns for %d valves%s." %
+                        (matrix.shape[1], len(numbers),
+                         " and a duration" if stepSeconds is None else ""))
+    if stepSeconds is None:
+        stepSeconds = matrix[:, -1].astype(float).tolist()
+        matrix = matrix[:, :-1]
+    rows, stepRows = numpy.unique(matrix != 0, axis=0, return_inverse=True)
+    return Pattern(numbers, rows, stepRows.reshape(-1).tolist(),
+                   StepDurations(stepSeconds, len(matrix)))
+
+
+def StepDurations(stepSeconds, count: int) -> List[float]:
+    if isinstance(stepSeconds, (int, float)):
+        durations = [float(stepSeconds)] * count
+    else:
+        durations = [float(s) for s in stepSeconds]
+        if len(durations) != count:
+            raise Exception("The pattern has %d rows but %d step durations." %
+                            (count, len(durations)))
+    if any(not d > 0 for d in durations):
+        raise Exception("Pattern steps must last longer than zero seconds.")
+    return durations
+
+
+# Identifies the devices that frames were compiled for. Frames are compiled again when it changes.
+def DeviceLayout(rig: Rig):
+    return tuple((d, d.startNumber, tuple(d.polarities)) for d in rig.allDevices
+                 if d.enabled and d.IsConnected())
+
+
+# Compiles what each distinct row of [pattern] writes to the connected devices of [rig]. The bits
+# of each port are computed a whole column at a time, so the cost grows with the number of valves
+# and not with the number of rows times valves.
+def CompileFrames(pattern: Pattern, rig: Rig):
+    rowCount = len(pattern.rowStates)
+    portColumns = []
+    for device in [d for d in rig.allDevices if d.enabled and d.IsConnected()]:
+        for port in range(3):
+            first = device.startNumber + port * 8
+            pins = [(column, number - first) for column, number in enumerate(pattern.numbers)
+                    if first <= number < first + 8]
+            if len(pins) > 0:
+                portColumns.append((device, port, pins))
+
+    frames: List[Dict[Device, List[Tuple[int, int, int]]]] = [{} for _ in range(rowCount)]
+    for device, port, pins in portColumns:
+        mask = 0
+        for _, pin in pins:
+            mask |= 1 << pin
+        polarity = device.polarities[port]
+        if hasattr(pattern.rows, "shape"):
+            import numpy
+            bits = numpy.zeros(rowCount, dtype=numpy.int64)
+            for column, pin in pins:
+                bits |= (pattern.rows[:, column] != polarity).astype(numpy.int64) << pin
+            bits = bits.tolist()
+        else:
+            bits = [sum(1 << pin for column, pin in pins if row[column] != polarity)
+                    for row in pattern.rows]
+        for frame, rowBits in zip(frames, bits):
+            frame.setdefault(device, []).append((port, mask, rowBits))
+    pattern.rowFrames = [[(device, tuple(ports)) for device, ports in frame.items()]
+                         for frame in frames]
+
+
+# A pattern being played by the sequencer. Playback is controlled from the program thread and
+# advanced by the sequencer.
+class Playback:
+    def __init__(self, pattern: Pattern, repeat: Optional[int] = None):
+        self.pattern = pattern
+        # How many times the table is played (None plays it until stopped).
+        self.repeat = repeat
+        # The duration of each step. Replaced by Sequencer.SetStepSeconds.
+        self.durations = pattern.durations
+
+        self.stepIndex = 0
+        # How many times the whole table has been played.
+        self.passes = 0
+        # When the next step is due, in the sequencer's time.
+        self.nextTime = 0.0
+        # The time left until the next step while paused.
+        self.remaining: Optional[float] = None
+        self.paused = False
+        self.pauseTime: Optional[float] = None
+        self.finished = False
+        # Set if writing a step failed, which ends the playback.
+        self.error: Optional[Exception] = None
+
+        # How late each step was written, and when the playback started and finished.
+        self.lateness = DurationHistogram()
+        self.startTime: Optional[float] = None
+        self.endTime: Optional[float] = None
+        self.pausedSeconds = 0.0
+        self.stepsPlayed = 0
+        # The total duration of the steps that have been played.
+        self.requestedSeconds = 0.0
+
+    # How long the playback has taken so far, not counting pauses.
+    def AchievedSeconds(self) -> float:
+        if self.startTime is None:
+            return 0.0
+        endTime = self.endTime if self.endTime is not None else \
+            self.pauseTime if self.pauseTime is not None else self.nextTime
+        return endTime - self.startTime - self.pausedSeconds
+
+
+# Plays patterns straight into the rig from a dedicated thread, so that steps are written on time
+# regardless of the 10 ms program tick. Each step is a single update of the rig's state table and
+# writes only the device ports it changes. With a VirtualClock (when simulating), no thread is
+# started; the scheduler advances the sequencer every tick instead.
+class Sequencer:
+    # Sleep until this long before a step is due, then spin for the rest.
+    SPIN_SECONDS = 0.001
+
+    def __init__(self, rig: Rig, threaded=True, clock=None):
+        self.rig = rig
+        self.threaded = threaded
+        self.clock = clock
+        self.playbacks: List[Playback] = []
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def Time(self) -> float:
+        return time.perf_counter() if self.threaded else self.clock.Time()
+
+    def Play(self, playback: Playback):
+        for number in playback.pattern.numbers:
+            self.rig.solenoidStates.setdefault(number, False)
+        with self.lock:
+            playback.startTime = playback.nextTime = self.Time()
+            self.playbacks.append(playback)
+        if not self.threaded:
+            self.Advance(playback.startTime)
+        else:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.Run, daemon=True, name="Sequencer")
+                self.thread.start()
+            self.wake.set()
+
+    # Stops a playback. No further steps of it are written once this returns.
+    def Stop(self, playback: Playback):
+        with self.lock:
+            if not playback.finished:
+                playback.finished = True
+                playback.endTime = self.Time()
+            if playback in self.playbacks:
+                self.playbacks.remove(playback)
+
+    def SetPaused(self, playback: Playback, paused: bool):
+        with self.lock:
+            if paused == playback.paused or playback.finished:
+                return
+            now = self.Time()
+            if paused:
+                playback.remaining = max(0.0, playback.nextTime - now)
+                playback.pauseTime = now
+            else:
+                playback.nextTime = now + playback.remaining
+                playback.pausedSeconds += now - playback.pauseTime
+                playback.remaining = None
+                playback.pauseTime = None
+            playback.paused = paused
+        self.wake.set()
+
+    # Gives every step of a playback the duration [seconds]. The step being played keeps its
+    # duration, so the change applies from the next step and the playback does not restart.
+    def SetStepSeconds(self, playback: Playback, seconds: float):
+        durations = StepDurations(seconds, len(playback.pattern.durations))
+        with self.lock:
+            playback.durations = durations
+        self.wake.set()
+
+    # The time the next step is due, or None if nothing is playing.
+    def NextTime(self) -> Optional[float]:
+        times = [p.nextTime for p in self.playbacks if not p.paused]
+        return min(times) if len(times) > 0 else None
+
+    # Writes every step that is due at [now].
+    def Advance(self, now: float):
+        with self.lock:
+            for playback in self.playbacks.copy():
+                try:
+                    while not playback.paused and not playback.finished and \
+                            playback.nextTime <= now:
+                        self.PlayStep(playback, now)
+                except Exception as e:
+                    playback.error = e
+                    playback.finished = True
+                    playback.endTime = now
+                    self.playbacks.remove(playback)
+
+    def PlayStep(self, playback: Playback, now: float):
+        pattern = playback.pattern
+        if playback.stepIndex == len(playback.durations):
+            # The last step has run for its duration.
+            playback.finished = True
+            playback.endTime = now
+            self.playbacks.remove(playback)
+            return
+        rig = self.rig
+        layout = DeviceLayout(rig)
+        if layout != pattern.layout:
+            CompileFrames(pattern, rig)
+            pattern.layout = layout
+        row = pattern.stepRows[playback.stepIndex]
+        with rig.lock:
+            rig.SetSolenoidStates(pattern.rowStates[row])
+            for device, ports in pattern.rowFrames[row]:
+                device.WritePorts(ports)
+            for remote in rig.remoteRigs:
+                remote.Push(rig.solenoidStates, rig.stateVersion)
+        seconds = playback.durations[playback.stepIndex]
+        playback.lateness.Add(now - playback.nextTime)
+        playback.stepsPlayed += 1
+        playback.requestedSeconds += seconds
+        playback.nextTime += seconds
+        playback.stepIndex += 1
+        if playback.stepIndex == len(playback.durations):
+            playback.passes += 1
+            if playback.repeat is None or playback.passes < playback.repeat:
+                playback.stepIndex = 0
+
+    def Run(self):
+        while True:
+            with self.lock:
+                due = self.NextTime()
+            if due is None:
+                self.wake.wait()
+                self.wake.clear()
+                continue
+            delay = due - time.perf_counter()
+            if delay > Sequencer.SPIN_SECONDS:
+                if self.wake.wait(delay - Sequencer.SPIN_SECONDS):
+                    self.wake.clear()
+                continue
+            while time.perf_counter() < due:
+                pass
+            self.Advance(time.perf_counter())
+
+
+# Returns the sequencer of [rig], creating it on first use. It runs its own thread unless [clock]
+# is virtual.
+def GetSequencer(rig: Rig, clock) -> Sequencer:
+    if rig.sequencer is None:
+        virtual = isinstance(clock, VirtualClock)
+        rig.sequencer = Sequencer(rig, not virtual, clock if virtual else None)
+    return rig.sequencer
@@ -0,0 +1,103 @@
+import pathlib
+from pathlib import Path
+from typing import List, Optional, Tuple, Dict
+
+from Data.Chip import Program
+from Data.FileIO import LoadObject
+from Data.ProjectFile import LoadProject
+from Data.ProgramCompilation import ProgramRegistry, CompiledProgram
+from Data.MessageLog import MessageLog
+from Data.Rig import Rig
+from Data.Scheduler import Scheduler
+
+
+# A uChip session without any user interface: the rig, the open chip projects and the scheduler
+# that runs their programs. Nothing here depends on Qt, so it can run on machines without a
+# display.
+#
+# Several projects can be open at once. They share the rig's state table, its flush and the
+# scheduler, which ticks their programs in the order the projects were opened. Each project can be
+# moved along the rig with a solenoid offset, e.g. two copies of a 48-valve chip at offsets 0 and
+# 48 of a 96-channel rig.
+class Session:
+    def __init__(self, devicesPath: Optional[Path] = Path("devices.pkl"), clock=None,
+                 messageCapacity: int = MessageLog.DEFAULT_CAPACITY):
+        self.rig = Rig()
+        # How many messages each program of the open projects keeps.
+        self.messageCapacity = messageCapacity
+        if devicesPath is not None:
+            try:
+                self.rig.allDevices = LoadObject(devicesPath)
+            except EOFError:
+                pass
+            except IOError:
+                pass
+        self.registries: List[ProgramRegistry] = []
+        self.scheduler = Scheduler(self.rig, self.CompiledPrograms, clock)
+
+    # Loads a chip project and compiles all of its programs. Its valve with solenoid number n
+    # drives rig solenoid n + solenoidOffset.
+    def OpenProject(self, path: Path, solenoidOffset: int = 0) -> ProgramRegistry:
+        chip = LoadProject(path)
+        registry = ProgramRegistry(chip, self.rig)
+        registry.clock = self.scheduler.clock
+        registry.messageCapacity = self.messageCapacity
+        registry.name = UniqueProjectName(path.stem, [r.name for r in self.registries])
+        registry.solenoidOffset = solenoidOffset
+        for program in chip.programs:
+            registry.Compile(program)
+        self.registries.append(registry)
+        return registry
+
+    def CompiledPrograms(self) -> List[CompiledProgram]:
+        if len(self.registries) == 1:
+            return self.registries[0].compiledPrograms
+        return [x for registry in self.registries for x in registry.compiledPrograms]
+
+    # Stops the functions of a project and closes it. Must be called on the program thread.
+    def CloseProject(self, registry: ProgramRegistry):
+        registry.StopAll()
+        self.registries.remove(registry)
+
+    # Finds a program by name in any open project. "Project/Program" finds it in the named project.
+    def FindProgram(self, name: str) -> Optional[Tuple[ProgramRegistry, Program]]:
+        return FindProgramIn(self.registries, name)
+
+    def Close(self):
+        self.rig.Disconnect()
+
+
+# Finds a program by name in [registries], in order. "Project/Program" only looks in the project
+# with that name.
+def FindProgramIn(registries: List[ProgramRegistry],
+                  name: str) -> Optional[Tuple[ProgramRegistry, Program]]:
+    projectName, _, programName = name.rpartition("/")
+    for registry in registries:
+        if projectName != "" and registry.name != projectName:
+            continue
+        program = registry.chip.FindProgram(programName)
+        if program is not None:
+            return registry, program
+    return None
+
+
+# [name], or "name (2)", "name (3)"... if it is already taken.
+def UniqueProjectName(name: str, taken: List[Optional[str]]) -> str:
+    unique = name
+    number = 2
+    while unique in taken:
+        unique = "%s (%d)" % (name, number)
+        number += 1
+    return unique
+
+
+# The rig solenoids that valves of more than one open project map to, as
+# {rig solenoid: ["Project: valve", ...]}.
+def SolenoidOverlaps(registries: List[ProgramRegistry]) -> Dict[int, List[str]]:
+    users: Dict[int, Dict[ProgramRegistry, List[str]]] = {}
+    for registry in registries:
+        for valve, number in zip(registry.chip.valves, registry.RigNumbers(registry.chip.valves)):
+            users.setdefault(number, {}).setdefault(registry, []).append(valve.name)
+    return {number: ["%s: %s" % (registry.name, name) for registry, names in byProject.items()
+                     for name in names]
+            for number, byProject in sorted(users.items()) if len(byProject) > 1}
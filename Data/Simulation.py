@@ -0,0 +1,95 @@
+import copy
+from typing import List, Tuple, Optional, Dict, Any
+
+from Data.Chip import Chip, Program
+from Data.ProgramCompilation import ProgramRegistry, Message
+from Data.Rig import Rig
+from Data.Clock import VirtualClock
+from Data.Scheduler import Scheduler
+
+
+# A rig without any hardware that records every solenoid transition and the (virtual) time at
+# which it happened.
+class SimulatedRig(Rig):
+    def __init__(self, clock: VirtualClock):
+        super().__init__()
+        self.clock = clock
+        self.transitions: List[Tuple[float, int, bool]] = []
+
+    def SetSolenoidState(self, number: int, state: bool):
+        if self.GetSolenoidState(number) != state:
+            self.transitions.append((self.clock.Time(), number, state))
+        super().SetSolenoidState(number, state)
+
+    def SetSolenoidStates(self, states: Dict[int, bool]):
+        time = self.clock.Time()
+        self.transitions += [(time, number, state) for number, state in states.items()
+                             if self.GetSolenoidState(number) != state]
+        super().SetSolenoidStates(states)
+
+    def RescanForDevices(self):
+        pass
+
+
+class SimulationResult:
+    def __init__(self):
+        # Every solenoid transition as (seconds from start, solenoid number, state).
+        self.transitions: List[Tuple[float, int, bool]] = []
+
+        # Every message logged by any program as (seconds from start, program name, message).
+        self.messages: List[Tuple[float, str, Message]] = []
+
+        # The simulated time from calling the function until it finished (or the simulation
+        # stopped).
+        self.duration = 0.0
+
+        # False if the function was still running when the simulation stopped.
+        self.finished = False
+
+
+# Runs [functionSymbol] of [program] under a virtual clock against a simulated rig and returns the
+# valve transitions and log output. The chip is copied first, so the simulation never touches the
+# real rig or the project's parameter values. [parameterValues] optionally overrides the program's
+# parameter values, and the simulation gives up after [maxSeconds] of simulated time, [maxTicks]
+# scheduler ticks or [maxTransitions] solenoid transitions. With [copyChip] False, the simulation
+# runs on [chip] itself, which must then be a copy that nothing else uses.
+def Simulate(chip: Chip, program: Program, functionSymbol: str,
+             parameterValues: Optional[Dict[str, Any]] = None,
+             maxSeconds: Optional[float] = 7 * 24 * 60 * 60, maxTicks: Optional[int] = None,
+             initialStates: Optional[Dict[int, bool]] = None,
+             maxTransitions: Optional[int] = None, copyChip: bool = True) -> SimulationResult:
+    simulatedChip = copy.deepcopy(chip) if copyChip else chip
+    simulatedProgram = simulatedChip.programs[chip.programs.index(program)]
+
+    clock = VirtualClock()
+    rig = SimulatedRig(clock)
+    if initialStates is not None:
+        rig.solenoidStates.update(initialStates)
+    registry = ProgramRegistry(simulatedChip, rig)
+    registry.clock = clock
+    for p in simulatedChip.programs:
+        registry.Compile(p)
+    if parameterValues is not None:
+        simulatedProgram.parameterValues.update(parameterValues)
+
+    compiledProgram = registry.Get(simulatedProgram)
+    compileErrors = [m.text for m in compiledProgram.messages if m.messageType == Message.ERROR_CT]
+    if len(compileErrors) > 0:
+        raise Exception("Program '%s' did not compile:\n%s" % (program.name, compileErrors[0]))
+    if functionSymbol not in compiledProgram.programFunctions:
+        raise Exception("Could not find function '%s' in program '%s'" % (functionSymbol,
+                                                                         program.name))
+    compiledProgram.programFunctions[functionSymbol]()
+
+    scheduler = Scheduler(rig, lambda: registry.compiledPrograms, clock)
+    result = SimulationResult()
+    if functionSymbol in compiledProgram.asyncFunctions:
+        scheduler.RunUntil(lambda: functionSymbol not in compiledProgram.asyncFunctions or
+                           (maxTransitions is not None and len(rig.transitions) >= maxTransitions),
+                           maxSeconds, maxTicks)
+    result.finished = functionSymbol not in compiledProgram.asyncFunctions
+    result.duration = clock.Time()
+    result.transitions = rig.transitions
+    result.messages = sorted([(m.timestamp, x.program.name, m) for x in registry.compiledPrograms
+                              for m in x.messages], key=lambda m: (m[0], m[2].sequence))
+    return result
@@ -0,0 +1,139 @@
+import bisect
+import threading
+import time
+from typing import Dict, List, Tuple, Optional
+
+
+# Counts durations into fixed buckets. Recording is a bisect and two additions, so it is cheap
+# enough to run on every tick.
+class DurationHistogram:
+    # Upper bounds of the buckets in seconds. The last bucket holds everything slower.
+    BOUNDS = [0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03, 0.1, 0.3, 1.0]
+
+    def __init__(self):
+        self.counts = [0] * (len(DurationHistogram.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def Add(self, seconds: float):
+        self.counts[bisect.bisect_left(DurationHistogram.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.maximum:
+            self.maximum = seconds
+
+    def Mean(self):
+        return self.total / self.count if self.count > 0 else 0.0
+
+    # The upper bound of the bucket that contains the given fraction of samples (e.g. 0.95).
+    def Percentile(self, fraction: float):
+        if self.count == 0:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(DurationHistogram.BOUNDS, self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.maximum)
+        return self.maximum
+
+    def ToDict(self):
+        return {"count": self.count, "total": self.total, "mean": self.Mean(),
+                "max": self.maximum, "p95": self.Percentile(0.95),
+                "buckets": {("<%g" % b): c for b, c in zip(DurationHistogram.BOUNDS, self.counts)} |
+                {(">=%g" % DurationHistogram.BOUNDS[-1]): self.counts[-1]}}
+
+
+class FunctionStats:
+    def __init__(self):
+        # How long each tick of the function took.
+        self.duration = DurationHistogram()
+
+        # How long after its WaitForSeconds deadline the function was resumed.
+        self.lateness = DurationHistogram()
+
+
+# Always-on timing of the program thread: how long each program function's ticks take, how late
+# waiting functions are resumed and how long flushing the rig takes. Written by the scheduler and
+# read (e.g. by the statistics panel or the control API) from other threads.
+class TickStats:
+    def __init__(self):
+        # By (project name, program name, function symbol), since open projects can have programs
+        # of the same name.
+        self.functions: Dict[Tuple[str, str, str], FunctionStats] = {}
+        self.flush = DurationHistogram()
+
+        # The time between the starts of consecutive ticks, and how much it changed from one tick
+        # to the next.
+        self.period = DurationHistogram()
+        self.jitter = DurationHistogram()
+        self.lastTickStart: Optional[float] = None
+        self.lastPeriod: Optional[float] = None
+        self.startTime = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def Function(self, projectName: str, programName: str, functionSymbol: str) -> FunctionStats:
+        key = (projectName, programName, functionSymbol)
+        stats = self.functions.get(key)
+        if stats is None:
+            with self.lock:
+                stats = self.functions.setdefault(key, FunctionStats())
+        return stats
+
+    def RecordTickStart(self, now: float):
+        if self.lastTickStart is not None:
+            period = now - self.lastTickStart
+            self.period.Add(period)
+            if self.lastPeriod is not None:
+                self.jitter.Add(abs(period - self.lastPeriod))
+            self.lastPeriod = period
+        self.lastTickStart = now
+
+    def Reset(self):
+        with self.lock:
+            self.functions = {}
+            self.flush = DurationHistogram()
+            self.period = DurationHistogram()
+            self.jitter = DurationHistogram()
+            self.lastTickStart = None
+            self.lastPeriod = None
+            self.startTime = time.perf_counter()
+
+    # A copy of the statistics that can be turned into JSON.
+    def Snapshot(self) -> Dict:
+        with self.lock:
+            functions = list(self.functions.items())
+            elapsed = time.perf_counter() - self.startTime
+            return {"elapsed": elapsed,
+                    "period": self.period.ToDict(),
+                    "jitter": self.jitter.ToDict(),
+                    "flush": self.flush.ToDict(),
+                    "functions": [{"project": projectName,
+                                   "program": programName,
+                                   "function": functionSymbol,
+                                   "share": stats.duration.total / elapsed if elapsed > 0 else 0,
+                                   "duration": stats.duration.ToDict(),
+                                   "lateness": stats.lateness.ToDict()}
+                                  for (projectName, programName, functionSymbol), stats in
+                                  functions]}
+
+    # The statistics as a text table, sorted by the share of time used.
+    def Table(self) -> str:
+        snapshot = self.Snapshot()
+        rows = [("Project", "Program", "Function", "Ticks", "Mean ms", "p95 ms", "Max ms",
+                 "Late ms", "Share")]
+        rows += [(f["project"], f["program"], f["function"], str(f["duration"]["count"]),
+                  "%.3f" % (f["duration"]["mean"] * 1000), "%.3f" % (f["duration"]["p95"] * 1000),
+                  "%.3f" % (f["duration"]["max"] * 1000), "%.3f" % (f["lateness"]["mean"] * 1000),
+                  "%.2f%%" % (f["share"] * 100))
+                 for f in sorted(snapshot["functions"], key=lambda f: -f["share"])]
+        flush = snapshot["flush"]
+        rows.append(("", "(rig)", "FlushStates", str(flush["count"]),
+                     "%.3f" % (flush["mean"] * 1000), "%.3f" % (flush["p95"] * 1000),
+                     "%.3f" % (flush["max"] * 1000), "",
+                     "%.2f%%" % (flush["total"] / snapshot["elapsed"] * 100
+                                 if snapshot["elapsed"] > 0 else 0)))
+        widths = [max(len(r[i]) for r in rows) for i in range(len(rows[0]))]
+        return "\n".join("  ".join(c.ljust(w) if i < 3 else c.rjust(w)
+                                   for i, (c, w) in enumerate(zip(r, widths))) for r in rows)
@@ -0,0 +1,158 @@
+import concurrent.futures
+import copy
+import hashlib
+import threading
+from typing import List, Tuple, Optional, Dict, Any
+
+from Data.Chip import Chip, Program, Valve
+from Data.MessageLog import Message
+from Data.Simulation import Simulate
+
+
+# The valve-state timeline of a program function, estimated by running it under a simulated
+# clock.
+class Timeline:
+    def __init__(self):
+        # The first solenoid transitions as (seconds from start, solenoid number, state), at most
+        # MAX_TRANSITIONS of them.
+        self.transitions: List[Tuple[float, int, bool]] = []
+
+        # Chip valve names for each solenoid number that appears in the transitions.
+        self.valveNames: Dict[int, str] = {}
+
+        self.duration = 0.0
+        self.transitionCount = 0
+        self.peakOpenValves = 0
+
+        # False if the function did not finish within the simulation limits, in which case the
+        # duration and the number of valve changes are only lower bounds.
+        self.finished = False
+
+        # Errors raised by the function (or any program it used) during the dry-run.
+        self.errors: List[str] = []
+
+    def Summary(self):
+        if self.finished:
+            text = "Estimated duration: %s" % FormatDuration(self.duration)
+            text += "\n%d valve changes" % self.transitionCount
+        else:
+            text = "Estimated duration: > %s" % FormatDuration(self.duration)
+            text += "\n> %d valve changes" % self.transitionCount
+        text += ", at most %d valves open at once" % self.peakOpenValves
+        if len(self.errors) > 0:
+            text += "\n%d error(s) during the dry-run:\n%s" % (len(self.errors), self.errors[0])
+        return text
+
+
+# Dry-runs are cached per (function, the scripts and parameter values of every program of the chip,
+# valve numbering), since a function can call or wait for the other programs. The transitions of
+# each are bounded by MAX_TRANSITIONS, so the cache stays small however long the functions run.
+_cache: Dict[Any, Timeline] = {}
+_CACHE_SIZE = 64
+_cacheLock = threading.Lock()
+
+# Estimates requested with EstimateInBackground run one at a time on this thread pool.
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                  thread_name_prefix="Timeline estimates")
+_pending: Dict[Any, concurrent.futures.Future] = {}
+
+# Dry-runs stop after this many ticks or valve changes. Functions that never finish, such as the
+# pump, are reported as running for longer than the time simulated until then.
+MAX_TICKS = 20000
+MAX_TRANSITIONS = 2000
+
+
+def TimelineKey(chip: Chip, program: Program, functionSymbol: str, maxSeconds: float,
+                maxTicks: int, maxTransitions: int):
+    programs = tuple((p.name, hashlib.sha1(p.script.Read().encode()).hexdigest(),
+                      ParameterKey(p.parameterValues)) for p in chip.programs)
+    return (chip.programs.index(program), functionSymbol, programs,
+            tuple((v.name, v.solenoidNumber) for v in chip.valves), maxSeconds, maxTicks,
+            maxTransitions)
+
+
+# Dry-runs [functionSymbol] of [program] under a simulated clock and returns its timeline. The
+# simulation starts with every solenoid closed and gives up after [maxSeconds] of simulated time,
+# [maxTicks] ticks or [maxTransitions] valve changes, which bounds the cost of functions that never
+# finish. With [copyChip] False, [chip] must be a copy that nothing else uses (see
+# EstimateInBackground).
+def EstimateTimeline(chip: Chip, program: Program, functionSymbol: str,
+                     maxSeconds: float = 7 * 24 * 60 * 60, maxTicks: int = MAX_TICKS,
+                     maxTransitions: int = MAX_TRANSITIONS, copyChip: bool = True,
+                     key=None) -> Timeline:
+    if key is None:
+        key = TimelineKey(chip, program, functionSymbol, maxSeconds, maxTicks, maxTransitions)
+    with _cacheLock:
+        if key in _cache:
+            return _cache[key]
+
+    result = Simulate(chip, program, functionSymbol, maxSeconds=maxSeconds, maxTicks=maxTicks,
+                      maxTransitions=maxTransitions, copyChip=copyChip)
+    timeline = Timeline()
+    timeline.transitions = result.transitions[:maxTransitions]
+    timeline.transitionCount = len(result.transitions)
+    timeline.duration = result.duration
+    timeline.finished = result.finished
+    timeline.errors = [m.text for _, _, m in result.messages if m.messageType != Message.MESSAGE]
+    valveNames = {}
+    for v in chip.valves:
+        valveNames.setdefault(v.solenoidNumber, v.name)
+    timeline.valveNames = {n: valveNames[n] for _, n, _ in timeline.transitions if n in valveNames}
+
+    openValves = set()
+    for _, number, state in result.transitions:
+        openValves.add(number) if state else openValves.discard(number)
+        timeline.peakOpenValves = max(timeline.peakOpenValves, len(openValves))
+
+    with _cacheLock:
+        if len(_cache) >= _CACHE_SIZE:
+            del _cache[next(iter(_cache))]
+        _cache[key] = timeline
+    return timeline
+
+
+# Like EstimateTimeline, but the dry-run happens on a background thread. The chip is copied first,
+# on the calling thread, which must be the one that changes the chip. Returns a future that is
+# already done if the estimate is cached, and the same future while an estimate is pending.
+def EstimateInBackground(chip: Chip, program: Program,
+                         functionSymbol: str) -> concurrent.futures.Future:
+    key = TimelineKey(chip, program, functionSymbol, 7 * 24 * 60 * 60, MAX_TICKS,
+                      MAX_TRANSITIONS)
+    with _cacheLock:
+        if key in _cache:
+            future = concurrent.futures.Future()
+            future.set_result(_cache[key])
+            return future
+        if key in _pending:
+            return _pending[key]
+    snapshot = copy.deepcopy(chip)
+    snapshotProgram = snapshot.programs[chip.programs.index(program)]
+    with _cacheLock:
+        future = _executor.submit(EstimateTimeline, snapshot, snapshotProgram, functionSymbol,
+                                  copyChip=False, key=key)
+        _pending[key] = future
+
+    def Forget(_):
+        with _cacheLock:
+            _pending.pop(key, None)
+    future.add_done_callback(Forget)
+    return future
+
+
+# A hashable summary of parameter values. Valves and programs are summarized by name (and solenoid
+# number) since the simulation runs on a copy of the chip.
+def ParameterKey(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, ParameterKey(v)) for k, v in value.items()))
+    if isinstance(value, list):
+        return tuple(ParameterKey(v) for v in value)
+    if isinstance(value, Valve):
+        return "valve", value.name, value.solenoidNumber
+    if isinstance(value, Program):
+        return "program", value.name
+    return value
+
+
+def FormatDuration(seconds: float):
+    seconds = round(seconds)
+    return "%d:%02d:%02d" % (seconds // 3600, (seconds // 60) % 60, seconds % 60)
@@ -0,0 +1,101 @@
+import collections
+import time
+from typing import Dict, List, Iterable, Optional, Any, Deque, Tuple, Sequence
+
+
+# Solenoids claimed by one running function.
+class Lease:
+    def __init__(self, owner: Any, label: str):
+        # The running function (its AsyncFunctionInfo) and a name for it, e.g. "Pump.RunPump".
+        self.owner = owner
+        self.label = label
+        self.numbers = set()
+
+
+# Tracks which running function owns which solenoids of a rig. A solenoid that is claimed by one
+# function cannot be set by any other function until the claim is released, so that programs
+# running side by side on one rig cannot fight over a valve. Unclaimed solenoids can be set by
+# anyone, as before.
+#
+# The table is only used from the program thread. [currentOwner] is the function whose code is
+# running at the moment; the scheduler sets it while ticking a function or calling its callbacks.
+class LeaseTable:
+    MAX_CONFLICTS = 100
+
+    def __init__(self):
+        self.leases: Dict[Any, Lease] = {}
+        self.owners: Dict[int, Lease] = {}
+
+        # The claimed solenoids as a bitmask (bit n is solenoid n), for a quick check on writes.
+        self.leasedMask = 0
+
+        # Incremented whenever a claim is released, so that waiting claims are retried.
+        self.version = 0
+
+        self.currentOwner = None
+
+        # The most recent rejected writes and claims as (time, writer, owner, solenoid number).
+        self.conflicts: Deque[Tuple[float, str, str, int]] = \
+            collections.deque(maxlen=LeaseTable.MAX_CONFLICTS)
+
+    # Claims [numbers] for [owner]. Returns the leases of other owners that hold any of them, in
+    # which case nothing is claimed.
+    def Acquire(self, owner: Any, label: str, numbers: Iterable[int]) -> List[Lease]:
+        numbers = set(numbers)
+        conflicts = self.Conflicts(owner, numbers)
+        if len(conflicts) > 0:
+            return conflicts
+        lease = self.leases.get(owner)
+        if lease is None:
+            lease = self.leases[owner] = Lease(owner, label)
+        lease.numbers |= numbers
+        for number in numbers:
+            self.owners[number] = lease
+            self.leasedMask |= 1 << number
+        return []
+
+    # The leases of owners other than [owner] that hold any of [numbers].
+    def Conflicts(self, owner: Any, numbers: Iterable[int]) -> List[Lease]:
+        conflicts = []
+        for number in numbers:
+            lease = self.owners.get(number)
+            if lease is not None and lease.owner is not owner and lease not in conflicts:
+                conflicts.append(lease)
+        return conflicts
+
+    # Releases [numbers] (or all solenoids if None) claimed by [owner].
+    def Release(self, owner: Any, numbers: Optional[Iterable[int]] = None):
+        lease = self.leases.get(owner)
+        if lease is None:
+            return
+        released = lease.numbers if numbers is None else lease.numbers & set(numbers)
+        for number in released:
+            del self.owners[number]
+            self.leasedMask &= ~(1 << number)
+        lease.numbers = lease.numbers - released
+        if len(lease.numbers) == 0:
+            del self.leases[owner]
+        if len(released) > 0:
+            self.version += 1
+
+    # Raises an exception if any of [numbers] is claimed by a function other than the current one.
+    # [names] are the valve names to report, in the same order.
+    def CheckWrite(self, numbers: Sequence[int], names: Sequence[str]):
+        owner = self.currentOwner
+        for number, name in zip(numbers, names):
+            lease = self.owners.get(number)
+            if lease is not None and lease.owner is not owner:
+                writer = getattr(owner, "label", "a function that is not running")
+                self.conflicts.append((time.time(), writer, lease.label, number))
+                raise Exception("Valve '%s' is claimed by %s." % (name, lease.label))
+
+    # Records that [writer] could not claim [numbers] because of [conflicts].
+    def RecordConflicts(self, writer: str, numbers: Iterable[int], conflicts: List[Lease]):
+        now = time.time()
+        for lease in conflicts:
+            for number in sorted(lease.numbers.intersection(numbers)):
+                self.conflicts.append((now, writer, lease.label, number))
+
+    def Summary(self) -> List[Dict]:
+        return [{"owner": lease.label, "solenoids": sorted(lease.numbers)} for lease in
+                list(self.leases.values())]
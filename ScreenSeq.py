@@ -2,39 +2,39 @@ from ucscript import *
 
 class Chip: 
     def __init__(self):
-        self.reagentValves = [FindValve("R"+str(i+1)) for i in range(8)]
-        self.vehicleValves = [FindValve("V"+str(i+1)) for i in range(8)]
+        self.reagentValves = FindValves(["R"+str(i+1) for i in range(8)])
+        self.vehicleValves = FindValves(["V"+str(i+1) for i in range(8)])
         self.sampleValve = FindValve("Sample")
         self.oilValve = FindValve("Oil")
         self.keepValve = FindValve("Keep")
         self.discardValve = FindValve("Discard")
-        self.allValves = self.reagentValves+self.vehicleValves+[self.sampleValve,self.oilValve,self.keepValve,self.discardValve]
+        self.allValves = FindValves(self.reagentValves, self.vehicleValves, self.sampleValve, self.oilValve, self.keepValve, self.discardValve)
 
 @display("Full Seal")
 def FullSeal():
     chip = Chip()
-    [valve.Close() for valve in chip.allValves]
+    chip.allValves.CloseAll()
 
 @display("Close All Inlets")
 def CloseAllInlets():
     chip = Chip()
-    [valve.Close() for valve in chip.allValves]
+    chip.allValves.CloseAll()
     chip.discardValve.Open()
 
 
 @display("Debubble")
 def Debubble():
     chip = Chip()
-    [valve.Close() for valve in chip.allValves]
+    chip.allValves.CloseAll()
     chip.discardValve.Open()
-    [valve.Open() for valve in chip.vehicleValves]
+    chip.vehicleValves.OpenAll()
     yield WaitForSeconds(2)
     chip.discardValve.Close()
 
 @display("Droplet Calibration")
 def DropletCalibration():
     chip = Chip()
-    [valve.Close() for valve in chip.allValves]
+    chip.allValves.CloseAll()
     chip.sampleValve.Open()
     chip.oilValve.Open()
     chip.discardValve.Open()
@@ -43,7 +43,7 @@ def DropletCalibration():
 @display("Droplet Calibration")
 def DropletCalibration():
     chip = Chip()
-    [valve.Close() for valve in chip.allValves]
+    chip.allValves.CloseAll()
     chip.sampleValve.Open()
     chip.oilValve.Open()
     chip.discardValve.Open()
@@ -76,8 +76,6 @@ class ChipView(QWidget):
         self.toolOptions.setLayout(toolOptionsLayout)
         toolPanelLayout.addWidget(self.toolOptions)
 
-        self.scriptBrowser = ScriptBrowser(self)
-
         self.SetEditing(True)
 
     def resizeEvent(self, event):
@@ -105,7 +103,7 @@ class ChipView(QWidget):
         newValve = Valve()
         newValve.name = "Valve " + str(highestValveNumber + 1)
         newValve.solenoidNumber = highestValveNumber + 1
-        UIMaster.Instance().currentChip.valves.append(newValve)
+        UIMaster.Instance().currentChip.AddValve(newValve)
         newValveItem = ValveItem.ValveItem(newValve)
         self.graphicsView.AddItems([newValveItem])
         self.graphicsView.CenterItem(newValveItem)
@@ -137,7 +135,7 @@ class ChipView(QWidget):
     def AddProgram(self, script: Script):
         newProgram = Program(script)
         newProgram.name = script.Name()
-        UIMaster.Instance().currentChip.programs.append(newProgram)
+        UIMaster.Instance().currentChip.AddProgram(newProgram)
         newProgramItem = ProgramItem.ProgramItem(newProgram)
         self.graphicsView.AddItems([newProgramItem])
         self.graphicsView.CenterItem(newProgramItem)
@@ -146,8 +144,10 @@ class ChipView(QWidget):
     def ShowProgramBrowser(self):
         ScriptBrowser.Instance().Show(self.AddProgram)
 
+    # Takes the chip's items out of the editor. The chip itself is not changed, so that it can keep
+    # running in the background.
     def CloseChip(self):
-        self.graphicsView.Clear()
+        self.graphicsView.Clear(removeFromChip=False)
 
     def OpenChip(self):
         imageItems = [ImageItem.ImageItem(image) for image in
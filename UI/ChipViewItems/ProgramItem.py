@@ -1,11 +1,14 @@
+import collections
+import concurrent.futures
+import time
 import traceback
 import typing
 import pathlib
 from PySide6.QtWidgets import QWidget, QVBoxLayout, QPushButton, QLabel, QFormLayout, QLineEdit, \
     QSpinBox, QDoubleSpinBox, QComboBox, QFileDialog, QGridLayout, QHBoxLayout, QScrollArea, QFrame, QSizePolicy, \
-    QCheckBox
+    QCheckBox, QToolTip
 from PySide6.QtCore import QRectF, Signal, Qt
-from PySide6.QtGui import QIcon, QColor, QPixmap
+from PySide6.QtGui import QIcon, QColor, QPixmap, QCursor
 
 import ucscript
 from UI.UIMaster import UIMaster
@@ -13,7 +16,11 @@ from UI.CustomGraphicsView import CustomGraphicsViewItem
 from UI.ScriptBrowser import ScriptBrowser
 from Data.Chip import Program, Script
 from Data.ProgramCompilation import IsTypeValidList, IsTypeValidOptions, DoTypesMatch, \
-    NoneValueForType, Message
+    NoneValueForType, SetProfiling
+from Data.MessageLog import Message, MessageLog
+from Data.Timeline import EstimateInBackground
+from Data.BuiltinScripts import IsShippedBuiltin
+from UI.ProfileView import ProfileView
 
 
 class ColoredIcon(QIcon):
@@ -34,6 +41,9 @@ class ProgramItem(CustomGraphicsViewItem):
 
         self.program = program
 
+        # Duration estimates that are being computed, by function index (see ShowEstimate).
+        self.estimates: typing.Dict[int, concurrent.futures.Future] = {}
+
         # Set up the inspector for this item:
         inspectorWidget = QWidget()
         inspectorWidget.setStyleSheet("""
@@ -80,6 +90,17 @@ class ProgramItem(CustomGraphicsViewItem):
         self.hideMessages.currentIndexChanged.connect(self.RecordChanges)
         nameAndSourceLayout.addRow("Log", self.hideMessages)
 
+        # Profiler toggle, with a button to show where the script spends its time.
+        self.profileToggle = QCheckBox("Time each line")
+        self.profileToggle.toggled.connect(self.SetProfiling)
+        self.showProfileButton = QPushButton("Hotspots...")
+        self.showProfileButton.clicked.connect(self.ShowProfile)
+        self.profileView: typing.Optional[ProfileView] = None
+        profileLayout = QHBoxLayout()
+        profileLayout.addWidget(self.profileToggle, stretch=1)
+        profileLayout.addWidget(self.showProfileButton, stretch=0)
+        nameAndSourceLayout.addRow("Profile", profileLayout)
+
         dummyWidget = QWidget()
         inspectorWidget.layout().addWidget(dummyWidget)
         dummyWidget.setFixedHeight(5)
@@ -183,7 +204,19 @@ class ProgramItem(CustomGraphicsViewItem):
 
     def ClearMessages(self):
         compiled = UIMaster.GetCompiledProgram(self.program)
-        compiled.messages = [m for m in compiled.messages if m.messageType == Message.ERROR_CT]
+        compiled.messages.RemoveWhere(lambda m: m.messageType != Message.ERROR_CT)
+
+    def SetProfiling(self, enabled: bool):
+        if self.isUpdating:
+            return
+        SetProfiling(UIMaster.GetCompiledProgram(self.program), enabled)
+
+    def ShowProfile(self):
+        if self.profileView is None:
+            self.profileView = ProfileView(UIMaster.Instance().topLevel,
+                                           UIMaster.GetCompiledProgram(self.program))
+        self.profileView.show()
+        self.profileView.raise_()
 
     def SetEnabled(self, state):
         for c in self.itemProxy.widget().children():
@@ -226,6 +259,8 @@ class ProgramItem(CustomGraphicsViewItem):
             self.nameWidget.setText("<b>%s</b>" % self.program.name)
         if self.program.script.isBuiltIn:
             fullPath = self.program.script.Name() + " <i>[BUILTIN]</i>"
+            if not IsShippedBuiltin(self.program.script):
+                fullPath += " <i>(saved with project)</i>"
             displayPath = fullPath
         else:
             fullPath = str(self.program.script.path.absolute())
@@ -244,12 +279,15 @@ class ProgramItem(CustomGraphicsViewItem):
             self.hideMessages.setCurrentIndex(int(self.program.hideMessages))
         self.messageArea.setVisible(not self.program.hideMessages)
         self.clearMessagesButton.setVisible(not self.program.hideMessages)
+        if self.profileToggle.isChecked() != (compiled.profiler is not None):
+            self.profileToggle.setChecked(compiled.profiler is not None)
 
 
         # Update the parameter and function widgets. These are complicated, so they have their own
         # methods for clarity.
         self.UpdateParameters()
         self.UpdateFunctions()
+        self.UpdateEstimates()
 
         self.itemProxy.adjustSize()
         self.itemProxy.setScale(self.program.scale)
@@ -357,6 +395,7 @@ class ProgramItem(CustomGraphicsViewItem):
             self.functionsLayout.addWidget(newSet.pauseButton, index, 7)
             self.functionsLayout.addWidget(newSet.resumeButton, index, 7)
             newSet.startButton.clicked.connect(lambda: self.StartFunction(index))
+            newSet.startButton.onHovered = lambda: self.ShowEstimate(index)
             newSet.stopButton.clicked.connect(
                 lambda: compiled.programFunctions[compiled.showableFunctions[index]].Stop())
             newSet.pauseButton.clicked.connect(
@@ -377,7 +416,15 @@ class ProgramItem(CustomGraphicsViewItem):
                                                      self.functionWidgetSets):
             functionWidgetSet.startButton.setText(
                 compiled.programFunctions[functionSymbol].functionName)
-            functionWidgetSet.label.setText(compiled.programFunctions[functionSymbol].functionName)
+            if functionSymbol in compiled.staleFunctions:
+                # The script was changed while this function was running.
+                functionWidgetSet.label.setText(
+                    compiled.programFunctions[functionSymbol].functionName + " <i>(modified)</i>")
+                functionWidgetSet.label.setToolTip("The script was modified while this function was "
+                                                   "running. Stop and restart it to apply the changes.")
+            else:
+                functionWidgetSet.label.setText(compiled.programFunctions[functionSymbol].functionName)
+                functionWidgetSet.label.setToolTip("")
             functionWidgetSet.startButton.setVisible(functionSymbol not in compiled.asyncFunctions)
             functionWidgetSet.label.setVisible(functionSymbol in compiled.asyncFunctions)
             functionWidgetSet.stopButton.setVisible(functionSymbol in compiled.asyncFunctions)
@@ -388,6 +435,40 @@ class ProgramItem(CustomGraphicsViewItem):
                                                       compiled.asyncFunctions[
                                                           functionSymbol].paused)
 
+    # Dry-runs the function under a simulated clock on a background thread. The estimated duration
+    # and valve usage are shown on the start button once they are known (see UpdateEstimates).
+    def ShowEstimate(self, index):
+        compiled = UIMaster.GetCompiledProgram(self.program)
+        if index >= len(compiled.showableFunctions):
+            return
+        try:
+            self.estimates[index] = EstimateInBackground(UIMaster.Instance().currentChip,
+                                                         self.program,
+                                                         compiled.showableFunctions[index])
+        except Exception as e:
+            self.functionWidgetSets[index].startButton.setToolTip("Could not estimate: %s" % e)
+            return
+        self.UpdateEstimates()
+
+    def UpdateEstimates(self):
+        for index, future in list(self.estimates.items()):
+            if index >= len(self.functionWidgetSets):
+                del self.estimates[index]
+                continue
+            button = self.functionWidgetSets[index].startButton
+            if not future.done():
+                if button.toolTip() != "Estimating...":
+                    button.setToolTip("Estimating...")
+                continue
+            del self.estimates[index]
+            try:
+                text = future.result().Summary()
+            except Exception as e:
+                text = "Could not estimate: %s" % e
+            button.setToolTip(text)
+            if button.underMouse():
+                QToolTip.showText(QCursor.pos(), text, button)
+
     def StartFunction(self, index):
         compiled = UIMaster.GetCompiledProgram(self.program)
         compiled.programFunctions[compiled.showableFunctions[index]]()
@@ -399,7 +480,7 @@ class ProgramItem(CustomGraphicsViewItem):
         newProgram.parameterValues = self.program.parameterValues.copy()
         newProgram.parameterVisibility = self.program.parameterVisibility.copy()
         newProgram.hideMessages = self.program.hideMessages
-        UIMaster.Instance().currentChip.programs.append(newProgram)
+        UIMaster.Instance().currentChip.AddProgram(newProgram)
         UIMaster.Instance().modified = True
         return ProgramItem(newProgram)
 
@@ -411,8 +492,13 @@ class ProgramItem(CustomGraphicsViewItem):
         self.UpdateGeometry()
         self.RecordChanges()
 
+    def OnDetached(self):
+        if self.profileView is not None:
+            self.profileView.close()
+
     def OnRemoved(self):
-        UIMaster.Instance().currentChip.programs.remove(self.program)
+        self.OnDetached()
+        UIMaster.Instance().currentChip.RemoveProgram(self.program)
         UIMaster.Instance().RemoveProgram(self.program)
         UIMaster.Instance().modified = True
         return True
@@ -446,7 +532,7 @@ class ParameterWidgetSet:
 # Convenience structure that stores the widgets for a single program function.
 class FunctionWidgetSet:
     def __init__(self):
-        self.startButton = QPushButton()
+        self.startButton = HoverButton()
         self.label = QLabel()
         self.stopButton = QPushButton("Stop")
         self.stopButton.setSizePolicy(QSizePolicy.Policy.MinimumExpanding, QSizePolicy.Policy.MinimumExpanding)
@@ -497,6 +583,17 @@ class FunctionWidgetSet:
         self.stopButton.deleteLater()
         self.label.deleteLater()
 
+# A push button that calls [onHovered] when the mouse enters it, before its tooltip is shown.
+class HoverButton(QPushButton):
+    def __init__(self):
+        super().__init__()
+        self.onHovered = lambda: None
+
+    def enterEvent(self, event) -> None:
+        self.onHovered()
+        super().enterEvent(event)
+
+
 # Control widget for a UI-editable parameter.
 class ParameterValueWidget(QWidget):
     OnValueChanged = Signal()
@@ -648,32 +745,47 @@ class MessageArea(QScrollArea):
         scrollContents.setLayout(self.messageLayout)
 
         self.verticalScrollBar().rangeChanged.connect(self.ScrollToBottom)
-        self.lastMessages = None
-        self.labels = []
-        self.Update([])
+        self.lastLog: typing.Optional[MessageLog] = None
+        self.lastResetCount = 0
+        self.nextSequence = 0
+        self.labels: typing.Deque[typing.Tuple[int, QLabel]] = collections.deque()
+        self.maxWidth = 200
+        self.setMinimumWidth(self.maxWidth)
 
     def ScrollToBottom(self):
         self.verticalScrollBar().setValue(self.verticalScrollBar().maximum())
 
-    def Update(self, messages):
-        if messages == self.lastMessages:
+    # Only messages that are new since the last update are added. Labels for messages that have
+    # dropped out of the bounded log are removed.
+    def Update(self, messages: MessageLog):
+        if messages is not self.lastLog or messages.resetCount != self.lastResetCount:
+            [label.deleteLater() for _, label in self.labels]
+            self.labels.clear()
+            self.lastLog = messages
+            self.lastResetCount = messages.resetCount
+            self.nextSequence = 0
+            self.maxWidth = 200
+
+        newMessages = messages.Since(self.nextSequence)
+        if len(newMessages) == 0:
             return
+        self.nextSequence = newMessages[-1].sequence + 1
 
-        [label.deleteLater() for label in self.labels]
-        self.labels = []
-        self.lastMessages = messages.copy()
-
-        maxWidth = 200
-        for i, message in enumerate(self.lastMessages):
+        for message in newMessages:
             newEntry = QLabel(message.text)
+            newEntry.setToolTip(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(message.timestamp)))
             if message.messageType == Message.MESSAGE:
-                bgColor = "#FFFFFF" if i % 2 == 0 else "#CCCCCC"
+                bgColor = "#FFFFFF" if message.sequence % 2 == 0 else "#CCCCCC"
             else:
-                bgColor = "#FFCCCC" if i % 2 == 0 else "#FFAAAA"
+                bgColor = "#FFCCCC" if message.sequence % 2 == 0 else "#FFAAAA"
             newEntry.setStyleSheet("""
             padding: 5px;
             background-color: """ + bgColor)
-            self.labels.append(newEntry)
+            self.labels.append((message.sequence, newEntry))
             self.messageLayout.addWidget(newEntry)
-            maxWidth = max(maxWidth, newEntry.sizeHint().width())
-        self.setMinimumWidth(maxWidth)
+            self.maxWidth = max(self.maxWidth, newEntry.sizeHint().width())
+
+        oldest = messages.OldestSequence()
+        while len(self.labels) > 0 and self.labels[0][0] < oldest:
+            self.labels.popleft()[1].deleteLater()
+        self.setMinimumWidth(self.maxWidth)
@@ -87,10 +87,9 @@ class ValveItem(CustomGraphicsViewItem):
         super().SetRect(rect)
         self.RecordChanges()
 
-    # Called when the valve is removed from the scene (either by the user or through loading a new
-    # chip project.
+    # Called when the user deletes the valve from the scene.
     def OnRemoved(self) -> bool:
-        UIMaster.Instance().currentChip.valves.remove(self.valve)
+        UIMaster.Instance().currentChip.RemoveValve(self.valve)
         UIMaster.Instance().modified = True
         return True
 
@@ -109,14 +108,14 @@ class ValveItem(CustomGraphicsViewItem):
         else:
             newValve.name = self.valve.name
             newValve.solenoidNumber = highestValveNumber + 1
-        UIMaster.Instance().currentChip.valves.append(newValve)
+        UIMaster.Instance().currentChip.AddValve(newValve)
         UIMaster.Instance().modified = True
         return ValveItem(newValve)
 
     def Toggle(self):
         r = UIMaster.Instance().rig
-        r.SetSolenoidState(self.valve.solenoidNumber,
-                           not r.GetSolenoidState(self.valve.solenoidNumber))
+        number = self.valve.solenoidNumber + UIMaster.Instance().programs.solenoidOffset
+        r.SetSolenoidState(number, not r.GetSolenoidState(number))
 
     def RecordChanges(self):
         if self.isUpdating:
@@ -142,7 +141,8 @@ class ValveItem(CustomGraphicsViewItem):
         font = Utilities.ComputeAutofit(self.valveWidget.font(), r, self.valveWidget.text())
         if self.valveWidget.font().pixelSize() != font.pixelSize():
             self.valveWidget.setFont(font)
-        currentState = UIMaster.Instance().rig.GetSolenoidState(self.valve.solenoidNumber)
+        currentState = UIMaster.Instance().rig.GetSolenoidState(
+            self.valve.solenoidNumber + UIMaster.Instance().programs.solenoidOffset)
         if currentState != self._displayState:
             self._displayState = currentState
             self.valveWidget.setStyleSheet(valveOpenStyle if currentState else valveClosedStyle)
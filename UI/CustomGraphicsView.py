@@ -68,7 +68,13 @@ class CustomGraphicsViewItem:
             self.inspectorProxy.setPos(rect.topLeft() - QPointF(0,
                                                                 self.inspectorProxy.sceneBoundingRect().height()))
 
+    # Called when the user deletes the item. Removes what it shows from the chip.
     def OnRemoved(self):
+        self.OnDetached()
+
+    # Called when the item is taken out of the view but what it shows stays in the chip, e.g. when
+    # its project moves to the background.
+    def OnDetached(self):
         pass
 
     def Duplicate(self) -> 'CustomGraphicsViewItem':
@@ -151,8 +157,10 @@ class CustomGraphicsView(QGraphicsView):
         self.updateTimer.timeout.connect(self.Update)
         self.updateTimer.start(100)
 
-    def Clear(self):
-        self.DeleteItems(self.allItems.copy())
+    # Removes every item. If [removeFromChip] is False, the items only leave the view and what they
+    # show is kept in the chip.
+    def Clear(self, removeFromChip: bool = True):
+        self.DeleteItems(self.allItems.copy(), removeFromChip)
 
     def Update(self):
         self.UpdateSelectionDisplay()
@@ -344,13 +352,16 @@ class CustomGraphicsView(QGraphicsView):
         r.moveTopLeft(self.SnapPoint(r.topLeft()))
         item.SetRect(r)
 
-    def DeleteItems(self, items: List[CustomGraphicsViewItem]):
+    def DeleteItems(self, items: List[CustomGraphicsViewItem], removeFromChip: bool = True):
         for i in items:
             self.allItems.remove(i)
             self.scene().removeItem(i.borderRectItem)
             self.scene().removeItem(i.itemProxy)
             self.scene().removeItem(i.inspectorProxy)
-            i.OnRemoved()
+            if removeFromChip:
+                i.OnRemoved()
+            else:
+                i.OnDetached()
         self.SelectItems([i for i in self.selectedItems if i not in items])
 
     def GetMaxItemZValue(self):
@@ -1,24 +1,54 @@
 import pathlib
+import threading
+import time
 
 import PySide6
 import typing
 from PySide6.QtWidgets import QMainWindow, QTabWidget, QWidget, QMenuBar, QFileDialog, \
-    QMessageBox, QHBoxLayout, QPushButton, QSizePolicy, QProxyStyle, QStyle
-from PySide6.QtCore import Qt, QTimer
+    QMessageBox, QHBoxLayout, QPushButton, QSizePolicy, QProxyStyle, QStyle, QInputDialog
+from PySide6.QtCore import Qt, QTimer, Signal
 from PySide6.QtGui import QIcon, QKeySequence
 from UI.ChipView import ChipView
 from UI.RigView import RigView
-from UI.UIMaster import UIMaster
+from UI.UIMaster import UIMaster, BackgroundProject
 from UI.ProgramWorker import ProgramWorker
 from UI.USBWorker import USBWorker
-from Data.FileIO import SaveObject, LoadObject
+from Data.ProjectFile import LoadProject, ProjectRecords, AutosavePath
+from Data.ProjectSaver import ProjectSaver
 from Data.Chip import Chip, Script
+from Data.ControlServer import ControlServer
+from Data.Metrics import MetricsServer
 from UI.ScriptEditor import ScriptEditor
+from UI.ScriptBrowser import ScriptBrowser
+from UI.StatsView import StatsView
+from UI.QueueView import QueueView
+from Data.ExperimentQueue import QueuePath
+from Data.Session import SolenoidOverlaps
 
 
 class MainWindow(QMainWindow):
+    # Emitted from the loading thread with (path, chip, error) once a project has been read.
+    chipLoaded = Signal(object, object, object)
+
+    # Emitted from the saving thread with (path, changes, error) once a save requested by the user
+    # is done. [changes] is the project's change count when it was saved (see UIMaster.changes).
+    projectSaved = Signal(object, object, object)
+
+    # How often open projects with unsaved changes are autosaved, in milliseconds.
+    AUTOSAVE_INTERVAL = 60 * 1000
+
     def __init__(self):
         super().__init__()
+        self.loadingPath: typing.Optional[pathlib.Path] = None
+        # The solenoid offset of a project that is being opened alongside the current one.
+        self.loadingOffset: typing.Optional[int] = None
+        self.controlServer: typing.Optional[ControlServer] = None
+        self.metricsServer: typing.Optional[MetricsServer] = None
+        self.statsView: typing.Optional[StatsView] = None
+        self.queueView: typing.Optional[QueueView] = None
+        self.chipLoaded.connect(self.OnChipLoaded)
+        self.projectSaver = ProjectSaver()
+        self.projectSaved.connect(self.OnProjectSaved)
         self.chipEditor = ChipView()
         centralWidget = QWidget()
         l = QHBoxLayout()
@@ -53,22 +83,35 @@ class MainWindow(QMainWindow):
         l.addWidget(self.toggleButton)
         l.addWidget(self.rigView, stretch=0)
 
-        self.programWorker = ProgramWorker(5.0)
-        self.usbWorker = USBWorker()
+        self.programWorker = ProgramWorker(UIMaster.Instance().rig, UIMaster.GetCompiledPrograms, 5.0)
+        UIMaster.Instance().scheduler = self.programWorker.scheduler
+        self.programWorker.scheduler.tickCallbacks.append(
+            lambda currentTime: [queue.Tick(currentTime) for queue in UIMaster.Instance().Queues()])
+        self.usbWorker = USBWorker(UIMaster.Instance().rig)
         watchdogTimer = QTimer(self)
         watchdogTimer.timeout.connect(self.CheckForTimeout)
         watchdogTimer.start(1000)
+        autosaveTimer = QTimer(self)
+        autosaveTimer.timeout.connect(self.Autosave)
+        autosaveTimer.start(MainWindow.AUTOSAVE_INTERVAL)
 
         self.NewChip()
         self.ToggleRig()
         self.ToggleRig()
 
         self.scriptEditors: typing.List[ScriptEditor] = []
-        self.chipEditor.scriptBrowser.onEditScript = self.OpenScriptEditor
+        ScriptBrowser.editScriptHandler = self.OpenScriptEditor
 
         self.setStyleSheet(UIMaster.StyleSheet())
 
         self.show()
+        QTimer.singleShot(0, self.ShowStartupErrors)
+
+    def ShowStartupErrors(self):
+        errors = UIMaster.Instance().startupErrors
+        if len(errors) > 0:
+            QMessageBox.warning(self, "uChip", "\n\n".join(errors))
+            errors.clear()
 
 
     def OpenScriptEditor(self, script: typing.Optional[Script]):
@@ -86,7 +129,8 @@ class MainWindow(QMainWindow):
         self.scriptEditors.append(ScriptEditor(script, self.OnScriptSaved))
 
     def OnScriptSaved(self, script: Script):
-        self.chipEditor.scriptBrowser.RelistAndSelect(script)
+        if ScriptBrowser.Exists():
+            ScriptBrowser.Instance().RelistAndSelect(script)
 
     def ToggleRig(self):
         self.rigView.setHidden(not self.rigView.isHidden())
@@ -104,26 +148,95 @@ class MainWindow(QMainWindow):
     def NewChip(self):
         if not self.PromptCloseChip():
             return
+        self.loadingPath = None
+        UIMaster.SetCursor(None)
         self.chipEditor.CloseChip()
+        UIMaster.Instance().currentChipPath = None
         UIMaster.Instance().currentChip = Chip()
         self.chipEditor.OpenChip()
         UIMaster.Instance().modified = False
         self.SetWindowTitle()
 
-    def SaveChip(self, saveAs: bool):
+    # Saves the current project. The project stays modified until the file has been written. With
+    # [wait], this waits for the file to be written and returns False if it could not be (e.g.
+    # before closing the project); otherwise it returns once the save has been requested.
+    def SaveChip(self, saveAs: bool, wait: bool = False):
         if saveAs or UIMaster.Instance().currentChipPath is None:
             d = QFileDialog.getSaveFileName(self, "Save Path", filter="uChip Project (*.ucp)")
             if d[0]:
                 UIMaster.Instance().currentChipPath = pathlib.Path(d[0])
+                UIMaster.Instance().UpdateProjectName()
             else:
                 return False
-        UIMaster.Instance().currentChip.ConvertPathsToRelative(UIMaster.Instance().currentChipPath)
-        SaveObject(UIMaster.Instance().currentChip, UIMaster.Instance().currentChipPath)
-        UIMaster.Instance().currentChip.ConvertPathsToAbsolute(UIMaster.Instance().currentChipPath)
-        UIMaster.Instance().modified = False
+        # The chip is copied into records here and written on the saver's thread, so that the
+        # window does not wait for the disk. Errors are reported by OnProjectSaved.
+        path = UIMaster.Instance().currentChipPath
+        changes = UIMaster.Instance().changes
+        records = ProjectRecords(UIMaster.Instance().currentChip, path)
+        errors = []
+
+        def OnDone(written, error):
+            if wait:
+                errors.append(error)
+            else:
+                self.projectSaved.emit(path, changes, error)
+
+        self.projectSaver.Save(records, path, obsolete=AutosavePath(path), onDone=OnDone)
+        if UIMaster.Instance().queue.path != QueuePath(UIMaster.Instance().currentChipPath):
+            UIMaster.Instance().queue.SetPath(QueuePath(UIMaster.Instance().currentChipPath))
         self.SetWindowTitle()
+        if wait:
+            self.projectSaver.Wait()
+            self.OnProjectSaved(path, changes, errors[0])
+            return errors[0] is None
         return True
 
+    def OnProjectSaved(self, path: pathlib.Path, changes: int, error):
+        if error is not None:
+            QMessageBox.critical(self, "Could not save project",
+                                 "Could not save '%s':\n%s" % (str(path), str(error)))
+            return
+        master = UIMaster.Instance()
+        if master.currentChipPath == path and master.changes == changes:
+            master.modified = False
+        for project in master.backgroundProjects:
+            if project.path == path and project.changes == changes:
+                project.modified = False
+        self.SetWindowTitle()
+
+    # Writes the unsaved changes of every open project next to its file (see AutosavePath). The
+    # saver skips projects that have not changed since they were last written.
+    def Autosave(self):
+        master = UIMaster.Instance()
+        projects = [(master.currentChip, master.currentChipPath, master.modified)] + \
+                   [(p.chip, p.path, p.modified) for p in master.backgroundProjects]
+        for chip, path, modified in projects:
+            if path is None or not modified:
+                continue
+            self.projectSaver.Save(ProjectRecords(chip, AutosavePath(path)), AutosavePath(path),
+                                   project=path, onlyIfChanged=True)
+
+    # Offers to recover the autosaved changes of a project that was not saved before uChip
+    # closed. Returns the chip to open.
+    def RecoverAutosave(self, path: pathlib.Path, chip: Chip):
+        autosavePath = AutosavePath(path)
+        if not autosavePath.exists() or autosavePath.stat().st_mtime < path.stat().st_mtime:
+            return chip, False
+        value = QMessageBox.question(self, "Recover unsaved changes",
+                                     "'%s' has unsaved changes from %s. Do you want to recover "
+                                     "them? If not, they are deleted." %
+                                     (path.name, time.strftime("%Y-%m-%d %H:%M", time.localtime(
+                                         autosavePath.stat().st_mtime))))
+        if value != QMessageBox.StandardButton.Yes:
+            autosavePath.unlink(missing_ok=True)
+            return chip, False
+        try:
+            return LoadProject(autosavePath), True
+        except Exception as e:
+            QMessageBox.critical(self, "Could not recover changes",
+                                 "Could not read '%s':\n%s" % (str(autosavePath), str(e)))
+            return chip, False
+
     def OpenChip(self):
         if not self.PromptCloseChip():
             return
@@ -133,14 +246,116 @@ class MainWindow(QMainWindow):
         else:
             return
 
-    def OpenChipPath(self, path):
+    # Opens another project in the editor while the current one keeps running in the background.
+    # Its valves are moved along the rig by a solenoid offset, which defaults to just after the
+    # solenoids of the projects that are already open.
+    def OpenChipAlongside(self):
+        d = QFileDialog.getOpenFileName(self, "Open Chip Alongside", filter="uChip Project (*.ucp)")
+        if not d[0]:
+            return
+        firstFree = max([n + 1 for r in UIMaster.Instance().registries for n in
+                         r.RigNumbers(r.chip.valves)] + [0])
+        offset, ok = QInputDialog.getInt(self, "Open Chip Alongside",
+                                         "Rig solenoid for the chip's solenoid 0:", firstFree, 0,
+                                         10000)
+        if ok:
+            self.OpenChipPath(d[0], offset)
+
+    # Reads the project on a background thread so that the window stays responsive. The current
+    # chip stays open until the new one has been read. If [solenoidOffset] is given, the project
+    # is opened alongside the current one instead of replacing it.
+    def OpenChipPath(self, path, solenoidOffset: typing.Optional[int] = None):
+        path = pathlib.Path(path)
+        self.loadingPath = path
+        self.loadingOffset = solenoidOffset
+        self.setWindowTitle("µChip - Loading " + path.stem + "...")
+        UIMaster.SetCursor(Qt.BusyCursor)
+        threading.Thread(target=self.LoadChip, args=(path,), daemon=True).start()
+
+    def LoadChip(self, path: pathlib.Path):
+        try:
+            chip = LoadProject(path)
+        except Exception as e:
+            self.chipLoaded.emit(path, None, e)
+            return
+        self.chipLoaded.emit(path, chip, None)
+
+    def OnChipLoaded(self, path: pathlib.Path, chip: typing.Optional[Chip], error):
+        if path != self.loadingPath:
+            # Another project was opened (or a new one created) in the meantime.
+            return
+        self.loadingPath = None
+        UIMaster.SetCursor(None)
+        if error is not None:
+            QMessageBox.critical(self, "Could not open project",
+                                 "Could not open '%s':\n%s" % (str(path), str(error)))
+            self.SetWindowTitle()
+            return
+        chip, recovered = self.RecoverAutosave(path, chip)
         self.chipEditor.CloseChip()
-        UIMaster.Instance().currentChipPath = pathlib.Path(path)
-        UIMaster.Instance().currentChip = LoadObject(UIMaster.Instance().currentChipPath)
-        UIMaster.Instance().currentChip.ConvertPathsToAbsolute(UIMaster.Instance().currentChipPath)
+        if self.loadingOffset is not None:
+            UIMaster.Instance().OpenAlongside(chip, path, self.loadingOffset)
+        else:
+            UIMaster.Instance().currentChipPath = path
+            UIMaster.Instance().currentChip = chip
         self.chipEditor.OpenChip()
-        UIMaster.Instance().modified = False
+        UIMaster.Instance().modified = recovered
         self.SetWindowTitle()
+        if self.loadingOffset is not None:
+            self.WarnAboutOverlaps()
+
+    def WarnAboutOverlaps(self):
+        overlaps = SolenoidOverlaps(UIMaster.Instance().registries)
+        if len(overlaps) == 0:
+            return
+        lines = ["Rig solenoid %d: %s" % (n, ", ".join(valves)) for n, valves in overlaps.items()]
+        if len(lines) > 10:
+            lines = lines[:10] + ["... and %d more" % (len(lines) - 10)]
+        QMessageBox.warning(self, "Shared solenoids",
+                            "Valves of different projects drive the same rig solenoids. Use "
+                            "claims to keep their programs from fighting over them.\n\n" +
+                            "\n".join(lines))
+
+    def SwitchProject(self, project: BackgroundProject):
+        self.chipEditor.CloseChip()
+        UIMaster.Instance().SwitchTo(project)
+        self.chipEditor.OpenChip()
+        self.SetWindowTitle()
+
+    # Stops the current project's functions and closes it, showing another open project.
+    def CloseProject(self):
+        if len(UIMaster.Instance().backgroundProjects) == 0 or not self.PromptCloseChip():
+            return
+        self.chipEditor.CloseChip()
+        UIMaster.Instance().CloseCurrent()
+        self.chipEditor.OpenChip()
+        self.SetWindowTitle()
+
+    # Lists the open projects in the Projects menu.
+    def UpdateProjectsMenu(self):
+        self.projectsMenu.clear()
+        currentAction = self.projectsMenu.addAction(UIMaster.Instance().programs.name)
+        currentAction.setCheckable(True)
+        currentAction.setChecked(True)
+        for project in UIMaster.Instance().backgroundProjects:
+            action = self.projectsMenu.addAction(project.programs.name +
+                                                 (" *" if project.modified else ""))
+            action.triggered.connect(lambda checked=False, p=project: self.SwitchProject(p))
+        self.projectsMenu.addSeparator()
+        closeAction = self.projectsMenu.addAction("Close Project")
+        closeAction.setEnabled(len(UIMaster.Instance().backgroundProjects) > 0)
+        closeAction.triggered.connect(self.CloseProject)
+
+    # Asks about unsaved changes in every open project.
+    def PromptCloseAll(self):
+        if not self.PromptCloseChip():
+            return False
+        for project in list(UIMaster.Instance().backgroundProjects):
+            if project.modified:
+                self.SwitchProject(project)
+                if not self.PromptCloseChip():
+                    return False
+        return True
 
     def PromptCloseChip(self):
         if UIMaster.Instance().modified:
@@ -151,18 +366,26 @@ class MainWindow(QMainWindow):
             if value == QMessageBox.StandardButton.Cancel:
                 return False
             elif value == QMessageBox.StandardButton.Save:
-                return self.SaveChip(False)
+                return self.SaveChip(False, wait=True)
+            elif UIMaster.Instance().currentChipPath is not None:
+                self.projectSaver.Remove(AutosavePath(UIMaster.Instance().currentChipPath))
         return True
 
     def SetWindowTitle(self):
         chipName = "New Chip" if UIMaster.Instance().currentChipPath is None else UIMaster.Instance().currentChipPath.stem
+        others = len(UIMaster.Instance().backgroundProjects)
+        if others > 0:
+            chipName += " (+%d running)" % others
         self.setWindowTitle("µChip - " + chipName)
 
     def closeEvent(self, event):
-        if self.PromptCloseChip():
+        if self.PromptCloseAll():
             super().closeEvent(event)
             self.programWorker.doStop = True
             self.usbWorker.doStop = True
+            self.SetControlServerEnabled(False)
+            self.SetMetricsServerEnabled(False)
+            self.projectSaver.Close()
             self.programWorker.thread.join()
             self.usbWorker.thread.join()
             for v in self.scriptEditors:
@@ -182,6 +405,10 @@ class MainWindow(QMainWindow):
         openAction = fileMenu.addAction("Open...")
         openAction.setShortcut(QKeySequence("Ctrl+O"))
         openAction.triggered.connect(self.OpenChip)
+        openAlongsideAction = fileMenu.addAction("Open Alongside...")
+        openAlongsideAction.setToolTip("Open another project on the same rig. The current project "
+                                       "keeps running.")
+        openAlongsideAction.triggered.connect(self.OpenChipAlongside)
 
         saveAction = fileMenu.addAction("Save")
         saveAction.setShortcut(QKeySequence("Ctrl+S"))
@@ -202,8 +429,107 @@ class MainWindow(QMainWindow):
         selectNoneAction.triggered.connect(lambda: self.chipEditor.graphicsView.SelectItems([]))
         selectNoneAction.setShortcut(QKeySequence("Esc"))
 
+        self.projectsMenu = menuBar.addMenu("&Projects")
+        self.projectsMenu.aboutToShow.connect(self.UpdateProjectsMenu)
+
         viewMenu = menuBar.addMenu("&View")
         centerOnSelected = viewMenu.addAction("Center On Selection")
         centerOnSelected.triggered.connect(lambda: self.chipEditor.graphicsView.CenterOnSelection())
 
+        toolsMenu = menuBar.addMenu("&Tools")
+        self.controlServerAction = toolsMenu.addAction("Control API")
+        self.controlServerAction.setCheckable(True)
+        self.controlServerAction.setToolTip("Let other programs on this computer run functions "
+                                            "and set parameters.")
+        self.controlServerAction.toggled.connect(self.SetControlServerEnabled)
+        self.metricsServerAction = toolsMenu.addAction("Metrics Endpoint")
+        self.metricsServerAction.setCheckable(True)
+        self.metricsServerAction.setToolTip("Serve tick timing, device and program metrics for "
+                                            "Prometheus on this computer.")
+        self.metricsServerAction.toggled.connect(self.SetMetricsServerEnabled)
+        self.fileLoggingAction = toolsMenu.addAction("Log Messages to File")
+        self.fileLoggingAction.setCheckable(True)
+        self.fileLoggingAction.setChecked(UIMaster.Instance().messageSink is not None)
+        self.fileLoggingAction.setToolTip("Write the messages of all programs to log files.")
+        self.fileLoggingAction.toggled.connect(self.SetFileLoggingEnabled)
+        logFolderAction = toolsMenu.addAction("Log Folder...")
+        logFolderAction.triggered.connect(self.ChooseLogFolder)
+        messageHistoryAction = toolsMenu.addAction("Message History...")
+        messageHistoryAction.setToolTip("Choose how many messages each program keeps.")
+        messageHistoryAction.triggered.connect(self.ChooseMessageCapacity)
+        statsAction = toolsMenu.addAction("Tick Statistics...")
+        statsAction.triggered.connect(self.ShowStats)
+        queueAction = toolsMenu.addAction("Experiment Queue...")
+        queueAction.triggered.connect(self.ShowQueue)
+
         self.setMenuBar(menuBar)
+
+    def ShowStats(self):
+        if self.statsView is None:
+            self.statsView = StatsView(self, self.programWorker.scheduler.stats)
+        self.statsView.show()
+        self.statsView.raise_()
+
+    def ShowQueue(self):
+        if self.queueView is None:
+            self.queueView = QueueView(self, self.programWorker.scheduler)
+        self.queueView.show()
+        self.queueView.raise_()
+
+    def SetControlServerEnabled(self, enabled: bool):
+        if enabled and self.controlServer is None:
+            try:
+                self.controlServer = ControlServer(self.programWorker.scheduler,
+                                                   lambda: UIMaster.Instance().registries)
+            except OSError as e:
+                QMessageBox.critical(self, "Control API", "Could not start the control API:\n" +
+                                     str(e))
+                self.controlServerAction.setChecked(False)
+                return
+            self.controlServerAction.setText("Control API (" + self.controlServer.Describe() + ")")
+        elif not enabled and self.controlServer is not None:
+            self.controlServer.Close()
+            self.controlServer = None
+            self.controlServerAction.setText("Control API")
+
+    def SetFileLoggingEnabled(self, enabled: bool):
+        self.SetFileLogging(enabled, UIMaster.Instance().LogDirectory())
+
+    def ChooseLogFolder(self):
+        directory = QFileDialog.getExistingDirectory(self, "Log Folder",
+                                                     str(UIMaster.Instance().LogDirectory()))
+        if directory:
+            self.SetFileLogging(self.fileLoggingAction.isChecked(), pathlib.Path(directory))
+
+    def ChooseMessageCapacity(self):
+        capacity, accepted = QInputDialog.getInt(self, "Message History",
+                                                 "Messages kept per program:",
+                                                 UIMaster.Instance().messageCapacity, 10, 1000000,
+                                                 100)
+        if accepted:
+            UIMaster.Instance().SetMessageCapacity(capacity)
+
+    def SetFileLogging(self, enabled: bool, directory: pathlib.Path):
+        try:
+            UIMaster.Instance().SetFileLogging(enabled, directory)
+        except OSError as e:
+            QMessageBox.critical(self, "Log Messages to File", "Could not write logs to " +
+                                 str(directory) + ":\n" + str(e))
+            self.fileLoggingAction.setChecked(UIMaster.Instance().messageSink is not None)
+
+    def SetMetricsServerEnabled(self, enabled: bool):
+        if enabled and self.metricsServer is None:
+            try:
+                self.metricsServer = MetricsServer(self.programWorker.scheduler,
+                                                   lambda: UIMaster.Instance().registries)
+            except OSError as e:
+                QMessageBox.critical(self, "Metrics Endpoint", "Could not start the metrics "
+                                                               "endpoint:\n" + str(e))
+                self.metricsServerAction.setChecked(False)
+                return
+            self.metricsServerAction.setText("Metrics Endpoint (" + self.metricsServer.Describe() +
+                                             ")")
+        elif not enabled and self.metricsServer is not None:
+            self.metricsServer.Close()
+            self.metricsServer = None
+            self.metricsServerAction.setText("Metrics Endpoint")
@@ -0,0 +1,112 @@
+from PySide6.QtWidgets import QDialog, QVBoxLayout, QHBoxLayout, QLabel, QPushButton, \
+    QTableWidget, QTableWidgetItem, QHeaderView, QSplitter
+from PySide6.QtCore import QTimer, Qt
+
+from Data.ProgramCompilation import CompiledProgram
+
+
+# A live table of the lines and API calls of a program's script that take the most time, while
+# the program is being profiled (see ScriptProfiler).
+class ProfileView(QDialog):
+    LINE_COLUMNS = ["Line", "Function", "Hits", "Total ms", "Per hit µs", "Share", "Code"]
+    API_COLUMNS = ["API call", "Calls", "Total ms", "Per call µs", "Share"]
+
+    # How many lines and API calls are shown.
+    ROWS = 50
+
+    def __init__(self, parent, compiledProgram: CompiledProgram):
+        super().__init__(parent)
+        self.compiledProgram = compiledProgram
+        self.setWindowTitle("Profile - " + compiledProgram.program.name)
+        self.setModal(False)
+        self.resize(900, 600)
+
+        self.lineTable = self.BuildTable(ProfileView.LINE_COLUMNS)
+        self.lineTable.horizontalHeader().setSectionResizeMode(6, QHeaderView.ResizeMode.Stretch)
+        self.apiTable = self.BuildTable(ProfileView.API_COLUMNS)
+        splitter = QSplitter(Qt.Vertical)
+        splitter.addWidget(self.lineTable)
+        splitter.addWidget(self.apiTable)
+        splitter.setSizes([400, 200])
+
+        self.summaryLabel = QLabel()
+        self.resetButton = QPushButton("Reset")
+        self.resetButton.clicked.connect(self.Reset)
+        buttonLayout = QHBoxLayout()
+        buttonLayout.addWidget(self.summaryLabel, stretch=1)
+        buttonLayout.addWidget(self.resetButton, stretch=0)
+
+        layout = QVBoxLayout()
+        layout.addWidget(splitter)
+        layout.addLayout(buttonLayout)
+        self.setLayout(layout)
+
+        self.scriptLines = []
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.Update)
+        self.timer.start(1000)
+
+    @staticmethod
+    def BuildTable(columns):
+        table = QTableWidget(0, len(columns))
+        table.setHorizontalHeaderLabels(columns)
+        table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.ResizeToContents)
+        table.verticalHeader().setVisible(False)
+        table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        return table
+
+    def showEvent(self, event) -> None:
+        super().showEvent(event)
+        try:
+            self.scriptLines = self.compiledProgram.program.script.Read().splitlines()
+        except Exception:
+            self.scriptLines = []
+        self.Update()
+
+    def Reset(self):
+        if self.compiledProgram.profileResults is not None:
+            self.compiledProgram.profileResults.Reset()
+        self.Update()
+
+    def Update(self):
+        if not self.isVisible():
+            return
+        profiler = self.compiledProgram.profileResults
+        if profiler is None:
+            self.summaryLabel.setText("Turn on profiling in the program's inspector.")
+            self.lineTable.setRowCount(0)
+            self.apiTable.setRowCount(0)
+            return
+        snapshot = profiler.Snapshot()
+        lines = snapshot["lines"][:ProfileView.ROWS]
+        self.Fill(self.lineTable, [[line["line"], line["function"], line["hits"],
+                                    "%.3f" % (line["seconds"] * 1000),
+                                    "%.1f" % (line["seconds"] / max(line["hits"], 1) * 1e6),
+                                    "%.1f%%" % (line["share"] * 100), self.Code(line["line"])]
+                                   for line in lines], {0, 2, 3, 4, 5})
+        calls = snapshot["api"][:ProfileView.ROWS]
+        self.Fill(self.apiTable, [[call["name"], call["calls"], "%.3f" % (call["seconds"] * 1000),
+                                   "%.1f" % (call["seconds"] / max(call["calls"], 1) * 1e6),
+                                   "%.1f%%" % (call["share"] * 100)] for call in calls],
+                  {1, 2, 3, 4})
+        self.summaryLabel.setText("%s: %.1f ms in %d runs of script code" % (
+            "Profiling" if self.compiledProgram.profiler is not None else "Stopped",
+            snapshot["total"] * 1000, snapshot["runs"]))
+
+    def Code(self, line: int):
+        if 0 < line <= len(self.scriptLines):
+            return self.scriptLines[line - 1].strip()
+        return ""
+
+    @staticmethod
+    def Fill(table: QTableWidget, rows, rightAligned):
+        table.setRowCount(len(rows))
+        for r, row in enumerate(rows):
+            for c, value in enumerate(row):
+                item = table.item(r, c)
+                if item is None:
+                    item = QTableWidgetItem()
+                    if c in rightAligned:
+                        item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                    table.setItem(r, c, item)
+                item.setText(str(value))
@@ -2,15 +2,15 @@ import threading
 import time
 import typing
 
-from UI.UIMaster import UIMaster
-from Data.ProgramCompilation import TickFunction, CompiledProgram
+from Data.Rig import Rig
+from Data.ProgramCompilation import CompiledProgram
+from Data.Scheduler import Scheduler
 
 
 class ProgramWorker:
-    def __init__(self, timeout: float):
-        self.tickStartTime: typing.Optional[float] = None
-        self.tickStartProgram: typing.Optional[CompiledProgram] = None
-        self.tickStartFunctionSymbol: str = ""
+    def __init__(self, rig: Rig, programSource: typing.Callable[[], typing.List[CompiledProgram]],
+                 timeout: float):
+        self.scheduler = Scheduler(rig, programSource)
         self.timeout = timeout
         self.thread = threading.Thread(target=self.Loop, daemon=True)
         self.doStop = False
@@ -18,20 +18,20 @@ class ProgramWorker:
 
     def Loop(self):
         while not self.doStop:
-            currentTime = time.time()
-            UIMaster.Instance().rig.FlushStates()
-            for x in UIMaster.GetCompiledPrograms().copy():
-                self.tickStartProgram = x
-                for s in x.asyncFunctions.copy():
-                    self.tickStartTime = time.time()
-                    self.tickStartFunctionSymbol = s
-                    TickFunction(x, currentTime, s)
-                    self.tickStartTime = None
-            time.sleep(0.01)
+            self.scheduler.Tick()
+            time.sleep(Scheduler.TICK_PERIOD)
+
+    @property
+    def tickStartProgram(self):
+        return self.scheduler.tickStartProgram
+
+    @property
+    def tickStartFunctionSymbol(self):
+        return self.scheduler.tickStartFunctionSymbol
 
     def IsStuck(self):
-        if self.tickStartTime is None or self.thread is None:
+        if self.scheduler.tickStartTime is None or self.thread is None:
             return False
-        if time.time() - self.tickStartTime >= self.timeout:
-            self.tickStartTime = time.time()
+        if time.time() - self.scheduler.tickStartTime >= self.timeout:
+            self.scheduler.tickStartTime = time.time()
             return True
@@ -0,0 +1,221 @@
+import time
+import typing
+
+from PySide6.QtWidgets import QDialog, QVBoxLayout, QHBoxLayout, QLabel, QPushButton, \
+    QTableWidget, QTableWidgetItem, QHeaderView, QComboBox, QPlainTextEdit, QSplitter, QWidget, \
+    QMessageBox
+from PySide6.QtCore import QTimer, Qt
+
+from Data.ExperimentQueue import ExperimentQueue, QueuedRun, ValueText
+from Data.Scheduler import Scheduler
+from UI.UIMaster import UIMaster
+
+
+# Lets the user queue a program function over a grid of parameter values and watch the runs.
+# Grid values are separated by semicolons, e.g. "10; 20; 30", so that list parameters can still
+# use commas.
+class QueueView(QDialog):
+    COLUMNS = ["#", "Program", "Function", "Parameters", "State", "Started", "Ended", "Duration"]
+
+    def __init__(self, parent, scheduler: Scheduler):
+        super().__init__(parent)
+        self.scheduler = scheduler
+        self.setWindowTitle("Experiment Queue")
+        self.setModal(False)
+        self.resize(900, 600)
+
+        self.programList = QComboBox()
+        self.programList.currentIndexChanged.connect(self.OnProgramChanged)
+        self.functionList = QComboBox()
+        self.gridTable = QTableWidget(0, 2)
+        self.gridTable.setHorizontalHeaderLabels(["Parameter", "Values (separate with ;)"])
+        self.gridTable.horizontalHeader().setSectionResizeMode(1, QHeaderView.ResizeMode.Stretch)
+        self.gridTable.verticalHeader().setVisible(False)
+        self.addButton = QPushButton("Add Runs")
+        self.addButton.clicked.connect(self.AddRuns)
+
+        submitLayout = QHBoxLayout()
+        submitLayout.addWidget(QLabel("Program"))
+        submitLayout.addWidget(self.programList, stretch=1)
+        submitLayout.addWidget(QLabel("Function"))
+        submitLayout.addWidget(self.functionList, stretch=1)
+        submitLayout.addWidget(self.addButton)
+
+        self.runTable = QTableWidget(0, len(QueueView.COLUMNS))
+        self.runTable.setHorizontalHeaderLabels(QueueView.COLUMNS)
+        self.runTable.horizontalHeader().setSectionResizeMode(
+            QHeaderView.ResizeMode.ResizeToContents)
+        self.runTable.horizontalHeader().setSectionResizeMode(3, QHeaderView.ResizeMode.Stretch)
+        self.runTable.verticalHeader().setVisible(False)
+        self.runTable.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        self.runTable.setSelectionBehavior(QTableWidget.SelectionBehavior.SelectRows)
+        self.runTable.itemSelectionChanged.connect(self.UpdateLog)
+        self.logView = QPlainTextEdit()
+        self.logView.setReadOnly(True)
+
+        self.runButton = QPushButton("Start Queue")
+        self.runButton.clicked.connect(self.ToggleRunning)
+        self.stopButton = QPushButton("Stop Current Run")
+        self.stopButton.clicked.connect(
+            lambda: self.scheduler.Invoke(self.Queue().StopCurrent))
+        self.retryButton = QPushButton("Retry")
+        self.retryButton.clicked.connect(self.RetrySelected)
+        self.removeButton = QPushButton("Remove")
+        self.removeButton.clicked.connect(self.RemoveSelected)
+        self.clearButton = QPushButton("Clear Finished")
+        self.clearButton.clicked.connect(lambda: self.Queue().ClearFinished())
+        self.summaryLabel = QLabel()
+
+        buttonLayout = QHBoxLayout()
+        buttonLayout.addWidget(self.summaryLabel, stretch=1)
+        for button in [self.runButton, self.stopButton, self.retryButton, self.removeButton,
+                       self.clearButton]:
+            buttonLayout.addWidget(button)
+
+        top = QWidget()
+        topLayout = QVBoxLayout()
+        topLayout.setContentsMargins(0, 0, 0, 0)
+        topLayout.addLayout(submitLayout)
+        topLayout.addWidget(self.gridTable)
+        top.setLayout(topLayout)
+        splitter = QSplitter(Qt.Vertical)
+        splitter.addWidget(top)
+        splitter.addWidget(self.runTable)
+        splitter.addWidget(self.logView)
+        splitter.setSizes([150, 300, 150])
+
+        layout = QVBoxLayout()
+        layout.addWidget(splitter)
+        layout.addLayout(buttonLayout)
+        self.setLayout(layout)
+
+        self.shownRuns: typing.List[QueuedRun] = []
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.Update)
+        self.timer.start(1000)
+
+    @staticmethod
+    def Queue() -> ExperimentQueue:
+        return UIMaster.Instance().queue
+
+    def showEvent(self, event) -> None:
+        super().showEvent(event)
+        self.ListPrograms()
+        self.Update()
+
+    def ListPrograms(self):
+        self.programList.blockSignals(True)
+        self.programList.clear()
+        for program in UIMaster.Instance().currentChip.programs:
+            self.programList.addItem(program.name, program)
+        self.programList.blockSignals(False)
+        self.OnProgramChanged()
+
+    def OnProgramChanged(self):
+        self.functionList.clear()
+        self.gridTable.setRowCount(0)
+        program = self.programList.currentData()
+        if program is None:
+            return
+        compiled = UIMaster.GetCompiledProgram(program)
+        self.functionList.addItems(compiled.showableFunctions)
+        self.gridTable.setRowCount(len(compiled.parameters))
+        for row, symbol in enumerate(compiled.parameters):
+            nameItem = QTableWidgetItem(symbol)
+            nameItem.setFlags(nameItem.flags() & ~Qt.ItemIsEditable)
+            self.gridTable.setItem(row, 0, nameItem)
+            value = program.parameterValues.get(symbol)
+            self.gridTable.setItem(row, 1, QTableWidgetItem("" if value is None else
+                                                            ValueText(value)))
+
+    def AddRuns(self):
+        program = self.programList.currentData()
+        function = self.functionList.currentText()
+        if program is None or function == "":
+            return
+        grid = {}
+        for row in range(self.gridTable.rowCount()):
+            values = [v.strip() for v in self.gridTable.item(row, 1).text().split(";")]
+            values = [v for v in values if v != ""]
+            if len(values) > 0:
+                grid[self.gridTable.item(row, 0).text()] = values
+        count = 1
+        for values in grid.values():
+            count *= len(values)
+        if count > 100 and QMessageBox.question(
+                self, "Experiment Queue", "Add %d runs to the queue?" % count) != \
+                QMessageBox.StandardButton.Yes:
+            return
+        self.Queue().Submit(program.name, function, grid)
+        self.Update()
+
+    def ToggleRunning(self):
+        self.Queue().SetRunning(not self.Queue().running)
+        self.Update()
+
+    def SelectedRuns(self) -> typing.List[QueuedRun]:
+        rows = sorted(set(i.row() for i in self.runTable.selectedIndexes()))
+        return [self.shownRuns[r] for r in rows if r < len(self.shownRuns)]
+
+    def RetrySelected(self):
+        for run in self.SelectedRuns():
+            self.Queue().Retry(run)
+        self.Update()
+
+    def RemoveSelected(self):
+        for run in self.SelectedRuns():
+            self.Queue().Remove(run)
+        self.Update()
+
+    def Update(self):
+        if not self.isVisible():
+            return
+        queue = self.Queue()
+        with queue.lock:
+            self.shownRuns = list(queue.runs)
+        self.runTable.setRowCount(len(self.shownRuns))
+        for r, run in enumerate(self.shownRuns):
+            duration = None
+            if run.startTime is not None:
+                duration = (run.endTime if run.endTime is not None else time.time()) - \
+                           run.startTime
+            row = [str(run.runId), run.programName, run.functionSymbol, run.Describe(),
+                   run.state, FormatTime(run.startTime), FormatTime(run.endTime),
+                   "" if duration is None else "%.1f s" % duration]
+            for c, text in enumerate(row):
+                item = self.runTable.item(r, c)
+                if item is None:
+                    item = QTableWidgetItem()
+                    self.runTable.setItem(r, c, item)
+                item.setText(text)
+
+        self.runButton.setText("Pause Queue" if queue.running else "Start Queue")
+        pending = sum(1 for run in self.shownRuns if run.state == QueuedRun.PENDING)
+        self.summaryLabel.setText("%d pending, %s" % (pending, "running" if queue.running else
+                                                      "paused"))
+        self.UpdateLog()
+
+    # Shows the log of the selected run, or with no run selected, the queue's own messages.
+    def UpdateLog(self):
+        selected = self.SelectedRuns()
+        if len(selected) > 1:
+            self.logView.setPlainText("")
+            return
+        if len(selected) == 0:
+            log = [[m.timestamp, m.LevelName(), m.text] for m in self.Queue().messages]
+        else:
+            run = selected[0]
+            log = run.log
+            if run.state == QueuedRun.RUNNING and self.Queue().currentProgram is not None:
+                log = [[m.timestamp, m.LevelName(), m.text] for m in
+                       self.Queue().currentProgram.messages.Since(run.logStart)]
+        text = "\n".join("%s  %s  %s" % (FormatTime(t), level, message.strip())
+                         for t, level, message in log)
+        if text != self.logView.toPlainText():
+            self.logView.setPlainText(text)
+
+
+def FormatTime(t: typing.Optional[float]):
+    if t is None:
+        return ""
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))
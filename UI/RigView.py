@@ -6,6 +6,7 @@ from Data.Rig import Device
 from UI.UIMaster import UIMaster
 import time
 import math
+import html
 
 
 class RigView(QWidget):
@@ -73,6 +74,11 @@ class RigView(QWidget):
         self.blinkButton.clicked.connect(self.Blink)
 
         deviceListAndInfoLayout.addWidget(self.blinkButton)
+
+        # The agents on other computers (see Data.RemoteRig) and whether they are connected.
+        self.remotesLabel = QLabel()
+        self.remotesLabel.setWordWrap(True)
+        deviceListAndInfoLayout.addWidget(self.remotesLabel)
         self.selectedDevice: Optional[Device] = None
         self.lastDevicesList: List[Device] = []
 
@@ -87,6 +93,15 @@ class RigView(QWidget):
     def Update(self):
         self.UpdateDeviceList()
         self.UpdateSolenoids()
+        self.UpdateRemotes()
+
+    def UpdateRemotes(self):
+        remotes = UIMaster.Instance().rig.remoteRigs
+        text = "<br>".join("<b>Agent %s</b>: %s" % (html.escape(r.Describe()),
+                                                     html.escape(r.Status())) for r in remotes)
+        if text != self.remotesLabel.text():
+            self.remotesLabel.setText(text)
+        self.remotesLabel.setVisible(len(remotes) > 0)
 
     def PushUIToDevice(self):
         self.selectedDevice.enabled = self.enabledBox.IsTrue()
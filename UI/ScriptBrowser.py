@@ -2,6 +2,7 @@ from PySide6.QtWidgets import QDialog, QPushButton, QVBoxLayout, QHBoxLayout, QL
     QListWidgetItem, QMessageBox
 from PySide6.QtCore import Qt, QPoint
 from Data.Chip import Script
+from Data.BuiltinScripts import IsShippedBuiltin
 from UI.PythonEditor import PythonEditor
 from UI.UIMaster import UIMaster
 
@@ -11,6 +12,9 @@ import pathlib
 class ScriptBrowser(QDialog):
     _instance: 'ScriptBrowser' = None
 
+    # Opens a script editor for the given script (None for a new script). Set by the main window.
+    editScriptHandler = None
+
     def __init__(self, parent):
         super().__init__(parent)
         self.onScriptChosen = None
@@ -61,7 +65,6 @@ class ScriptBrowser(QDialog):
         mainLayout.addLayout(previewLayout, stretch=1)
 
         self.setLayout(mainLayout)
-        self.onEditScript = lambda x: None
 
         if ScriptBrowser._instance is None:
             ScriptBrowser._instance = self
@@ -77,7 +80,9 @@ class ScriptBrowser(QDialog):
         self.scriptList.blockSignals(True)
         self.scriptList.clear()
         self.scriptList.addItems(
-            [("[built-in]  " if script.isBuiltIn else "") + script.Name() for script in ScriptBrowser.Scripts()])
+            [("[built-in]  " if script.isBuiltIn else "") + script.Name() +
+             ("  (saved with project)" if script.isBuiltIn and not IsShippedBuiltin(script) else "")
+             for script in ScriptBrowser.Scripts()])
         self.scriptList.blockSignals(False)
         self.scriptList.setCurrentRow(0)
 
@@ -86,10 +91,12 @@ class ScriptBrowser(QDialog):
         self.Relist()
 
     def NewScript(self):
-        self.onEditScript(None)
+        if ScriptBrowser.editScriptHandler is not None:
+            ScriptBrowser.editScriptHandler(None)
 
     def EditScript(self):
-        self.onEditScript(self.SelectedScript())
+        if ScriptBrowser.editScriptHandler is not None:
+            ScriptBrowser.editScriptHandler(self.SelectedScript())
 
     def RelistAndSelect(self, script: Script):
         self.Relist()
@@ -190,6 +197,13 @@ class ScriptBrowser(QDialog):
             self.SelectScript(selectedScript)
         self.show()
 
+    # The browser is only built the first time it is needed, so it does not slow down startup.
     @staticmethod
     def Instance():
+        if ScriptBrowser._instance is None:
+            ScriptBrowser(UIMaster.Instance().topLevel)
         return ScriptBrowser._instance
+
+    @staticmethod
+    def Exists():
+        return ScriptBrowser._instance is not None
@@ -122,10 +122,8 @@ class ScriptEditor(QMainWindow):
 class DocumentationWidget(QFrame):
     def __init__(self):
         super().__init__()
+        # The documentation is read when the widget is first shown (see showEvent).
         self.documentationLabel = QLabel()
-        f = open("Documentation.txt")
-        self.documentationLabel.setText(f.read())
-        f.close()
         self.documentationLabel.setTextFormat(Qt.TextFormat.RichText)
         self.documentationLabel.setAlignment(Qt.AlignmentFlag.AlignTop)
         self.documentationLabel.setWordWrap(True)
@@ -146,5 +144,5 @@ class DocumentationWidget(QFrame):
 
     def showEvent(self, event) -> None:
         super().showEvent(event)
-        f = open("Documentation.txt")
-        self.documentationLabel.setText(f.read())
\ No newline at end of file
+        with open("Documentation.txt") as f:
+            self.documentationLabel.setText(f.read())
\ No newline at end of file
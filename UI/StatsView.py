@@ -0,0 +1,89 @@
+from PySide6.QtWidgets import QDialog, QVBoxLayout, QHBoxLayout, QLabel, QPushButton, \
+    QTableWidget, QTableWidgetItem, QHeaderView
+from PySide6.QtCore import QTimer, Qt
+
+from Data.TickStats import TickStats
+
+
+# A live table of how much of the tick budget each program function uses.
+class StatsView(QDialog):
+    COLUMNS = ["Project", "Program", "Function", "Ticks", "Mean ms", "p95 ms", "Max ms", "Mean late ms",
+               "Max late ms", "Share"]
+
+    def __init__(self, parent, stats: TickStats):
+        super().__init__(parent)
+        self.stats = stats
+        self.setWindowTitle("Tick Statistics")
+        self.setModal(False)
+        self.resize(800, 400)
+
+        self.summaryLabel = QLabel()
+        self.table = QTableWidget(0, len(StatsView.COLUMNS))
+        self.table.setHorizontalHeaderLabels(StatsView.COLUMNS)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.ResizeToContents)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+
+        self.resetButton = QPushButton("Reset")
+        self.resetButton.clicked.connect(self.Reset)
+
+        buttonLayout = QHBoxLayout()
+        buttonLayout.addWidget(self.summaryLabel, stretch=1)
+        buttonLayout.addWidget(self.resetButton, stretch=0)
+
+        layout = QVBoxLayout()
+        layout.addWidget(self.table)
+        layout.addLayout(buttonLayout)
+        self.setLayout(layout)
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.Update)
+        self.timer.start(1000)
+        self.Update()
+
+    def Reset(self):
+        self.stats.Reset()
+        self.Update()
+
+    def Update(self):
+        if not self.isVisible():
+            return
+        snapshot = self.stats.Snapshot()
+        rows = [[f["project"], f["program"], f["function"], f["duration"]["count"],
+                 f["duration"]["mean"], f["duration"]["p95"], f["duration"]["max"],
+                 f["lateness"]["mean"], f["lateness"]["max"], f["share"]]
+                for f in sorted(snapshot["functions"], key=lambda f: -f["share"])]
+        flush = snapshot["flush"]
+        rows.append(["", "(rig)", "FlushStates", flush["count"], flush["mean"], flush["p95"],
+                     flush["max"], None, None,
+                     flush["total"] / snapshot["elapsed"] if snapshot["elapsed"] > 0 else 0])
+
+        self.table.setRowCount(len(rows))
+        for r, row in enumerate(rows):
+            for c, value in enumerate(row):
+                if value is None:
+                    text = ""
+                elif c == 9:
+                    text = "%.2f%%" % (value * 100)
+                elif c >= 4:
+                    text = "%.3f" % (value * 1000)
+                else:
+                    text = str(value)
+                item = self.table.item(r, c)
+                if item is None:
+                    item = QTableWidgetItem()
+                    if c >= 3:
+                        item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                    self.table.setItem(r, c, item)
+                item.setText(text)
+
+        period = snapshot["period"]
+        jitter = snapshot["jitter"]
+        self.summaryLabel.setText("Tick period: mean %.2f ms, p95 %.2f ms, max %.2f ms over %d "
+                                  "ticks; jitter p95 %.2f ms" %
+                                  (period["mean"] * 1000, period["p95"] * 1000,
+                                   period["max"] * 1000, period["count"], jitter["p95"] * 1000))
+
+    def showEvent(self, event) -> None:
+        super().showEvent(event)
+        self.Update()
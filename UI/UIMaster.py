@@ -1,21 +1,62 @@
 from Data.Rig import Rig
 from Data.Chip import Chip, Program
 from Data.FileIO import SaveObject, LoadObject
+from Data.MessageLog import MessageLog, MessageFileSink
+from Data.ExperimentQueue import ExperimentQueue, QueuePath
+from Data.Session import UniqueProjectName
+from Data.RemoteRig import LoadRemoteRigs
+from Data.Scheduler import Scheduler
 import Data.ProgramCompilation as ProgramCompilation
-from typing import Optional, List, Dict
+from typing import Optional, List
 from pathlib import Path
+from PySide6.QtCore import QSettings, QStandardPaths
 from PySide6.QtGui import QCursor, QGuiApplication
 from PySide6.QtWidgets import QApplication
 
 
+# A chip project that is open but not shown in the editor. Its programs keep running.
+class BackgroundProject:
+    def __init__(self, chip: Chip, path: Optional[Path],
+                 programs: ProgramCompilation.ProgramRegistry, queue: ExperimentQueue,
+                 modified: bool, changes: int):
+        self.chip = chip
+        self.path = path
+        self.programs = programs
+        self.queue = queue
+        self.modified = modified
+        self.changes = changes
+
+
 class UIMaster:
     _instance = None
 
     def __init__(self):
         super().__init__()
-        self.topLevel = QApplication.topLevelWidgets()[0]
-        self._compiledPrograms: List[ProgramCompilation.CompiledProgram] = []
-        self._programLookup: Dict[Program, ProgramCompilation.CompiledProgram] = {}
+        self.programs: Optional[ProgramCompilation.ProgramRegistry] = None
+        self.queue: Optional[ExperimentQueue] = None
+
+        # Several projects can be open at once, all running on the one rig and scheduler. The
+        # current project is the one in the editor; the others are kept in [backgroundProjects].
+        # [registries] holds the program registries of all of them, in the order the projects
+        # were opened, which is the order their programs are ticked in.
+        self.backgroundProjects: List[BackgroundProject] = []
+        self.registries: List[ProgramCompilation.ProgramRegistry] = []
+        # Runs the programs of all projects. Set by the main window; without it, projects that are
+        # closed are stopped on the calling thread.
+        self.scheduler: Optional[Scheduler] = None
+        # Problems found while starting up, which the main window shows once it is open.
+        self.startupErrors: List[str] = []
+        # Settings that are kept between sessions.
+        self.settings = QSettings("uChip", "uChip")
+        # Writes the messages of all programs to log files, if turned on (see SetFileLogging).
+        self.messageSink: Optional[MessageFileSink] = None
+        # How many messages each program keeps (see SetMessageCapacity).
+        self.messageCapacity = self.settings.value("messageCapacity", MessageLog.DEFAULT_CAPACITY,
+                                                   int)
+        try:
+            self.SetFileLogging(self.settings.value("logToFile", False, bool), self.LogDirectory())
+        except OSError:
+            self.settings.setValue("logToFile", False)
         self.rig = Rig()
         self.rig.allDevices = []
         try:
@@ -24,46 +65,182 @@ class UIMaster:
             pass
         except IOError:
             pass
-        self.currentChip = Chip()
-        self.modified = False
+        # Solenoids driven by agents on other computers, e.g.
+        #   [{"host": "bench2", "port": 8766, "first": 48, "count": 48}]
+        try:
+            self.rig.remoteRigs = LoadRemoteRigs(Path("remotes.json"))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.startupErrors.append("Could not read remotes.json: %s" % e)
         self.currentChipPath: Optional[Path] = None
+        # Counts the changes to the current project, so that a save that finishes only marks the
+        # project unmodified if it was not changed again while it was being written.
+        self.changes = 0
+        self._modified = False
+        self.currentChip = Chip()
         self.currentCursorShape: Optional[QCursor] = None
 
+    # The folder that message logs are written to. By default it is in the user's data folder.
+    def LogDirectory(self) -> Path:
+        default = Path(QStandardPaths.writableLocation(
+            QStandardPaths.StandardLocation.AppLocalDataLocation)) / "Logs"
+        return Path(self.settings.value("logDirectory", str(default)))
+
+    # Turns writing the messages of all programs to rotating log files in [directory] on or off,
+    # and remembers the choice. Raises OSError if the folder cannot be created.
+    def SetFileLogging(self, enabled: bool, directory: Path):
+        oldSink = self.messageSink
+        if enabled and (oldSink is None or oldSink.path.parent != directory):
+            self.messageSink = MessageFileSink(directory)
+        elif not enabled:
+            self.messageSink = None
+        if self.messageSink is not oldSink:
+            for registry in self.registries:
+                registry.SetMessageSink(self.messageSink)
+            if oldSink is not None:
+                oldSink.Close()
+        self.settings.setValue("logToFile", enabled)
+        self.settings.setValue("logDirectory", str(directory))
+
+    # Changes how many messages each program of every open project keeps, and remembers it.
+    def SetMessageCapacity(self, capacity: int):
+        self.messageCapacity = capacity
+        for registry in self.registries:
+            registry.SetMessageCapacity(capacity)
+        for queue in self.Queues():
+            queue.messages.SetCapacity(capacity)
+        self.settings.setValue("messageCapacity", capacity)
+
+    @property
+    def modified(self) -> bool:
+        return self._modified
+
+    @modified.setter
+    def modified(self, modified: bool):
+        self._modified = modified
+        if modified:
+            self.changes += 1
+
+    # The main window, used as a parent for dialogs.
+    @property
+    def topLevel(self):
+        return QApplication.topLevelWidgets()[0]
+
+    # Each chip project gets its own program registry and experiment queue. Set currentChipPath
+    # first, so that the project's saved queue is loaded. Setting the chip replaces the current
+    # project.
+    @property
+    def currentChip(self) -> Chip:
+        return self._currentChip
+
+    @currentChip.setter
+    def currentChip(self, chip: Chip):
+        self.SetChip(chip, 0)
+
+    def SetChip(self, chip: Chip, solenoidOffset: int):
+        self._currentChip = chip
+        oldPrograms = self.programs
+        if oldPrograms is not None:
+            self.StopProject(oldPrograms, self.queue)
+        self.programs = ProgramCompilation.ProgramRegistry(chip, self.rig)
+        self.programs.messageSink = self.messageSink
+        self.programs.messageCapacity = self.messageCapacity
+        self.programs.solenoidOffset = solenoidOffset
+        self.queue = ExperimentQueue(self.programs, QueuePath(self.currentChipPath))
+        if oldPrograms in self.registries:
+            self.registries = [self.programs if r is oldPrograms else r for r in self.registries]
+        else:
+            self.registries = self.registries + [self.programs]
+        self.UpdateProjectName()
+
+    # Names the current project after its file, e.g. for the labels of its running functions.
+    def UpdateProjectName(self):
+        self.programs.name = UniqueProjectName(
+            "New Chip" if self.currentChipPath is None else self.currentChipPath.stem,
+            [r.name for r in self.registries if r is not self.programs])
+
+    # Opens another project in the editor. The current project keeps running in the background.
+    def OpenAlongside(self, chip: Chip, path: Optional[Path], solenoidOffset: int):
+        self.backgroundProjects.append(self.CurrentAsBackground())
+        self.programs = None
+        self.currentChipPath = path
+        self.SetChip(chip, solenoidOffset)
+        self.modified = False
+
+    # Shows a background project in the editor and moves the current one to the background.
+    def SwitchTo(self, project: BackgroundProject):
+        self.backgroundProjects.remove(project)
+        self.backgroundProjects.append(self.CurrentAsBackground())
+        self.Restore(project)
+
+    # Stops the functions of the current project and closes it, showing the most recently used
+    # background project instead. Returns False if it is the only project.
+    def CloseCurrent(self) -> bool:
+        if len(self.backgroundProjects) == 0:
+            return False
+        self.StopProject(self.programs, self.queue)
+        self.registries = [r for r in self.registries if r is not self.programs]
+        self.Restore(self.backgroundProjects.pop())
+        return True
+
+    # Stops the queue and the running functions of a project that is closed or replaced. Their
+    # patterns stop and their claims are released, so they do not keep driving the rig.
+    def StopProject(self, programs: ProgramCompilation.ProgramRegistry, queue: ExperimentQueue):
+        def Stop():
+            queue.SetRunning(False)
+            programs.StopAll()
+            queue.StopCurrent()
+
+        if self.scheduler is None:
+            Stop()
+        else:
+            self.scheduler.Invoke(Stop)
+
+    def CurrentAsBackground(self) -> BackgroundProject:
+        return BackgroundProject(self._currentChip, self.currentChipPath, self.programs,
+                                 self.queue, self.modified, self.changes)
+
+    def Restore(self, project: BackgroundProject):
+        self._currentChip = project.chip
+        self.currentChipPath = project.path
+        self.programs = project.programs
+        self.queue = project.queue
+        self._modified = project.modified
+        self.changes = project.changes
+
+    # The experiment queues of all open projects.
+    def Queues(self) -> List[ExperimentQueue]:
+        return [self.queue] + [p.queue for p in self.backgroundProjects]
+
     @staticmethod
     def Shutdown():
         self = UIMaster.Instance()
         self.rig.Disconnect()
         SaveObject(self.rig.allDevices, Path("devices.pkl"))
+        for queue in self.Queues():
+            queue.Flush()
+        if self.messageSink is not None:
+            self.messageSink.Close()
 
     @staticmethod
     def CompileProgram(program: Program):
-        self = UIMaster.Instance()
-        if program not in self._programLookup:
-            self._programLookup[program] = ProgramCompilation.CompiledProgram(program)
-            self._compiledPrograms.append(self._programLookup[program])
-        ProgramCompilation.Recompile(self._programLookup[program], self.currentChip, self.rig,
-                                     self._compiledPrograms)
+        UIMaster.Instance().programs.Compile(program)
 
     @staticmethod
     def RemoveProgram(program: Program):
-        self = UIMaster.Instance()
-        if program not in self._programLookup:
-            return
-        self._compiledPrograms.remove(self._programLookup[program])
-        del self._programLookup[program]
+        UIMaster.Instance().programs.Remove(program)
 
+    # The programs of all open projects, which the scheduler ticks. Called on the program thread;
+    # [registries] is only ever replaced, never changed in place.
     @staticmethod
     def GetCompiledPrograms():
-        self = UIMaster.Instance()
-        return self._compiledPrograms
+        registries = UIMaster.Instance().registries
+        if len(registries) == 1:
+            return registries[0].compiledPrograms
+        return [x for registry in registries for x in registry.compiledPrograms]
 
     @staticmethod
     def GetCompiledProgram(program: Program):
-        self = UIMaster.Instance()
-        if program not in self._programLookup or \
-                ProgramCompilation.IsOutOfDate(self._programLookup[program]):
-            self.CompileProgram(program)
-        return self._programLookup[program]
+        return UIMaster.Instance().programs.Get(program)
 
     @staticmethod
     def Instance():
@@ -1,15 +1,16 @@
 import threading
 import time
-from UI.UIMaster import UIMaster
+from Data.Rig import Rig
 
 
 class USBWorker:
-    def __init__(self):
+    def __init__(self, rig: Rig):
+        self.rig = rig
         self.thread = threading.Thread(target=self.Loop, daemon=True)
         self.doStop = False
         self.thread.start()
 
     def Loop(self):
         while not self.doStop:
-            UIMaster.Instance().rig.RescanForDevices()
+            self.rig.RescanForDevices()
             time.sleep(1)
@@ -0,0 +1,104 @@
+# Switching between open projects in the editor. Runs headless; needs PySide6. Run from the uChip
+# directory:
+#   python -m pytest tests
+import os
+
+import pytest
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+QtWidgets = pytest.importorskip("PySide6.QtWidgets")
+
+from Data.Chip import Chip, Valve, Program, Text  # noqa: E402
+from Data.BuiltinScripts import FindBuiltin  # noqa: E402
+from Data.ProgramCompilation import CallFunction, IsFunctionRunning  # noqa: E402
+from UI.UIMaster import UIMaster  # noqa: E402
+
+
+@pytest.fixture
+def chipView(monkeypatch):
+    monkeypatch.chdir(os.path.join(os.path.dirname(__file__), ".."))
+    application = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    UIMaster._instance = None
+    from UI.ChipView import ChipView
+    view = ChipView()
+    yield view
+    view.CloseChip()
+    UIMaster._instance = None
+    application.processEvents()
+
+
+def MakeChip(valveCount: int) -> Chip:
+    chip = Chip()
+    for number in range(valveCount):
+        valve = Valve()
+        valve.name = "Valve %d" % number
+        valve.solenoidNumber = number
+        chip.AddValve(valve)
+    text = Text()
+    text.text = "Label"
+    chip.text.append(text)
+    chip.AddProgram(Program(FindBuiltin("Pump")))
+    return chip
+
+
+def Contents(chip: Chip):
+    return list(chip.valves), list(chip.programs), list(chip.text), list(chip.images)
+
+
+def test_switching_keeps_background_project(chipView):
+    master = UIMaster.Instance()
+    first = MakeChip(3)
+    master.currentChip = first
+    master.modified = False
+    chipView.OpenChip()
+    before = Contents(first)
+    compiled = master.programs.Get(first.programs[0])
+
+    chipView.CloseChip()
+    master.OpenAlongside(MakeChip(2), None, 48)
+    chipView.OpenChip()
+
+    assert Contents(first) == before
+    assert len(master.backgroundProjects) == 1
+    background = master.backgroundProjects[0]
+    assert background.chip is first
+    assert not background.modified
+    assert background.programs.Get(first.programs[0]) is compiled
+
+    chipView.CloseChip()
+    master.SwitchTo(background)
+    chipView.OpenChip()
+
+    assert master.currentChip is first
+    assert Contents(first) == before
+    assert not master.modified
+    assert len(chipView.graphicsView.allItems) == sum(len(x) for x in before)
+
+
+def test_deleting_items_removes_them_from_chip(chipView):
+    master = UIMaster.Instance()
+    chip = MakeChip(2)
+    master.currentChip = chip
+    master.modified = False
+    chipView.OpenChip()
+
+    chipView.graphicsView.Clear()
+
+    assert Contents(chip) == ([], [], [], [])
+    assert master.modified
+
+
+def test_replacing_project_stops_its_functions(chipView):
+    master = UIMaster.Instance()
+    chip = MakeChip(3)
+    master.currentChip = chip
+    program = chip.programs[0]
+    program.parameterValues["cyclesPerSecond"] = 0.0
+    compiled = master.programs.Get(program)
+    CallFunction(compiled, "RunPump")
+    assert IsFunctionRunning(compiled, "RunPump")
+
+    master.currentChip = Chip()
+
+    assert not IsFunctionRunning(compiled, "RunPump")
+    assert master.registries == [master.programs]
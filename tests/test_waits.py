@@ -0,0 +1,75 @@
+# Waiting for other program functions. Runs without Qt or hardware. Run from the uChip directory:
+#   python -m pytest tests
+from Data.Chip import Chip, Program, Script
+from Data.Clock import VirtualClock
+from Data.ProgramCompilation import ProgramRegistry, CallFunction, IsFunctionRunning, \
+    StopFunction
+from Data.Rig import Rig
+from Data.Scheduler import Scheduler
+
+SCRIPT = """
+@display
+def Long():
+    yield WaitForSignal("finish")
+
+def WaitTwice():
+    yield WaitAny(Long, Long)
+
+def WaitThroughProxies():
+    yield WaitAny(FindProgram("Waits").Long, FindProgram("Waits").Long)
+
+def WaitForNothing():
+    yield WaitAny()
+"""
+
+
+def StartProgram(tmp_path):
+    path = tmp_path / "Waits.py"
+    path.write_text(SCRIPT)
+    chip = Chip()
+    program = Program(Script(path))
+    program.name = "Waits"
+    chip.AddProgram(program)
+    clock = VirtualClock()
+    rig = Rig()
+    registry = ProgramRegistry(chip, rig)
+    registry.clock = clock
+    compiled = registry.Get(program)
+    scheduler = Scheduler(rig, lambda: registry.compiledPrograms, clock)
+    return registry, compiled, scheduler
+
+
+def test_wait_any_for_the_same_function_twice(tmp_path):
+    registry, compiled, scheduler = StartProgram(tmp_path)
+    CallFunction(compiled, "Long")
+    for waiter in ["WaitTwice", "WaitThroughProxies"]:
+        CallFunction(compiled, waiter)
+        scheduler.RunUntil(lambda: False, 0.1, None)
+        assert IsFunctionRunning(compiled, waiter), waiter
+
+    registry.Signal("finish")
+    scheduler.RunUntil(lambda: False, 0.1, None)
+
+    assert not IsFunctionRunning(compiled, "WaitTwice")
+    assert not IsFunctionRunning(compiled, "WaitThroughProxies")
+
+
+def test_wait_any_for_a_function_that_is_not_running(tmp_path):
+    registry, compiled, scheduler = StartProgram(tmp_path)
+    CallFunction(compiled, "WaitTwice")
+    CallFunction(compiled, "WaitForNothing")
+    scheduler.RunUntil(lambda: False, 0.1, None)
+
+    assert not IsFunctionRunning(compiled, "WaitTwice")
+    assert not IsFunctionRunning(compiled, "WaitForNothing")
+
+
+def test_stopping_the_function_wakes_wait_any(tmp_path):
+    registry, compiled, scheduler = StartProgram(tmp_path)
+    CallFunction(compiled, "Long")
+    CallFunction(compiled, "WaitTwice")
+    scheduler.RunUntil(lambda: False, 0.1, None)
+    StopFunction(compiled, "Long")
+    scheduler.RunUntil(lambda: False, 0.1, None)
+
+    assert not IsFunctionRunning(compiled, "WaitTwice")
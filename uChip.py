@@ -1,13 +1,16 @@
 import pathlib
 
 from PySide6 import QtWidgets
+from PySide6.QtCore import QTimer
 from UI.MainWindow import MainWindow
-from UI.DebugWindow import DebugWindow
 import sys
 
 if __name__ == '__main__':
     app = QtWidgets.QApplication(sys.argv)
+    app.setOrganizationName("uChip")
+    app.setApplicationName("uChip")
     window = MainWindow()
-    window.OpenChipPath(pathlib.Path("ScreenSeq.ucp"))
+    # Open the default project once the window has painted.
+    QTimer.singleShot(0, lambda: window.OpenChipPath(pathlib.Path("ScreenSeq.ucp")))
     app.exec()
 
@@ -0,0 +1 @@
+# Command line interface for running uChip projects without the GUI. See __main__.py.
@@ -0,0 +1,421 @@
+# Runs uChip projects from the command line, without Qt. Run from the uChip directory:
+#   python -m uchip run project.ucp --program Pump --function RunPump --set cyclesPerSecond=5
+#   python -m uchip run project.ucp --program Screen --function StartScreen --simulate
+#   python -m uchip list project.ucp
+#   python -m uchip convert old.ucp
+#   python -m uchip serve project.ucp --socket uchip.sock
+#   python -m uchip serve left.ucp right.ucp@48
+#   python -m uchip agent --port 8766
+#   python -m uchip serve project.ucp --remote bench2=48+48
+#   python -m uchip serve project.ucp --metrics-port 8767 --metrics-file /var/lib/node/uchip.prom
+#   python -m uchip queue project.ucp --program Screen --function StartScreen \
+#       --grid "collectionTime=10;20;30" --grid "stabilizeTime=5;10" --run
+import argparse
+import ipaddress
+import pathlib
+import sys
+import threading
+import time
+
+from Data.MessageLog import Message, MessageLog
+from Data.ProgramCompilation import ParseParameterValue, CompiledProgram, StopFunction, \
+    SetProfiling
+from Data.Session import Session, SolenoidOverlaps
+from Data.ControlServer import ControlServer
+from Data.ExperimentQueue import ExperimentQueue, QueuePath, QueuedRun
+from Data.RemoteRig import RigAgent, ParseRemoteRig, DEFAULT_PORT, DEFAULT_HOST, \
+    SECRET_VARIABLE, DefaultSecret
+from Data.Metrics import MetricsServer, MetricsFileWriter
+from Data.ProjectFile import ConvertProject
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m uchip",
+                                     description="Run uChip projects without the GUI.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Run a program function until it finishes.")
+    run.add_argument("project", type=pathlib.Path)
+    run.add_argument("--program", required=True, help="The name of the program in the project.")
+    run.add_argument("--function", required=True, help="The symbol of the function to run.")
+    run.add_argument("--set", action="append", default=[], metavar="PARAMETER=VALUE",
+                     help="Set a parameter before running. Lists are comma-separated and valves "
+                          "and programs are given by name.")
+    run.add_argument("--devices", type=pathlib.Path, default=pathlib.Path("devices.pkl"),
+                     help="The saved device configuration to use.")
+    run.add_argument("--timeout", type=float, default=None,
+                     help="Stop the function after this many seconds.")
+    run.add_argument("--simulate", action="store_true",
+                     help="Dry-run under a simulated clock without touching the rig.")
+    run.add_argument("--stats", action="store_true",
+                     help="Print tick timing per function when the run ends.")
+    run.add_argument("--profile", action="store_true",
+                     help="Time the program's script line by line and print the slowest lines "
+                          "and API calls when the run ends (not with --simulate).")
+    AddRemoteArgument(run)
+    AddMetricsArguments(run)
+
+    serve = commands.add_parser("serve", help="Run projects and accept commands from the local "
+                                              "control API until interrupted.")
+    serve.add_argument("projects", nargs="+", metavar="project[@offset]",
+                       help="Projects to run side by side on the rig. Add @N to move a project's "
+                            "solenoid 0 to rig solenoid N.")
+    serve.add_argument("--socket", default=None,
+                       help="The Unix socket to listen on (default: %s)." %
+                            ControlServer.DEFAULT_SOCKET)
+    serve.add_argument("--port", type=int, default=None,
+                       help="Listen on this localhost TCP port instead of a Unix socket.")
+    serve.add_argument("--message-capacity", type=int, default=MessageLog.DEFAULT_CAPACITY,
+                       metavar="COUNT",
+                       help="How many messages each program keeps for the control API "
+                            "(default: %d)." % MessageLog.DEFAULT_CAPACITY)
+    serve.add_argument("--devices", type=pathlib.Path, default=pathlib.Path("devices.pkl"),
+                       help="The saved device configuration to use.")
+    AddRemoteArgument(serve)
+    AddMetricsArguments(serve)
+
+    queue = commands.add_parser("queue", help="Add runs to a project's experiment queue, list it "
+                                              "and run the pending runs.")
+    queue.add_argument("project", type=pathlib.Path)
+    queue.add_argument("--program", help="The program of the runs to add.")
+    queue.add_argument("--function", help="The function of the runs to add.")
+    queue.add_argument("--grid", action="append", default=[], metavar="PARAMETER=V1;V2;...",
+                       help="Parameter values to run. One run is added for every combination.")
+    queue.add_argument("--run", action="store_true", help="Run the pending runs.")
+    queue.add_argument("--devices", type=pathlib.Path, default=pathlib.Path("devices.pkl"),
+                       help="The saved device configuration to use.")
+    AddRemoteArgument(queue)
+    AddMetricsArguments(queue)
+
+    agent = commands.add_parser("agent", help="Drive this computer's solenoid boards for a uChip "
+                                              "controller on another computer.")
+    agent.add_argument("--host", default=DEFAULT_HOST,
+                       help="The address to listen on (default: %s, only this computer). Use "
+                            "0.0.0.0 to let other computers connect, and set a shared secret "
+                            "in %s on the agent and the controller." % (DEFAULT_HOST,
+                                                                       SECRET_VARIABLE))
+    agent.add_argument("--port", type=int, default=DEFAULT_PORT, help="The TCP port to listen on.")
+    agent.add_argument("--devices", type=pathlib.Path, default=pathlib.Path("devices.pkl"),
+                       help="The saved device configuration to use.")
+
+    listCommand = commands.add_parser("list", help="List the programs, functions and parameters "
+                                                   "of a project.")
+    listCommand.add_argument("project", type=pathlib.Path)
+
+    convert = commands.add_parser("convert", help="Convert projects saved by earlier versions of "
+                                                  "uChip to the current project format.")
+    convert.add_argument("projects", nargs="+", type=pathlib.Path)
+    convert.add_argument("--no-backup", action="store_true",
+                         help="Do not keep the original file as <project>.ucp.dill.")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        return Run(args)
+    if args.command == "list":
+        return List(args)
+    if args.command == "serve":
+        return Serve(args)
+    if args.command == "queue":
+        return Queue(args)
+    if args.command == "agent":
+        return Agent(args)
+    if args.command == "convert":
+        return Convert(args)
+
+
+def List(args):
+    session = Session(None)
+    registry = session.OpenProject(args.project)
+    for compiled in registry.compiledPrograms:
+        print("%s (%s)" % (compiled.program.name, compiled.program.script.Name()))
+        for symbol, parameter in compiled.parameters.items():
+            print("    parameter %s = %r" % (symbol, compiled.program.parameterValues.get(symbol)))
+        for symbol in compiled.showableFunctions:
+            print("    function %s" % symbol)
+        PrintMessages(compiled, 0)
+    return 0
+
+
+def Run(args):
+    session = Session(None if args.simulate else args.devices)
+    registry = session.OpenProject(args.project)
+    found = session.FindProgram(args.program)
+    if found is None:
+        print("Could not find a program named '%s'." % args.program, file=sys.stderr)
+        return 1
+    _, program = found
+    compiled = registry.Get(program)
+    if any(m.messageType == Message.ERROR_CT for m in compiled.messages):
+        PrintMessages(compiled, 0)
+        return 1
+    if args.function not in compiled.programFunctions:
+        print("Could not find function '%s' in program '%s'." % (args.function, args.program),
+              file=sys.stderr)
+        return 1
+
+    for assignment in args.set:
+        symbol, _, text = assignment.partition("=")
+        if symbol not in compiled.parameters:
+            print("Program '%s' has no parameter '%s'." % (args.program, symbol), file=sys.stderr)
+            return 1
+        program.parameterValues[symbol] = ParseParameterValue(
+            text, compiled.parameters[symbol].parameterType, registry.chip)
+
+    if args.simulate:
+        return Simulate(registry, program, args)
+
+    StartRescanning(session, args)
+    exporters = StartMetrics(session, args)
+    if args.profile:
+        SetProfiling(compiled, True)
+    compiled.programFunctions[args.function]()
+    printed = [0]
+
+    def IsDone():
+        printed[0] = PrintMessages(compiled, printed[0])
+        return args.function not in compiled.asyncFunctions
+
+    try:
+        finished = session.scheduler.RunUntil(IsDone, args.timeout)
+        if not finished and args.function in compiled.asyncFunctions:
+            StopFunction(compiled, args.function)
+    except KeyboardInterrupt:
+        if args.function in compiled.asyncFunctions:
+            StopFunction(compiled, args.function)
+        session.rig.FlushStates()
+        PrintMessages(compiled, printed[0])
+        PrintStats(session, args, compiled)
+        CloseAll(exporters)
+        session.Close()
+        return 130
+    session.rig.FlushStates()
+    PrintMessages(compiled, printed[0])
+    PrintStats(session, args, compiled)
+    CloseAll(exporters)
+    session.Close()
+    return 1 if any(m.messageType != Message.MESSAGE for m in compiled.messages) else 0
+
+
+def Serve(args):
+    session = Session(args.devices, messageCapacity=args.message_capacity)
+    for project in args.projects:
+        path, offset = ParseProjectArgument(project)
+        session.OpenProject(path, offset)
+    for number, valves in SolenoidOverlaps(session.registries).items():
+        print("Warning: rig solenoid %d is used by %s." % (number, ", ".join(valves)),
+              file=sys.stderr)
+    StartRescanning(session, args)
+    address = ("127.0.0.1", args.port) if args.port is not None else args.socket
+    server = ControlServer(session.scheduler, lambda: session.registries, address)
+    print("Listening on %s" % server.Describe())
+    exporters = StartMetrics(session, args)
+    printed = {}
+
+    def PrintAllMessages():
+        for compiled in session.CompiledPrograms():
+            printed[compiled] = PrintMessages(compiled, printed.get(compiled, 0))
+        return False
+
+    try:
+        session.scheduler.RunUntil(PrintAllMessages)
+    except KeyboardInterrupt:
+        pass
+    server.Close()
+    CloseAll(exporters)
+    for compiled in session.CompiledPrograms():
+        for symbol in list(compiled.asyncFunctions):
+            StopFunction(compiled, symbol)
+    session.rig.FlushStates()
+    session.Close()
+    return 0
+
+
+def Queue(args):
+    session = Session(args.devices if args.run else None)
+    registry = session.OpenProject(args.project)
+    queue = ExperimentQueue(registry, QueuePath(args.project))
+    queuePrinted = PrintQueueMessages(queue, 0)
+    if args.program is not None or args.function is not None:
+        if args.program is None or args.function is None:
+            print("Give both --program and --function to add runs.", file=sys.stderr)
+            return 1
+        grid = {}
+        for assignment in args.grid:
+            symbol, _, text = assignment.partition("=")
+            grid[symbol] = [v.strip() for v in text.split(";") if v.strip() != ""]
+        print("Added %d run(s)." % len(queue.Submit(args.program, args.function, grid)))
+
+    if args.run:
+        StartRescanning(session, args)
+        exporters = StartMetrics(session, args)
+        session.scheduler.tickCallbacks.append(queue.Tick)
+        queue.SetRunning(True)
+        printed = {}
+
+        def IsDone():
+            for compiled in session.CompiledPrograms():
+                printed[compiled] = PrintMessages(compiled, printed.get(compiled, 0))
+            return not queue.running and queue.current is None
+
+        try:
+            session.scheduler.RunUntil(IsDone)
+        except KeyboardInterrupt:
+            queue.SetRunning(False)
+            queue.StopCurrent()
+        session.rig.FlushStates()
+        CloseAll(exporters)
+        session.Close()
+
+    queue.Flush()
+    PrintQueueMessages(queue, queuePrinted)
+    for run in queue.runs:
+        duration = "" if run.startTime is None or run.endTime is None else \
+            "  %.1f s" % (run.endTime - run.startTime)
+        print("%4d  %-11s  %s.%s(%s)%s" % (run.runId, run.state, run.programName,
+                                          run.functionSymbol, run.Describe(), duration))
+    return 1 if any(r.state == QueuedRun.FAILED for r in queue.runs) else 0
+
+
+def Convert(args):
+    failed = False
+    for path in args.projects:
+        temporaryPath = path.with_name(path.name + ".converting")
+        try:
+            if not ConvertProject(path, temporaryPath):
+                print("%s is already in the current format." % path)
+                continue
+        except Exception as e:
+            print("Could not convert %s: %s" % (path, e), file=sys.stderr)
+            temporaryPath.unlink(missing_ok=True)
+            failed = True
+            continue
+        if not args.no_backup:
+            path.replace(path.with_name(path.name + ".dill"))
+        temporaryPath.replace(path)
+        print("Converted %s." % path)
+    return 1 if failed else 0
+
+
+# Splits "project.ucp@48" into the path and the solenoid offset.
+def ParseProjectArgument(text: str):
+    path, _, offset = text.rpartition("@")
+    if path != "" and offset.isdigit():
+        return pathlib.Path(path), int(offset)
+    return pathlib.Path(text), 0
+
+
+def Agent(args):
+    session = Session(args.devices)
+    agent = RigAgent(session.rig, (args.host, args.port))
+    print("Agent listening on %s" % agent.Describe())
+    if DefaultSecret() == "" and not ipaddress.ip_address(agent.address[0]).is_loopback:
+        print("Warning: any computer that can reach this agent can set its valves. Set a shared "
+              "secret in %s." % SECRET_VARIABLE, file=sys.stderr)
+    StartRescanning(session, args)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    agent.Close()
+    session.Close()
+    return 0
+
+
+def AddRemoteArgument(parser: argparse.ArgumentParser):
+    parser.add_argument("--remote", action="append", default=[], type=ParseRemoteRig,
+                        metavar="HOST[:PORT]=FIRST+COUNT[@REMOTEFIRST]",
+                        help="Drive solenoids FIRST to FIRST+COUNT-1 with the agent on HOST "
+                             "(python -m uchip agent), starting at its solenoid REMOTEFIRST.")
+
+
+def AddMetricsArguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--metrics-port", type=int, default=None, metavar="PORT",
+                        help="Serve OpenMetrics/Prometheus metrics at "
+                             "http://127.0.0.1:PORT/metrics.")
+    parser.add_argument("--metrics-file", type=pathlib.Path, default=None, metavar="PATH",
+                        help="Write Prometheus metrics to this file every --metrics-interval "
+                             "seconds (e.g. for node_exporter's textfile collector).")
+    parser.add_argument("--metrics-interval", type=float, default=15.0, metavar="SECONDS")
+
+
+# Starts the metrics exporters asked for on the command line.
+def StartMetrics(session: Session, args):
+    exporters = []
+    if args.metrics_port is not None:
+        exporters.append(MetricsServer(session.scheduler, lambda: session.registries,
+                                       ("127.0.0.1", args.metrics_port)))
+    if args.metrics_file is not None:
+        exporters.append(MetricsFileWriter(session.scheduler, lambda: session.registries,
+                                           args.metrics_file, args.metrics_interval))
+    for exporter in exporters:
+        print("Exporting metrics to %s" % exporter.Describe(), file=sys.stderr)
+    return exporters
+
+
+def CloseAll(exporters):
+    for exporter in exporters:
+        exporter.Close()
+
+
+def PrintStats(session: Session, args, compiled: CompiledProgram):
+    if args.stats:
+        print(session.scheduler.stats.Table(), file=sys.stderr)
+    if args.profile:
+        print(compiled.profileResults.Table(compiled.program.script.Read().splitlines()),
+              file=sys.stderr)
+
+
+# Keeps devices and remote rigs connected in the background, like the GUI's USB worker.
+def StartRescanning(session: Session, args):
+    session.rig.remoteRigs += getattr(args, "remote", [])
+
+    def RescanLoop():
+        while True:
+            session.rig.RescanForDevices()
+            time.sleep(1)
+
+    session.rig.RescanForDevices()
+    for remote in session.rig.remoteRigs:
+        if not remote.IsConnected():
+            print("Could not connect to the agent %s yet (%s)." % (remote.Describe(),
+                                                                   remote.Status()),
+                  file=sys.stderr)
+    threading.Thread(target=RescanLoop, daemon=True).start()
+
+
+def Simulate(registry, program, args):
+    from Data.Simulation import Simulate
+    result = Simulate(registry.chip, program, args.function,
+                      maxSeconds=args.timeout if args.timeout is not None else 7 * 24 * 60 * 60)
+    names = {}
+    for v in registry.chip.valves:
+        names.setdefault(v.solenoidNumber, v.name)
+    for t, number, state in result.transitions:
+        print("%12.3f  %s %s" % (t, names.get(number, "Solenoid %d" % number),
+                                 "open" if state else "closed"))
+    for t, programName, message in result.messages:
+        print("%12.3f  [%s] %s" % (t, programName, message.text))
+    print("Duration: %.3f s%s" % (result.duration, "" if result.finished else " (did not finish)"))
+    return 0 if result.finished else 1
+
+
+# Prints the messages of a program from sequence number [start] and returns the next sequence
+# number to print from.
+def PrintMessages(compiled: CompiledProgram, start: int):
+    for message in compiled.messages.Since(start):
+        stream = sys.stdout if message.messageType == Message.MESSAGE else sys.stderr
+        print("[%s] %s" % (compiled.program.name, message.text), file=stream)
+        start = message.sequence + 1
+    return start
+
+
+def PrintQueueMessages(queue: ExperimentQueue, start: int):
+    for message in queue.messages.Since(start):
+        print(message.text, file=sys.stderr)
+        start = message.sequence + 1
+    return start
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -66,6 +66,50 @@ class Valve:
         pass
 
 
+# A fixed set of valves that are switched together with a single change to the rig, retrieved with
+# FindValves(...). Pattern bits and snapshots are integers where bit i is the i-th valve of the
+# group (in the order given to FindValves).
+# e.g. inlets = FindValves("R*", "V*")
+#      inlets.SetAll(False)
+#      inlets.SetPattern({"R1": True, "V1": False})
+class ValveGroup:
+    def SetAll(self, state: bool):
+        pass
+
+    def OpenAll(self):
+        self.SetAll(True)
+
+    def CloseAll(self):
+        self.SetAll(False)
+
+    # Sets the valves from a dict of {valve name or index: state} (other valves are left alone), or
+    # from an integer with one bit per valve.
+    def SetPattern(self, pattern: typing.Union[typing.Dict, int]):
+        pass
+
+    # Returns the current states as an integer with one bit per valve.
+    def Snapshot(self) -> int:
+        pass
+
+    def Restore(self, snapshot: int):
+        self.SetPattern(snapshot)
+
+    def Names(self) -> typing.List[str]:
+        pass
+
+    def Valves(self) -> typing.List[Valve]:
+        pass
+
+    def __len__(self):
+        return len(self.Valves())
+
+    def __iter__(self):
+        return iter(self.Valves())
+
+    def __getitem__(self, index):
+        return self.Valves()[index]
+
+
 # A Program object should not be instantiated by itself. Programs can be retrieved by name with
 # FindProgram(name) or passed through the GUI with Parameter(Program). All of the program's
 # parameters and functions are accessible through this object by their symbol name.
@@ -91,9 +135,18 @@ class ProgramFunction:
         self.onResume: typing.Optional[Callable] = lambda: None
         self.hidden = True
 
+        # Returns the running instance of this function (or None). Bound by uChip.
+        self.runningInfo: Callable = lambda: None
+
+        # Valve selectors that the function claims when it starts (see @claims).
+        self.claims: typing.Optional[tuple] = None
+        self.waitForClaims = False
+
     def __call__(self, *args, **kwargs):
         return self.Call(*args, **kwargs)
 
+    # Runs the function. If it runs asynchronously, this function is returned so that it can be
+    # waited on with WaitForFunction.
     def Call(self, *args, **kwargs):
         raise NotImplementedError("ERROR!")
 
@@ -131,6 +184,97 @@ class WaitForHours(WaitForSeconds):
         super().__init__(60 * 60 * hours)
 
 
+# The following values can be yielded to pause until other running program functions have
+# finished or been stopped. Functions that are not running count as finished. The waiting function
+# is resumed in the same tick that the last awaited function finishes.
+# e.g. yield WaitForFunction(FindProgram("Pump").RunPump)
+class WaitForFunction:
+    def __init__(self, function: ProgramFunction):
+        self.functions = [function]
+        self.waitForAll = True
+
+
+# e.g. yield WaitAll(FindProgram("Pump 1").RunPump, FindProgram("Pump 2").RunPump)
+class WaitAll(WaitForFunction):
+    def __init__(self, *functions: ProgramFunction):
+        super().__init__(None)
+        self.functions = list(functions)
+
+
+# Resumes as soon as any one of the functions has finished.
+class WaitAny(WaitForFunction):
+    def __init__(self, *functions: ProgramFunction):
+        super().__init__(None)
+        self.functions = list(functions)
+        self.waitForAll = False
+
+
+# Yield to pause until another function (in any program of the chip) calls Signal(name). If a
+# timeout in seconds is given, the function resumes after the timeout even without a signal, and
+# timedOut is set to True.
+# e.g. yield WaitForSignal("reagents ready")
+class WaitForSignal:
+    def __init__(self, name: str, timeout: typing.Optional[float] = None):
+        self.name = name
+        self.timeout = timeout
+        self.timedOut = False
+
+
+# Yield to pause until predicate() returns True. The predicate is only checked again when a valve
+# or parameter changes. If a timeout in seconds is given, the function resumes after the timeout
+# even if the predicate is still False, and timedOut is set to True.
+# e.g. yield WaitUntil(lambda: FindValve("Outlet").IsOpen(), timeout=60)
+class WaitUntil:
+    def __init__(self, predicate: Callable[[], bool], timeout: typing.Optional[float] = None):
+        self.predicate = predicate
+        self.timeout = timeout
+        self.timedOut = False
+
+
+# Yield to play a table of valve states with precise timing. [valves] is a ValveGroup, a list of
+# valves or valve names, and each row of [table] gives one state per valve (or an integer with bit
+# i set to open valve i). The table can also be a NumPy array (steps x valves) or another
+# buffer-protocol object. Each row is held for [stepSeconds] (a number, or one number per row), or
+# if stepSeconds is None, for the number of seconds in the row's last column. [stepSeconds] can
+# also be a function that returns the duration of every step. It is called again whenever a
+# parameter, a valve or a solenoid changes (at most once a tick), and a new duration applies from
+# the next step, so the pattern keeps playing without a gap. If it returns None, the pattern stops
+# and the function continues.
+# The table is played [repeat] times, or until the function is stopped if repeat is None.
+# Stopping or pausing the function stops or pauses the pattern. Steps are written by a dedicated
+# thread, so they are not limited to the 10 ms program tick.
+# Once the pattern has finished or been stopped, the requested duration of the steps that were
+# played, the achieved duration and how late steps were written are set on the PlayPattern.
+# e.g. yield PlayPattern(FindValves("Pump *"), [(1, 0, 0), (1, 1, 0), (0, 1, 0)], 0.05)
+class PlayPattern:
+    def __init__(self, valves, table,
+                 stepSeconds: typing.Union[None, float, typing.Sequence[float],
+                                           Callable[[], typing.Optional[float]]],
+                 repeat: typing.Optional[int] = None):
+        self.valves = valves
+        self.table = table
+        self.stepSeconds = stepSeconds
+        self.repeat = repeat
+        self.stepsPlayed = 0
+        self.requestedSeconds = 0.0
+        self.achievedSeconds = 0.0
+        self.meanLateness = 0.0
+        self.maxLateness = 0.0
+
+
+# Yield to claim valves for the running function. While claimed, the valves cannot be set by any
+# other function; trying to do so raises an error in that function. If another function holds any
+# of the valves, this function waits until they are all released (or the timeout in seconds
+# passes, in which case timedOut is set and nothing is claimed). Claims are released when the
+# function finishes or is stopped, or with ReleaseClaim. Selectors are the same as for FindValves.
+# e.g. yield Claim("Pump *", "Inlet")
+class Claim:
+    def __init__(self, *selectors, timeout: typing.Optional[float] = None):
+        self.selectors = selectors
+        self.timeout = timeout
+        self.timedOut = False
+
+
 class OptionsParameterType:
     def __init__(self, options: typing.List[str]):
         self.options = options
@@ -199,6 +343,20 @@ def onResume(funcToCall: typing.Callable):
     return decorate
 
 
+# A decorator that claims valves (see Claim) when the decorated asynchronous function starts. If
+# another function holds any of them, the function is not started and an error is logged, or with
+# wait=True, the function starts once they have been released.
+# e.g. @claims("Pump *", wait=True)
+def claims(*selectors, wait=False):
+    def decorate(function: Union[Callable, ProgramFunction]):
+        f = _pf(function)
+        f.claims = selectors
+        f.waitForClaims = wait
+        return f
+
+    return decorate
+
+
 # Sets the program description.
 class SetDescription:
     def __init__(self, description: str):
@@ -210,11 +368,34 @@ def FindValve(name: str) -> Valve:
     pass
 
 
+# Finds all valves matching the given selectors and returns them as a ValveGroup. A selector can
+# be a valve name, a wildcard pattern ("R*", "V[1-4]"), a compiled regular expression
+# (re.compile("R[0-9]+")), a Valve, another ValveGroup, or a list of these.
+def FindValves(*selectors) -> ValveGroup:
+    pass
+
+
 # Finds a program in the chip project named [name].
 def FindProgram(name: str) -> Program:
     pass
 
 
+# Resumes all functions that are waiting with WaitForSignal(name).
+def Signal(name: str):
+    pass
+
+
+# Claims valves for the running function if no other function holds any of them. Returns True if
+# they were claimed.
+def TryClaim(*selectors) -> bool:
+    pass
+
+
+# Releases valves claimed by the running function, or all of them if no selectors are given.
+def ReleaseClaim(*selectors):
+    pass
+
+
 # Logs text to the program output.
 def Log(text: str):
     pass